@@ -1,9 +1,19 @@
 """ Sequence Bloom Tree Node implementation based off of HowDe-SBT in Kingsford & Solomon (2015) """
 from bitarray import bitarray
+from SBT.bits import indices_to_bitarray
+from SBT.SparseFilter import compress_filter, decompress_filter, DEFAULT_MAX_DENSITY
+from SBT.kernels import base_check, base_batch_check, MISS, HIT, PARTIAL
+from SBT.traversal import update_shape, restore_node, iter_matching_names
+import numpy as np
 
 
 class BaseNode(object):
+    __slots__ = ("bloom_filter_length", "hash_functions", "similarity_function", "experiment_name", "bloom_filter",
+                 "left_child", "right_child", "leaf_range", "height",
+                 "num_leaves", "id")
     count = 0  # How many Nodes have been created
+    sbt_type = "Base"
+    filter_names = ("bloom_filter",)  # Filters kept in the matrices of a FlatTree
 
     def __init__(self, bloom_filter_length, hash_functions, similarity_function, experiment_name, bloom_filter=None):
         self.bloom_filter_length = bloom_filter_length
@@ -14,8 +24,11 @@ class BaseNode(object):
         self.bloom_filter = bloom_filter if bloom_filter is not None else bitarray('0') * bloom_filter_length
         self.left_child = None
         self.right_child = None
+        self.leaf_range = None  # (first, last + 1) leaf id of the subtree, set by traversal.index_leaves()
+        self.height = 0  # Number of edges on the longest path down to a leaf (see traversal.update_shape())
+        self.num_leaves = 1  # Number of leaves in the subtree
         # Give node an id
-        self.id = str(BaseNode.count)
+        self.id = BaseNode.count
         BaseNode.count += 1
 
     """ Creates a new parent Node whose children are left_child and right_child. The Node's filter(s) are set so that
@@ -30,6 +43,7 @@ class BaseNode(object):
         # Set new node's children
         node.left_child = left_child
         node.right_child = right_child
+        update_shape(node)
         return node
 
     """ Insert a kmer into the Node's bloom filter """
@@ -37,9 +51,27 @@ class BaseNode(object):
         for hash_function in self.hash_functions:
             self.bloom_filter[hash_function(kmer) % self.bloom_filter_length] = True
 
-    """ Query a kmer from the Node's bloom filter """
-    def query_kmer(self, kmer):
+    """ Insert the precomputed filter indices of many kmers (one column per hash function) into the Node's bloom
+    filter """
+    def insert_filter_indices(self, filter_indices):
+        self.bloom_filter |= indices_to_bitarray(filter_indices, self.bloom_filter_length)
+
+    """ Replace every filter of this Node that has at most max_density of its bits set with a SparseFilter, which is
+    queried without decompressing it """
+    def compress(self, max_density=DEFAULT_MAX_DENSITY):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, compress_filter(getattr(self, filter_name), max_density))
+
+    """ Turn the Node's SparseFilters back into bitarrays (needed before inserting into the Node) """
+    def decompress(self):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, decompress_filter(getattr(self, filter_name)))
+
+    """ Query a kmer from the Node's bloom filter. Every bit read is reported to trace if given """
+    def query_kmer(self, kmer, trace=None):
         for hash_function in self.hash_functions:  # Check if any bits are 0, if so return false
+            if trace is not None:
+                trace.probe(0, 1)
             if not self.bloom_filter[hash_function(kmer) % self.bloom_filter_length]:
                 return False
         return True
@@ -51,66 +83,110 @@ class BaseNode(object):
             return self.similarity_function(self.bloom_filter, node.bloom_filter)
         return self.similarity_function(self.bloom_filter[:bits_to_check], node.bloom_filter[:bits_to_check])
 
+    """ Restore an unpickled Node, including Nodes pickled before the node classes had slots (see
+    traversal.restore_node()) """
+    def __setstate__(self, state):
+        restore_node(self, state)
+
     """ Deep copy fields of node (except for left and right children) """
     def copy(self):
         return BaseNode(self.bloom_filter_length, self.hash_functions, self.similarity_function, self.experiment_name,
                         self.bloom_filter.copy())
 
     """ Insert a single node to an existing SBT greedily by traversing down the most similar child starting from the 
-    root """
-    def insert_experiment(self, node):
+    root. If bits_to_check is set, children are compared with the node on only their first (# bits_to_check) bits, a
+    fixed-size sample of the filters (hashed kmers are spread uniformly over the filter), so routing costs O(depth)
+    regardless of bloom_filter_length and only the filter updates touch the full filters. Returns the Nodes on the way
+    from the new leaf's parent up to this Node """
+    def insert_experiment(self, node, bits_to_check=None):
         # 0 children - copy current node into left child and insert into right child
         if self.left_child is None:
             self.left_child = self.copy()
             self.experiment_name = "I" + str(self.id)  # Label inner nodes
             self.right_child = node
+            path = []
         # 2 children - iterate into the more similar child
         else:
-            left_similarity = self.left_child.similarity(node)
-            right_similarity = self.right_child.similarity(node)
+            left_similarity = self.left_child.similarity(node, bits_to_check)
+            right_similarity = self.right_child.similarity(node, bits_to_check)
             if left_similarity > right_similarity:
-                self.left_child.insert_experiment(node)
+                path = self.left_child.insert_experiment(node, bits_to_check)
             else:
-                self.right_child.insert_experiment(node)
+                path = self.right_child.insert_experiment(node, bits_to_check)
         # Union bloom filter
         self.bloom_filter |= node.bloom_filter
+        update_shape(self)
+        path.append(self)
+        return path
 
-    """ Query a list of kmers from a SBT by checking whether the respective bit is turned on in the bloom filter. If at
-     least (# absolute_threshold) kmers are present, then the query proceeds to the children. If the current node is a 
-     leaf then the node's name is returned. """
-    def query_experiment(self, kmers: list, absolute_threshold):
+    """ Make this Node's filters those of the root of a standalone tree, given its ancestors from the root down (path).
+    Base filters do not depend on their ancestors """
+    def detach(self, path):
+        pass
+
+    """ Recompute the filters of path (the ancestors of node from the root down, already linked to node) after the
+    subtree at node changed. node's filters must be those of a standalone tree (see detach()). Only the nodes on the
+    path are touched, so this costs O(depth * bloom_filter_length). A parent's bloom filter is the union of its
+    children's """
+    @staticmethod
+    def update_path(path, node):
+        for parent in reversed(path):
+            parent.bloom_filter = parent.left_child.bloom_filter | parent.right_child.bloom_filter
+            update_shape(parent)
+
+    """ Check a list of kmers against this Node by checking whether the respective bit is turned on in the bloom
+    filter. If more than |kmers| - absolute_threshold kmers are missing, the subtree is pruned (MISS). Otherwise a leaf
+    is returned (HIT) and an inner node passes the kmers that hit on to its children (PARTIAL). pending is unused since
+    a base filter never resolves kmers for its descendants. The kmers and bits read are reported to trace if given """
+    def kmer_check(self, kmers: list, pending, absolute_threshold, trace=None):
         hits = []
         num_misses = 0
         for kmer in kmers:  # Check if kmer is present
-            if self.query_kmer(kmer):
+            if trace is not None:
+                trace.probe(1, 0)
+            if self.query_kmer(kmer, trace):
                 hits.append(kmer)
             else:
                 num_misses += 1
                 if num_misses > len(kmers) - absolute_threshold:  # Stop since too many misses
-                    return []
+                    return MISS, None, None, absolute_threshold
         # Passed threshold
         if self.left_child is None:  # Return since this node is a leaf/exp
-            return [self.experiment_name]
-        return self.left_child.query_experiment(hits, absolute_threshold) + \
-            self.right_child.query_experiment(hits, absolute_threshold)
+            return HIT, None, None, absolute_threshold
+        return PARTIAL, hits, None, absolute_threshold
 
-    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a list of 
-    filter_indices that the kmers hash to """
-    def fast_query_experiment(self, filter_indices, absolute_threshold):
-        hits = []
-        num_misses = 0
-        for index in filter_indices:  # Check if each index is a hit
-            if self.bloom_filter[index]:  # Hit
-                hits.append(index)
-            else:  # Complete miss - none of descendants have a hit at that index
-                num_misses += 1
-                if num_misses > len(filter_indices) - absolute_threshold:  # Stop since too many misses
-                    return []
-        # Passed threshold
-        if self.left_child is None:  # Return since this node is a leaf
-            return [self.experiment_name]
-        return self.left_child.fast_query_experiment(hits, absolute_threshold) + \
-            self.right_child.fast_query_experiment(hits, absolute_threshold)
+    """ Query a list of kmers from a SBT by checking whether the respective bit is turned on in the bloom filter. If at
+     least (# absolute_threshold) kmers are present, then the query proceeds to the children. If the current node is a 
+     leaf then the node's name is returned. The tree is walked with traversal.iter_matches """
+    def query_experiment(self, kmers: list, absolute_threshold, trace=None):
+        return list(iter_matching_names(self, BaseNode.kmer_check, (kmers, None, absolute_threshold), trace))
+
+    """ Vectorized version of kmer_check() for a matrix of filter_indices that the kmers hash to (one row per kmer, one
+    column per hash function). A kmer is only a hit if all of its bits are set. The bits are checked with
+    kernels.base_check and only the rows of the hits are passed on to the children """
+    def fast_check(self, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+        status, hits, _, _, weights = base_check(self.bloom_filter, filter_indices, absolute_threshold, weights, trace)
+        if status == PARTIAL and self.left_child is None:  # Leaf passed threshold
+            return HIT, None, None, absolute_threshold, None
+        return status, hits, None, absolute_threshold, weights
+
+    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a matrix of 
+    filter_indices that the kmers hash to (one row per kmer, one column per hash function) """
+    def fast_query_experiment(self, filter_indices, absolute_threshold, trace=None):
+        return list(iter_matching_names(self, BaseNode.fast_check, (filter_indices, None, absolute_threshold), trace))
+
+    """ Check a batch of queries at once. filter_indices holds the indices of the kmers of every query (one row per
+    kmer, one column per hash function) and query_ids the query each row belongs to. pending is unused since a base
+    filter never resolves bits for its descendants. The bits of all rows are looked up in one pass over the bloom filter
+    (kernels.base_batch_check), and each query is then pruned or passed on to the children on its own. active marks the
+    queries still searching this subtree and absolute_thresholds holds their thresholds. Returns the queries found at
+    this node (the ones that pass at a leaf) and the state to search the children with (None if no query has to) """
+    def batch_check(self, filter_indices, pending, query_ids, active, absolute_thresholds, weights=None, trace=None):
+        passed, child_state = base_batch_check(self.bloom_filter, filter_indices, query_ids, active,
+                                               absolute_thresholds, weights, trace)
+        if self.left_child is None:  # Leaf - every query that passed is found
+            return passed, None
+        return np.zeros(len(active), dtype=bool), child_state  # Inner nodes only pass queries on
 
     """ Print experiment name and the bits of the bloom filter, then call print on children """
     def print(self):
@@ -122,9 +198,9 @@ class BaseNode(object):
     """ Obtain experiment name (bits=False) or bits (bits=True) of the bloom filter, then add to a graphviz Graph, then 
     iterate on children """
     def graphviz(self, graph, bits):
-        graph.node(self.id, ''.join(map(str, map(int, self.bloom_filter))) if bits else self.experiment_name)
+        graph.node(str(self.id), ''.join(map(str, map(int, self.bloom_filter))) if bits else self.experiment_name)
         if self.left_child is not None:
-            graph.edge(tail_name=self.id, head_name=self.left_child.id)
-            graph.edge(tail_name=self.id, head_name=self.right_child.id)
+            graph.edge(tail_name=str(self.id), head_name=str(self.left_child.id))
+            graph.edge(tail_name=str(self.id), head_name=str(self.right_child.id))
             self.left_child.graphviz(graph, bits)
             self.right_child.graphviz(graph, bits)
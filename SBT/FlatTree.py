@@ -0,0 +1,167 @@
+""" Flat, array-backed layout of an SBT. Instead of one Python object per node, the topology lives in parallel integer
+arrays (left child, right child, parent, leaf flag) and all filters of one kind (e.g. every sim filter of a Split-SBT)
+live in one contiguous packed-bit matrix with one row per node that has that filter (leaves only have their first
+filter). Nodes are numbered in pre-order, so every subtree is a contiguous block of rows. The layout is built from (and
+turned back into) the node objects of an SBT, can be memory-mapped from an index file (see index_file), and is queried
+with the same kernels and traversal as the node objects """
+from SBT.BaseNode import BaseNode
+from SBT.SSBTNode import SSBTNode
+from SBT.HowDeNode import HowDeNode
+from SBT.bits import packed_to_bitarray, packed_bits
+from SBT.kernels import base_check, split_check, howde_check, base_batch_check, split_batch_check, \
+    howde_batch_check, MISS, HIT, PARTIAL
+from SBT.traversal import iter_nodes, index_shapes, iter_matches, match_leaf_ids, batch_match_leaf_ids
+import numpy as np
+
+NODE_CLASSES = {"Base": BaseNode, "SSBT": SSBTNode, "HowDe": HowDeNode}
+
+
+# Left and right child numbers of a list of nodes in pre-order (-1 for leaves)
+def topology(nodes):
+    numbers = {id(node): number for number, node in enumerate(nodes)}
+    left = np.array([numbers[id(node.left_child)] if node.left_child is not None else -1 for node in nodes],
+                    dtype=np.int32)
+    right = np.array([numbers[id(node.right_child)] if node.right_child is not None else -1 for node in nodes],
+                     dtype=np.int32)
+    return left, right
+
+
+# Row of every node in the matrix of one filter kind, numbering the nodes that have the filter in order (-1 otherwise)
+def filter_rows(nodes, filter_name):
+    present = np.array([getattr(node, filter_name) is not None for node in nodes])
+    return np.where(present, np.cumsum(present) - 1, -1).astype(np.int32)
+
+
+class FlatTree(object):
+    def __init__(self, sbt_type, bloom_filter_length, left, right, names, filters, rows):
+        self.sbt_type = sbt_type
+        self.bloom_filter_length = bloom_filter_length
+        self.left = left  # Left child of every node (-1 for leaves)
+        self.right = right  # Right child of every node (-1 for leaves)
+        self.names = names  # Experiment name of every node
+        self.filters = filters  # Filter name (see the node classes' filter_names) -> packed-bit matrix
+        self.rows = rows  # Filter name -> row of every node in the filter's matrix (-1 if the node has no such filter)
+        self.is_leaf = left < 0
+        self.parent = np.full(len(left), -1, dtype=np.int32)
+        self.parent[left[~self.is_leaf]] = np.flatnonzero(~self.is_leaf)
+        self.parent[right[~self.is_leaf]] = np.flatnonzero(~self.is_leaf)
+        # Number the leaves from left to right. Children always come after their parent in pre-order, so walking the
+        # nodes backwards sets the leaf range of both children before their parent's
+        self.leaf_nodes = np.flatnonzero(self.is_leaf).astype(np.int32)  # Node of every leaf id
+        self.leaf_first = np.zeros(len(left), dtype=np.int32)
+        self.leaf_last = np.zeros(len(left), dtype=np.int32)
+        self.leaf_first[self.leaf_nodes] = np.arange(len(self.leaf_nodes))
+        self.leaf_last[self.leaf_nodes] = np.arange(1, len(self.leaf_nodes) + 1)
+        for node in np.flatnonzero(~self.is_leaf)[::-1]:
+            self.leaf_first[node] = self.leaf_first[left[node]]
+            self.leaf_last[node] = self.leaf_last[right[node]]
+        self.leaf_names = [names[node] for node in self.leaf_nodes]
+
+    """ Build the flat layout of the tree under root """
+    @staticmethod
+    def from_root(root):
+        nodes = list(iter_nodes(root))  # Pre-order
+        left, right = topology(nodes)
+        row_bytes = (root.bloom_filter_length + 7) // 8
+        filters = {}
+        rows = {}
+        for filter_name in root.filter_names:
+            rows[filter_name] = filter_rows(nodes, filter_name)
+            matrix = np.zeros((np.count_nonzero(rows[filter_name] >= 0), row_bytes), dtype=np.uint8)
+            for node, row in zip(nodes, rows[filter_name]):
+                if row >= 0:
+                    matrix[row] = packed_bits(getattr(node, filter_name))
+            filters[filter_name] = matrix
+        return FlatTree(root.sbt_type, root.bloom_filter_length, left, right,
+                        [node.experiment_name for node in nodes], filters, rows)
+
+    """ Turn the flat layout back into node objects (e.g. to insert more experiments). Returns the root node """
+    def to_root(self, hash_functions, similarity_function):
+        node_class = NODE_CLASSES[self.sbt_type]
+        nodes = [node_class(self.bloom_filter_length, hash_functions, similarity_function, name) for name in self.names]
+        for number, node in enumerate(nodes):
+            for filter_name in node_class.filter_names:
+                bloom_filter = self.filter_row(filter_name, number)
+                if bloom_filter is not None:
+                    setattr(node, filter_name, packed_to_bitarray(bloom_filter, self.bloom_filter_length))
+            if not self.is_leaf[number]:
+                node.left_child = nodes[self.left[number]]
+                node.right_child = nodes[self.right[number]]
+        index_shapes(nodes[0])
+        return nodes[0]
+
+    """ Height of every node (number of edges on the longest path down to a leaf) """
+    def heights(self):
+        heights = np.zeros(len(self.left), dtype=np.int32)
+        for node in np.flatnonzero(~self.is_leaf)[::-1]:  # Children come after their parent in pre-order
+            heights[node] = 1 + max(heights[self.left[node]], heights[self.right[node]])
+        return heights
+
+    """ Children of a node (used by the traversal functions) """
+    def children(self, node):
+        return self.left[node], self.right[node]
+
+    """ (first, last + 1) leaf id of the subtree of a node (used by the traversal functions) """
+    def leaf_range(self, node):
+        return self.leaf_first[node], self.leaf_last[node]
+
+    """ Packed bits of a node's filter, or None if the node does not have that filter """
+    def filter_row(self, filter_name, node):
+        row = self.rows[filter_name][node]
+        return self.filters[filter_name][row] if row >= 0 else None
+
+    """ Same as the node classes' fast_check() for the node with the given number """
+    def fast_check(self, node, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+        if self.sbt_type == "SSBT":
+            result = split_check(self.filter_row("sim_filter", node), self.filter_row("rem_filter", node),
+                                 filter_indices, pending, absolute_threshold, weights, trace)
+        elif self.sbt_type == "HowDe":
+            result = howde_check(self.filter_row("how_filter", node), self.filter_row("det_filter", node),
+                                 filter_indices, pending, absolute_threshold, weights, trace)
+        else:
+            result = base_check(self.filter_row("bloom_filter", node), filter_indices, absolute_threshold, weights,
+                                trace)
+        if result[0] == PARTIAL and self.is_leaf[node]:  # A base leaf that passed is a hit, other leaves are misses
+            return (HIT if self.sbt_type == "Base" else MISS), None, None, absolute_threshold, None
+        return result
+
+    """ Same as the node classes' batch_check() for the node with the given number """
+    def batch_check(self, node, filter_indices, pending, query_ids, active, absolute_thresholds, weights=None,
+                    trace=None):
+        if self.sbt_type == "SSBT":
+            return split_batch_check(self.filter_row("sim_filter", node), self.filter_row("rem_filter", node),
+                                     filter_indices, pending, query_ids, active, absolute_thresholds, weights, trace)
+        if self.sbt_type == "HowDe":
+            return howde_batch_check(self.filter_row("how_filter", node), self.filter_row("det_filter", node),
+                                     filter_indices, pending, query_ids, active, absolute_thresholds, weights, trace)
+        passed, child_state = base_batch_check(self.filter_row("bloom_filter", node), filter_indices, query_ids,
+                                               active, absolute_thresholds, weights, trace)
+        if self.is_leaf[node]:  # Leaf - every query that passed is found
+            return passed, None
+        return np.zeros(len(active), dtype=bool), child_state
+
+    """ Returns a bitset over the leaf ids of the experiments that match a query's filter indices (weights as in
+    kernels) """
+    def match_leaf_ids(self, filter_indices, absolute_threshold, weights=None, trace=None):
+        return match_leaf_ids(0, self.fast_check, (filter_indices, None, absolute_threshold, weights),
+                              len(self.leaf_nodes), self, trace)
+
+    """ Yield the experiment names that match a query's filter indices as they are found """
+    def iter_matching_names(self, filter_indices, absolute_threshold, weights=None, trace=None):
+        for node in iter_matches(0, self.fast_check, (filter_indices, None, absolute_threshold, weights), self, trace):
+            first, last = self.leaf_range(node)
+            yield from self.leaf_names[first:last]
+
+    """ Returns a (# queries x # leaves) bitset of the experiments that match a batch of queries (see
+    SBT.query_batch) """
+    def batch_match_leaf_ids(self, filter_indices, query_ids, absolute_thresholds, weights=None, trace=None):
+        state = (filter_indices, np.ones(filter_indices.shape, dtype=bool), query_ids,
+                 np.ones(len(absolute_thresholds), dtype=bool), absolute_thresholds, weights)
+        return batch_match_leaf_ids(0, self.batch_check, state, len(absolute_thresholds), len(self.leaf_nodes), self,
+                                    trace)
+
+    """ Number of bytes used by the topology arrays and filter matrices """
+    def nbytes(self):
+        arrays = [self.left, self.right, self.parent, self.is_leaf, self.leaf_nodes, self.leaf_first, self.leaf_last]
+        arrays += list(self.rows.values()) + list(self.filters.values())
+        return sum(array.nbytes for array in arrays)
@@ -1,13 +1,22 @@
 """ Sequence Bloom Tree Node implementation based off of HowDe-SBT in Harris & Medvedev (2019) """
 from bitarray import bitarray
+from SBT.bits import indices_to_bitarray
+from SBT.SparseFilter import compress_filter, decompress_filter, DEFAULT_MAX_DENSITY
+from SBT.kernels import howde_check, howde_batch_check, MISS, HIT, PARTIAL
+from SBT.traversal import update_shape, restore_node, iter_matching_names, iter_leaves
 
 
 class HowDeNode(object):
+    __slots__ = ("bloom_filter_length", "hash_functions", "similarity_function", "experiment_name", "how_filter",
+                 "det_filter", "union_filter", "left_child", "right_child", "leaf_range", "height",
+                 "num_leaves", "id")
     count = 0  # How many Nodes have been created
+    sbt_type = "HowDe"
+    filter_names = ("how_filter", "det_filter", "union_filter")  # Filters kept in the matrices of a FlatTree
 
     def __init__(self, bloom_filter_length, hash_functions, similarity_function, experiment_name, how_filter=None):
         self.bloom_filter_length = bloom_filter_length
-        self.hash_function = hash_functions[0]  # Only need 1 hash function
+        self.hash_functions = hash_functions
         self.similarity_function = similarity_function
         self.experiment_name = experiment_name
         # Initialize Bloom Filters to all 0s
@@ -16,8 +25,11 @@ class HowDeNode(object):
         self.union_filter = None  # None if node is a leaf
         self.left_child = None
         self.right_child = None
+        self.leaf_range = None  # (first, last + 1) leaf id of the subtree, set by traversal.index_leaves()
+        self.height = 0  # Number of edges on the longest path down to a leaf (see traversal.update_shape())
+        self.num_leaves = 1  # Number of leaves in the subtree
         # Give node an id
-        self.id = str(HowDeNode.count)
+        self.id = HowDeNode.count
         HowDeNode.count += 1
 
     """ Creates a new parent Node whose children are left_child and right_child. The Node's filter(s) are set so that
@@ -25,7 +37,7 @@ class HowDeNode(object):
     @staticmethod
     def from_children(left_child, right_child):
         # Create new node
-        node = HowDeNode(left_child.bloom_filter_length, [left_child.hash_function], left_child.similarity_function,
+        node = HowDeNode(left_child.bloom_filter_length, left_child.hash_functions, left_child.similarity_function,
                          left_child.experiment_name)
         node.experiment_name = "I" + str(node.id)  # Label inner nodes
         # Set new node's filters
@@ -42,19 +54,43 @@ class HowDeNode(object):
         # Set new node's children
         node.left_child = left_child
         node.right_child = right_child
+        update_shape(node)
         return node
 
     """ Insert a kmer into the Node's how filter """
     def insert_kmer(self, kmer):
-        self.how_filter[self.hash_function(kmer) % self.bloom_filter_length] = True
+        for hash_function in self.hash_functions:
+            self.how_filter[hash_function(kmer) % self.bloom_filter_length] = True
 
-    """ Query a kmer from the Node's determined filter """
-    def query_kmer_det(self, kmer):
-        return self.det_filter[self.hash_function(kmer) % self.bloom_filter_length]
+    """ Insert the precomputed filter indices of many kmers (one column per hash function) into the Node's how
+    filter """
+    def insert_filter_indices(self, filter_indices):
+        self.how_filter |= indices_to_bitarray(filter_indices, self.bloom_filter_length)
 
-    """ Query a kmer from the Node's how filter """
-    def query_kmer_how(self, kmer):
-        return self.how_filter[self.hash_function(kmer) % self.bloom_filter_length]
+    """ Replace every filter of this Node that has at most max_density of its bits set with a SparseFilter, which is
+    queried without decompressing it """
+    def compress(self, max_density=DEFAULT_MAX_DENSITY):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, compress_filter(getattr(self, filter_name), max_density))
+
+    """ Turn the Node's SparseFilters back into bitarrays (needed before inserting into the Node) """
+    def decompress(self):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, decompress_filter(getattr(self, filter_name)))
+
+    """ Query the bit of a kmer given by hash function number hash_index from the Node's determined filter. The read is
+    reported to trace if given """
+    def query_kmer_det(self, kmer, hash_index=0, trace=None):
+        if trace is not None:
+            trace.probe(0, 1)
+        return self.det_filter[self.hash_functions[hash_index](kmer) % self.bloom_filter_length]
+
+    """ Query the bit of a kmer given by hash function number hash_index from the Node's how filter. The read is
+    reported to trace if given """
+    def query_kmer_how(self, kmer, hash_index=0, trace=None):
+        if trace is not None:
+            trace.probe(0, 1)
+        return self.how_filter[self.hash_functions[hash_index](kmer) % self.bloom_filter_length]
 
     """ Return similarity between the first (# bits_to_check) bits of this Node's how filter and the first 
     (# bits_to_check) of another node's how filter """
@@ -63,19 +99,28 @@ class HowDeNode(object):
             return self.similarity_function(self.how_filter, node.how_filter)
         return self.similarity_function(self.how_filter[:bits_to_check], node.how_filter[:bits_to_check])
 
+    """ Restore an unpickled Node, including Nodes pickled before the node classes had slots (see
+    traversal.restore_node()) """
+    def __setstate__(self, state):
+        restore_node(self, state)
+
     """ Deep copy fields of node (except for left and right children) """
     def copy(self):
-        return HowDeNode(self.bloom_filter_length, [self.hash_function], self.similarity_function, self.experiment_name,
+        return HowDeNode(self.bloom_filter_length, self.hash_functions, self.similarity_function, self.experiment_name,
                          self.how_filter.copy())
 
     """ Insert a single node to an existing SBT greedily by traversing down the most similar child starting from the 
-        root """
-    def insert_experiment(self, node):
+    root. If bits_to_check is set, children are compared with the node on only their first (# bits_to_check) bits, a
+    fixed-size sample of the filters (hashed kmers are spread uniformly over the filter), so routing costs O(depth)
+    regardless of bloom_filter_length and only the filter updates touch the full filters. Returns the Nodes on the way
+    from the new leaf's parent up to this Node """
+    def insert_experiment(self, node, bits_to_check=None):
         # 0 children - copy current node into left child and insert into right child
         if self.left_child is None:
             self.left_child = self.copy()
             self.experiment_name = "I" + str(self.id)  # Label inner nodes
             self.right_child = node
+            path = []
             self.union_filter = self.left_child.how_filter | self.right_child.how_filter
             self.how_filter &= self.right_child.how_filter
             self.det_filter = self.how_filter | ~self.union_filter
@@ -86,87 +131,112 @@ class HowDeNode(object):
             self.how_filter &= node.how_filter
             self.det_filter = self.how_filter | ~self.union_filter
             # Iterate into more similar child
-            left_similarity = self.left_child.similarity(node)
-            right_similarity = self.right_child.similarity(node)
+            left_similarity = self.left_child.similarity(node, bits_to_check)
+            right_similarity = self.right_child.similarity(node, bits_to_check)
             if left_similarity > right_similarity:
-                self.left_child.insert_experiment(node)
+                path = self.left_child.insert_experiment(node, bits_to_check)
             else:
-                self.right_child.insert_experiment(node)
+                path = self.right_child.insert_experiment(node, bits_to_check)
+        update_shape(self)
+        path.append(self)
+        return path
 
-    """ Query a list of kmers from a SBT by checking whether the respective bit is turned on in the bloom filter. If at
-     least (# absolute_threshold) kmers are present, then the query returns all children nodes. If at least |kmers| - 
-      absolute_threshold kmers are not present, then the subtree at this node is pruned from search. Lastly, if neither
-      of those two conditions are met, then the query proceeds to the children. """
-    def query_experiment(self, kmers: list, absolute_threshold):
+    """ Make this Node's filters those of the root of a standalone tree, given its ancestors from the root down (path).
+    HowDe filters do not depend on their ancestors """
+    def detach(self, path):
+        pass
+
+    """ Recompute the filters of path (the ancestors of node from the root down, already linked to node) after the
+    subtree at node changed. node's filters must be those of a standalone tree (see detach()). A parent's how filter is
+    the intersection and its union filter the union of its children's, and its determined filter is rebuilt from them.
+    Only the nodes on the path are touched, so this costs O(depth * bloom_filter_length) """
+    @staticmethod
+    def update_path(path, node):
+        for parent in reversed(path):
+            left_child, right_child = parent.left_child, parent.right_child
+            left_union, right_union = (child.how_filter if child.union_filter is None else child.union_filter
+                                       for child in (left_child, right_child))  # Leaves have no union filter
+            parent.union_filter = left_union | right_union
+            parent.how_filter = left_child.how_filter & right_child.how_filter
+            parent.det_filter = parent.how_filter | ~parent.union_filter
+            update_shape(parent)
+
+    """ Check a list of kmers against this Node by checking whether the respective bit is turned on in the bloom
+    filter. If at least (# absolute_threshold) kmers are present, then all descendants are returned (HIT). If more than
+    |kmers| - absolute_threshold kmers are not present, then the subtree at this node is pruned from search (MISS).
+    Lastly, if neither of those two conditions are met, then the partial hits are passed on to the children with the
+    remaining threshold (PARTIAL). With several hash functions, pending holds the hash functions of each kmer whose bits
+    are not determined yet (None means all of them). The kmers and bits read are reported to trace if given """
+    def kmer_check(self, kmers: list, pending, absolute_threshold, trace=None):
+        if pending is None:
+            pending = [range(len(self.hash_functions))] * len(kmers)
         partial_hits = []
+        partial_pending = []
         complete_hits = 0
         complete_misses = 0
-        # If the node is a leaf then only check how filter
-        if self.det_filter is None:
-            for kmer in kmers:  # Check if each kmer is present
-                if self.query_kmer_how(kmer):  # Complete Hit
-                    complete_hits += 1
-                    if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                        return self.iter_children()
-                else:  # Complete Miss
-                    complete_misses += 1
-                    if complete_misses > len(kmers) - absolute_threshold:  # Stop since too many misses
-                        return []
-        # If the node is an inner node, then first check det before checking how
-        for kmer in kmers:  # Check if each kmer is present, partially present, or absent
-            if self.query_kmer_det(kmer):  # Complete hit or complete miss - all descendants have or have not
-                if self.query_kmer_how(kmer):  # Complete Hit
-                    complete_hits += 1
-                    if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                        return self.iter_children()
-                else:  # Complete Miss
-                    complete_misses += self.query_kmer_how(kmer)
-                    if complete_misses > len(kmers) - absolute_threshold:  # Stop since too many misses
-                        return []
+        for kmer, hash_indices in zip(kmers, pending):  # Check if each kmer is present, partially present, or absent
+            if trace is not None:
+                trace.probe(1, 0)
+            unresolved = []
+            missed = False
+            for hash_index in hash_indices:
+                # Leaves only have a how filter, so every bit of a leaf is determined
+                if self.det_filter is not None and not self.query_kmer_det(kmer, hash_index, trace):
+                    unresolved.append(hash_index)  # Some descendants have the bit, some don't
+                elif not self.query_kmer_how(kmer, hash_index, trace):  # No descendant has the bit
+                    missed = True
+                    break
+            if missed:  # Complete Miss
+                complete_misses += 1
+                if complete_misses > len(kmers) - absolute_threshold:  # Stop since too many misses
+                    return MISS, None, None, absolute_threshold
+            elif not unresolved:  # Complete Hit
+                complete_hits += 1
+                if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
+                    return HIT, None, None, absolute_threshold
             else:  # Partial hit: some descendants have, some don't
                 partial_hits.append(kmer)
+                partial_pending.append(unresolved)
+        if complete_hits >= absolute_threshold:
+            return HIT, None, None, absolute_threshold
+        if self.left_child is None:  # Leaves have no partial hits
+            return MISS, None, None, absolute_threshold
         # Search children since not enough hits but not enough misses only on kmer partial hits
-        return self.left_child.query_experiment(partial_hits, absolute_threshold - complete_hits) + \
-            self.right_child.query_experiment(partial_hits, absolute_threshold - complete_hits)
+        return PARTIAL, partial_hits, partial_pending, absolute_threshold - complete_hits
 
-    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a list of 
-    filter_indices that the kmers hash to """
-    def fast_query_experiment(self, filter_indices, absolute_threshold):
-        partial_hits = []
-        complete_hits = 0
-        complete_misses = 0
-        # If the node is a leaf then only check how filter
-        if self.det_filter is None:
-            for index in filter_indices:  # Check if each index is a hit
-                if self.how_filter[index]:  # Complete Hit
-                    complete_hits += 1
-                    if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                        return self.iter_children()
-                else:  # Complete Miss
-                    complete_misses += 1
-                    if complete_misses > len(filter_indices) - absolute_threshold:  # Stop since too many misses
-                        return []
-        for index in filter_indices:  # Check if each index is a hit
-            if self.det_filter[index]:  # Complete hit or complete miss - all descendants have or don't have
-                if self.how_filter[index]:  # Complete Hit
-                    complete_hits += 1
-                    if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                        return self.iter_children()
-                else:  # Complete Miss
-                    complete_misses += 1
-                    if complete_misses > len(filter_indices) - absolute_threshold:  # Stop since too many misses
-                        return []
-            else:  # Partial hit - some descendants have, some don't
-                partial_hits.append(index)
-        # Search children since not enough hits but not enough misses only on kmer partial hits
-        return self.left_child.fast_query_experiment(partial_hits, absolute_threshold - complete_hits) + \
-            self.right_child.fast_query_experiment(partial_hits, absolute_threshold - complete_hits)
+    """ Query a list of kmers from a SBT. The tree is walked with traversal.iter_matches using kmer_check() """
+    def query_experiment(self, kmers: list, absolute_threshold, pending=None, trace=None):
+        return list(iter_matching_names(self, HowDeNode.kmer_check, (kmers, pending, absolute_threshold), trace))
+
+    """ Vectorized version of kmer_check() for a matrix of filter_indices that the kmers hash to (one row per kmer, one
+    column per hash function). pending marks the indices whose bits are not determined yet (None means all of them).
+    The bits are checked with kernels.howde_check and only the partial hits are passed on to the children """
+    def fast_check(self, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+        status, partial_hits, pending, absolute_threshold, weights = howde_check(
+            self.how_filter, self.det_filter, filter_indices, pending, absolute_threshold, weights, trace)
+        if status == PARTIAL and self.left_child is None:  # Leaves have no partial hits
+            return MISS, None, None, absolute_threshold, None
+        return status, partial_hits, pending, absolute_threshold, weights
+
+    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a matrix of 
+    filter_indices that the kmers hash to (one row per kmer, one column per hash function) """
+    def fast_query_experiment(self, filter_indices, absolute_threshold, pending=None, trace=None):
+        return list(iter_matching_names(self, HowDeNode.fast_check, (filter_indices, pending, absolute_threshold),
+                                        trace))
+
+    """ Check a batch of queries at once. filter_indices holds the indices of the kmers of every query (one row per
+    kmer, one column per hash function), pending marks the indices whose bits are not determined yet, and query_ids the
+    query each row belongs to. The bits of all rows are looked up in one pass over each filter
+    (kernels.howde_batch_check), and each query is then completed, pruned or passed on to the children on its own.
+    active marks the queries still searching this subtree and absolute_thresholds holds their thresholds. Returns the
+    queries whose every descendant matches and the state to search the children with (None if no query has to) """
+    def batch_check(self, filter_indices, pending, query_ids, active, absolute_thresholds, weights=None, trace=None):
+        return howde_batch_check(self.how_filter, self.det_filter, filter_indices, pending, query_ids, active,
+                                 absolute_thresholds, weights, trace)
 
     """ Returns a list of the names of all descendant nodes """
     def iter_children(self):
-        if self.left_child is not None:
-            return self.left_child.iter_children() + self.right_child.iter_children()
-        return [self.experiment_name]
+        return [leaf.experiment_name for leaf in iter_leaves(self)]
 
     """ Print experiment name and the bits of the bloom filter, then call print on children """
     def print(self):
@@ -181,7 +251,7 @@ class HowDeNode(object):
     """ Obtain experiment name (bits=False) or bits (bits=True) of the bloom filter, then add to a graphviz Graph, then 
     iterate on children """
     def graphviz(self, graph, bits):
-        graph.node(self.id,
+        graph.node(str(self.id),
                    'how: ' + ''.join(map(str, map(int, self.how_filter))) +
                    ('\ndet: ' + ''.join(map(str, map(int, self.det_filter)))
                     if self.det_filter is not None else '') +
@@ -189,7 +259,7 @@ class HowDeNode(object):
                     if self.union_filter is not None else '')
                    if bits else self.experiment_name)
         if self.left_child is not None:
-            graph.edge(tail_name=self.id, head_name=self.left_child.id)
-            graph.edge(tail_name=self.id, head_name=self.right_child.id)
+            graph.edge(tail_name=str(self.id), head_name=str(self.left_child.id))
+            graph.edge(tail_name=str(self.id), head_name=str(self.right_child.id))
             self.left_child.graphviz(graph, bits)
             self.right_child.graphviz(graph, bits)
@@ -0,0 +1,113 @@
+""" Deterministic, seeded k-mer hashing. A sequence is 2-bit encoded once and the hashes of all of its k-mers are
+computed together as one NumPy array, instead of slicing every k-mer into a new string and hashing it in Python. Unlike
+Python's salted hash(), the hashes only depend on the seed, so an SBT that is pickled and reloaded in another process
+keeps answering queries correctly """
+from SBT.sequence_reader import RECORD_SEPARATOR
+import numpy as np
+
+# 2-bit code of each nucleotide (lowercase is accepted, any other character such as N is encoded as A). The separator
+# between the records of a sequence gets its own code, and kmers containing it are left out
+SEPARATOR_CODE = 4
+ENCODING = np.zeros(256, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    ENCODING[ord(_base)] = _code
+    ENCODING[ord(_base.lower())] = _code
+ENCODING[ord(RECORD_SEPARATOR)] = SEPARATOR_CODE
+
+CODES = {base: code for code, base in enumerate("ACGT")}
+CODES.update({base.lower(): code for base, code in list(CODES.items())})
+BLOCK = 32  # Number of bases packed into one uint64 word
+MASK = (1 << 64) - 1
+
+
+# splitmix64 finalizer. Scrambles an array of uint64 words (wrapping arithmetic)
+def mix64(x):
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+# Same as mix64() but for a single Python int, which avoids NumPy's per-call overhead when hashing one kmer
+def mix64_int(x):
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK
+    return x ^ (x >> 31)
+
+
+class KmerHasher(object):
+    def __init__(self, seed=0):
+        self.seed = seed
+        with np.errstate(over='ignore'):
+            self.key = mix64(np.array([seed], dtype=np.uint64) + np.uint64(0x9e3779b97f4a7c15))[0]
+
+    """ 2-bit encode a sequence into an array of uint8 codes """
+    @staticmethod
+    def encode(sequence):
+        if isinstance(sequence, str):
+            sequence = sequence.encode("ascii", "replace")
+        return ENCODING[np.frombuffer(sequence, dtype=np.uint8)]
+
+    """ Pack the 32 bases starting at every position of the sequence into one uint64 word each (the first base sits in
+    the highest bits). The sequence is padded with A's so that every position has a full word """
+    @staticmethod
+    def pack(codes):
+        padded = np.concatenate((codes, np.zeros(BLOCK - 1, dtype=np.uint8))).astype(np.uint64)
+        words = np.zeros(len(codes), dtype=np.uint64)
+        for offset in range(BLOCK):
+            words <<= np.uint64(2)
+            words |= padded[offset:offset + len(codes)]
+        return words
+
+    """ Mask of the k-mer positions of an array of codes that lie within one record (None if the codes have no record
+    separator, so that every position does) """
+    @staticmethod
+    def within_records(codes, k):
+        separators = codes == SEPARATOR_CODE
+        if not separators.any():
+            return None
+        counts = np.concatenate(([0], np.cumsum(separators)))  # Separators before every position
+        return counts[k:] == counts[:-k]
+
+    """ Hash every k-mer of a sequence (or of an array of 2-bit codes). Returns a uint64 array with one hash per k-mer
+    position, leaving out the k-mers that span two records. k-mers longer than 32 bases are hashed block by block,
+    chaining each 32 base block into the hash """
+    def kmer_hashes(self, sequence, k):
+        codes = sequence if isinstance(sequence, np.ndarray) else self.encode(sequence)
+        num_kmers = len(codes) - k + 1
+        if num_kmers <= 0:
+            return np.zeros(0, dtype=np.uint64)
+        within = self.within_records(codes, k)
+        if within is not None:
+            codes = np.where(codes == SEPARATOR_CODE, 0, codes).astype(np.uint8)  # No kept k-mer contains them
+        words = self.pack(codes)
+        num_blocks = (k + BLOCK - 1) // BLOCK
+        last_block = k - BLOCK * (num_blocks - 1)  # Number of bases in the final (possibly partial) block
+        with np.errstate(over='ignore'):
+            hashes = np.full(num_kmers, self.key, dtype=np.uint64)
+            for block in range(num_blocks):
+                word = words[BLOCK * block:BLOCK * block + num_kmers]
+                if block == num_blocks - 1 and last_block < BLOCK:
+                    word = word >> np.uint64(2 * (BLOCK - last_block))
+                hashes = mix64(hashes ^ word)
+        return hashes if within is None else hashes[within]
+
+    """ Hash a single k-mer. Consistent with kmer_hashes() so that it can be used in place of hash() """
+    def __call__(self, kmer):
+        hash_value = int(self.key)
+        for block in range(0, len(kmer), BLOCK):
+            word = 0
+            for base in kmer[block:block + BLOCK]:
+                word = (word << 2) | CODES.get(base, 0)
+            hash_value = mix64_int(hash_value ^ word)
+        return hash_value
+
+    def __eq__(self, other):
+        return isinstance(other, KmerHasher) and self.seed == other.seed
+
+    def __hash__(self):
+        return hash(("KmerHasher", self.seed))
+
+    def __repr__(self):
+        return "KmerHasher(seed=" + str(self.seed) + ")"
@@ -0,0 +1,88 @@
+""" Exact kmer index used as the ground truth of queries. Every experiment's distinct kmers are kept as one sorted
+uint64 array (the 2-bit code of the kmer itself for k <= 32, so membership is exact, and a 64-bit KmerHasher hash for
+longer kmers). An experiment truly contains a query if at least threshold * (# kmers) of the query's kmers (counted with
+repeats, like the SBT's absolute threshold) are among its kmers, which is the containment the SBT approximates. Queries
+are answered with one vectorized searchsorted per experiment over the distinct kmers of a whole batch of queries, so
+verifying a benchmark's queries costs far less than searching every genome for every query string """
+from SBT.KmerHasher import KmerHasher, BLOCK, SEPARATOR_CODE
+import numpy as np
+
+
+class KmerIndex(object):
+    def __init__(self, k):
+        self.k = k
+        self.hasher = KmerHasher(0)  # Only used for kmers longer than BLOCK bases
+        self.experiment_names = []
+        self.kmers = []  # Sorted distinct kmer keys of every experiment
+
+    """ uint64 key of every kmer position of a sequence (leaving out the kmers that span two records, like
+    KmerHasher.kmer_hashes()): the kmer's 2-bit code if it fits in one word and its hash otherwise """
+    def kmer_keys(self, sequence):
+        codes = KmerHasher.encode(sequence)
+        num_kmers = len(codes) - self.k + 1
+        if num_kmers <= 0:
+            return np.zeros(0, dtype=np.uint64)
+        if self.k > BLOCK:
+            return self.hasher.kmer_hashes(codes, self.k)
+        within = KmerHasher.within_records(codes, self.k)
+        if within is not None:
+            codes = np.where(codes == SEPARATOR_CODE, 0, codes).astype(np.uint8)
+        keys = KmerHasher.pack(codes)[:num_kmers] >> np.uint64(2 * (BLOCK - self.k))
+        return keys if within is None else keys[within]
+
+    """ Sorted distinct kmer keys of a sequence, as the index keeps them for an experiment """
+    def experiment_kmers(self, sequence):
+        return np.unique(self.kmer_keys(sequence))
+
+    """ Add an experiment whose sorted distinct kmer keys are known (e.g. a memory-mapped array of experiment_kmers())
+    to the index """
+    def add_kmers(self, kmers, experiment_name):
+        self.experiment_names.append(experiment_name)
+        self.kmers.append(kmers)
+
+    """ Add the kmers of an experiment's sequence to the index """
+    def add_experiment(self, sequence, experiment_name):
+        self.add_kmers(self.experiment_kmers(sequence), experiment_name)
+
+    """ Build an index over sequences with the given experiment names """
+    @staticmethod
+    def from_sequences(sequences, experiment_names, k):
+        index = KmerIndex(k)
+        for sequence, experiment_name in zip(sequences, experiment_names):
+            index.add_experiment(sequence, experiment_name)
+        return index
+
+    """ (# queries x # experiments) array of the number of kmers of every query (counted with repeats) that are in
+    every experiment """
+    def hit_counts(self, sequences):
+        return self.key_hit_counts([self.kmer_keys(sequence) for sequence in sequences])
+
+    """ hit_counts() of the kmer keys of every query """
+    def key_hit_counts(self, keys):
+        query_ids = np.repeat(np.arange(len(keys)), [len(query_keys) for query_keys in keys])
+        # Probe every distinct kmer of the batch once
+        distinct, inverse = np.unique(np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64),
+                                      return_inverse=True)
+        counts = np.zeros((len(keys), len(self.kmers)), dtype=np.int64)
+        for experiment_id, kmers in enumerate(self.kmers):
+            positions = np.minimum(np.searchsorted(kmers, distinct), max(len(kmers) - 1, 0))
+            present = kmers[positions] == distinct if len(kmers) else np.zeros(len(distinct), dtype=bool)
+            counts[:, experiment_id] = np.bincount(query_ids[present[inverse]], minlength=len(keys))
+        return counts
+
+    """ Names of the experiments that contain at least threshold * (# kmers) of the kmers of each query. Returns a list
+    with the names of every query """
+    def query_batch(self, sequences, threshold):
+        keys = [self.kmer_keys(sequence) for sequence in sequences]
+        counts = self.key_hit_counts(keys)
+        thresholds = threshold * np.array([len(query_keys) for query_keys in keys])
+        return [[self.experiment_names[experiment_id] for experiment_id in np.flatnonzero(query_counts >= minimum)]
+                for query_counts, minimum in zip(counts, thresholds)]
+
+    """ Names of the experiments that contain at least threshold * (# kmers) of the kmers of a query """
+    def query_sequence(self, sequence, threshold):
+        return self.query_batch([sequence], threshold)[0]
+
+    """ Number of bytes used by the kmer arrays """
+    def nbytes(self):
+        return sum(kmers.nbytes for kmers in self.kmers)
@@ -0,0 +1,67 @@
+""" LRU cache of query results. Repeated queries (reads and amplicons that occur many times) are answered without
+hashing their kmers into a traversal again. A query is identified by a digest of its filter indices in canonical
+(sorted) order and the threshold, so two sequences with the same kmers share an entry. The cache holds bitsets of leaf
+ids, which are only valid for the tree they were computed on: SBT.tree_changed() clears it after every mutation """
+from collections import OrderedDict
+import numpy as np
+import hashlib
+
+DEFAULT_CACHE_BYTES = 1 << 26  # Bytes of cached results kept by default
+ENTRY_OVERHEAD = 128  # Approximate bytes used by the key and dictionary entry of every cached result
+
+
+class QueryCache(object):
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Digest -> bitset of leaf ids, least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    """ Digest of a (# kmers x # hash functions) matrix of filter indices and a threshold. The rows are sorted first,
+    so the digest does not depend on the order of the kmers """
+    @staticmethod
+    def key(filter_indices, threshold):
+        filter_indices = np.asarray(filter_indices, dtype=np.int64)
+        if filter_indices.ndim == 2 and len(filter_indices) > 1:
+            filter_indices = filter_indices[np.lexsort(filter_indices.T[::-1])]
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.array(filter_indices.shape, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(filter_indices).tobytes())
+        digest.update(repr(float(threshold)).encode("ascii"))
+        return digest.digest()
+
+    """ Returns a copy of the bitset of leaf ids cached under key, or None (counting a hit or a miss) """
+    def get(self, key):
+        leaf_ids = self.entries.get(key)
+        if leaf_ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return leaf_ids.copy()
+
+    """ Cache a bitset of leaf ids under key, evicting the least recently used results to stay within max_bytes """
+    def put(self, key, leaf_ids):
+        size = leaf_ids.nbytes + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes + ENTRY_OVERHEAD
+        self.entries[key] = leaf_ids.copy()
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes + ENTRY_OVERHEAD
+
+    """ Drop every cached result (the hit and miss counters are kept) """
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    """ Fraction of lookups that were hits """
+    def hit_rate(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+
+    def __len__(self):
+        return len(self.entries)
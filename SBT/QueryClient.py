@@ -0,0 +1,66 @@
+""" Blocking client for QueryServer. Queries sent with query_many() are all written before any answer is read, so the
+server can put them in the same micro-batches """
+import socket
+import json
+
+
+class QueryClient(object):
+    def __init__(self, host="127.0.0.1", port=8765, path=None, timeout=None):
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.socket.makefile("rwb")
+        self.next_id = 0
+
+    """ Send one message and return its id """
+    def send(self, message):
+        message = dict(message, id=self.next_id)
+        self.next_id += 1
+        self.file.write(json.dumps(message).encode("utf-8") + b"\n")
+        return message["id"]
+
+    """ Read answers until the answers of every id in message_ids have arrived. Returns them by id """
+    def receive(self, message_ids):
+        waiting = set(message_ids)
+        answers = {}
+        while waiting:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("The query server closed the connection")
+            answer = json.loads(line)
+            answers[answer["id"]] = answer
+            waiting.discard(answer["id"])
+        return answers
+
+    """ Returns the names of the experiments matching every sequence, in order """
+    def query_many(self, sequences):
+        message_ids = [self.send({"sequence": sequence}) for sequence in sequences]
+        self.file.flush()
+        answers = self.receive(message_ids)
+        for message_id in message_ids:
+            if "error" in answers[message_id]:
+                raise ValueError("Query failed on the server: " + answers[message_id]["error"])
+        return [answers[message_id]["matches"] for message_id in message_ids]
+
+    """ Returns the names of the experiments matching a sequence """
+    def query(self, sequence):
+        return self.query_many([sequence])[0]
+
+    """ Returns the server's latency percentiles, throughput and counters (see QueryServer.stats()) """
+    def stats(self):
+        message_id = self.send({"command": "stats"})
+        self.file.flush()
+        return self.receive([message_id])[message_id]["stats"]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,134 @@
+""" Long-lived query server. An SBT is loaded once and kept resident while any number of clients send queries over a
+localhost TCP port or a Unix socket. Messages are lines of JSON:
+
+    {"id": 1, "sequence": "ACGT..."}    ->  {"id": 1, "matches": ["experiment", ...]}
+    {"id": 2, "command": "stats"}       ->  {"id": 2, "stats": {...}}
+
+Queries arriving within batch_window seconds of each other (up to max_batch of them) are collected into a micro-batch
+and answered with one SBT.query_batch() pass in a worker thread, so the event loop keeps accepting queries while a
+batch is walking the tree. The tree is only touched by that one thread. See QueryClient for a client """
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+import asyncio
+import json
+import time
+
+DEFAULT_BATCH_WINDOW = 0.002  # Seconds to wait for more queries after the first query of a batch
+DEFAULT_MAX_BATCH = 256  # Maximum number of queries in a batch
+LATENCY_SAMPLES = 10000  # Number of most recent query latencies kept for the percentiles
+
+
+class QueryServer(object):
+    def __init__(self, sbt, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.sbt = sbt
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = None  # asyncio.Queue of (sequence, future, arrival time), created in the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Runs the tree passes
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.num_queries = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.start_time = time.perf_counter()
+
+    """ Serve until cancelled, on a Unix socket if path is given and on host:port otherwise """
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        self.queue = asyncio.Queue()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port)
+        batcher = asyncio.ensure_future(self.run_batches())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+    """ Answer the messages of one client. Every query is answered as soon as its batch is done, so a client can have
+    many queries in flight and the answers may come back out of order """
+    async def handle_client(self, reader, writer):
+        lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.answer(line, writer, lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            writer.close()
+
+    """ Answer one message """
+    async def answer(self, line, writer, lock):
+        message_id = None
+        try:
+            message = json.loads(line)
+            message_id = message.get("id")
+            if message.get("command") == "stats":
+                response = {"id": message_id, "stats": self.stats()}
+            else:
+                if not isinstance(message.get("sequence"), str):
+                    raise ValueError("A query needs a sequence string")
+                response = {"id": message_id, "matches": await self.query(message["sequence"])}
+        except Exception as error:  # Report bad messages and failed queries to the client instead of dropping it
+            self.num_errors += 1
+            response = {"id": message_id, "error": repr(error)}
+        async with lock:
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+
+    """ Queue a query for the next batch and wait for its matches """
+    async def query(self, sequence):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sequence, future, time.perf_counter()))
+        return await future
+
+    """ Collect queued queries into batches and run each batch in the worker thread """
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_window > 0 and self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.batch_window)  # Let more queries arrive
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            sequences = [sequence for sequence, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.sbt.query_batch, sequences)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            done = time.perf_counter()
+            for (_, future, arrival), matches in zip(batch, results):
+                self.latencies.append(done - arrival)
+                if not future.done():
+                    future.set_result(matches)
+            self.num_queries += len(batch)
+            self.num_batches += 1
+
+    """ Latency percentiles (seconds, over the most recent queries), throughput and counters """
+    def stats(self):
+        latencies = np.array(self.latencies)
+        query_cache = self.sbt.query_cache
+        uptime = time.perf_counter() - self.start_time
+        return {
+            "queries": self.num_queries,
+            "batches": self.num_batches,
+            "errors": self.num_errors,
+            "mean_batch_size": self.num_queries / self.num_batches if self.num_batches else 0,
+            "p50_latency": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_latency": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "queries_per_second": self.num_queries / uptime if uptime > 0 else 0,
+            "uptime": uptime,
+            "cache_hits": query_cache.hits if query_cache is not None else None,
+            "cache_misses": query_cache.misses if query_cache is not None else None,
+        }
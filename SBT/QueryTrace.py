@@ -0,0 +1,94 @@
+""" Opt-in query tracing (SBT.enable_tracing()). The traversal reports every node check to the trace, which keeps plain
+per-depth integer counters: nodes checked, kmer rows and filter bits probed, subtrees pruned (MISS), subtrees whose
+every leaf matched above the leaves (complete hits, which only Split-SBT and HowDe-SBT nodes can short-circuit on) and
+matching leaves. The rows and bits probed are the ones the checks actually read (see probe()): a check that stops early
+once its threshold is decided only counts the rows it got to, and a Split-SBT or HowDe-SBT inner node reads two
+filters. The SBT also adds the time spent in every phase of a query (hashing the kmers, planning the probes,
+walking the tree and turning leaf ids into names). When tracing is disabled the traversal only checks that the trace
+is None. Batched queries count one check per query and node, so their counters add up like those of single queries """
+from SBT.kernels import MISS, HIT
+import time
+import json
+
+LEVEL_COUNTERS = ("checks", "rows_probed", "bits_probed", "misses", "complete_hits", "leaf_hits")
+
+
+class QueryTrace(object):
+    def __init__(self):
+        self.reset()
+
+    """ Drop everything recorded so far """
+    def reset(self):
+        self.queries = 0
+        self.levels = {counter: [] for counter in LEVEL_COUNTERS}  # Counter -> value at every depth
+        self.phase_times = {}  # Phase -> seconds
+        self.rows_read = 0  # Rows and bits read by the node check in progress
+        self.bits_read = 0
+
+    """ Add a level of counters for depth if the tree is deeper than any level seen so far """
+    def grow(self, depth):
+        while len(self.levels["checks"]) <= depth:
+            for counters in self.levels.values():
+                counters.append(0)
+
+    """ Called by a node check for every num_rows kmer rows and num_bits filter bits it reads """
+    def probe(self, num_rows, num_bits):
+        self.rows_read += num_rows
+        self.bits_read += num_bits
+
+    """ Add the rows and bits probed by the node check that just finished to depth """
+    def add_probes(self, depth):
+        self.levels["rows_probed"][depth] += self.rows_read
+        self.levels["bits_probed"][depth] += self.bits_read
+        self.rows_read = 0
+        self.bits_read = 0
+
+    """ Record the check of one node at depth, which returned status for a query """
+    def check(self, depth, status, is_leaf):
+        self.grow(depth)
+        self.add_probes(depth)
+        levels = self.levels
+        levels["checks"][depth] += 1
+        if status == MISS:
+            levels["misses"][depth] += 1
+        elif status == HIT:
+            levels["leaf_hits" if is_leaf else "complete_hits"][depth] += 1
+
+    """ Record the batched check of one node at depth for num_active queries, of which num_found matched completely and
+    num_searching go on to the children (the others were pruned) """
+    def batch_check(self, depth, num_active, num_found, num_searching, is_leaf):
+        self.grow(depth)
+        self.add_probes(depth)
+        levels = self.levels
+        levels["checks"][depth] += num_active
+        levels["misses"][depth] += num_active - num_found - num_searching
+        levels["leaf_hits" if is_leaf else "complete_hits"][depth] += num_found
+
+    """ Call function() and add the seconds it took to phase. Returns its result """
+    def timed(self, phase, function):
+        start = time.perf_counter()
+        result = function()
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + time.perf_counter() - start
+        return result
+
+    """ Everything recorded so far as a dictionary of plain values: the counters at every depth, their totals, the mean
+    depth at which subtrees were pruned and the time of every phase """
+    def to_dict(self):
+        misses = self.levels["misses"]
+        return {
+            "queries": self.queries,
+            "levels": [{"depth": depth, **{counter: self.levels[counter][depth] for counter in LEVEL_COUNTERS}}
+                       for depth in range(len(self.levels["checks"]))],
+            "totals": {counter: sum(counters) for counter, counters in self.levels.items()},
+            "mean_prune_depth": sum(depth * count for depth, count in enumerate(misses)) / sum(misses)
+            if sum(misses) else None,
+            "phase_times": dict(self.phase_times),
+        }
+
+    """ Everything recorded so far as JSON (see to_dict()), also written to file_name if given """
+    def to_json(self, file_name=None):
+        text = json.dumps(self.to_dict(), indent=1)
+        if file_name is not None:
+            with open(file_name, "w") as f:
+                f.write(text)
+        return text
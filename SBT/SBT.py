@@ -7,9 +7,26 @@ from graphviz import Digraph
 from SBT.SSBTNode import SSBTNode
 from SBT.BaseNode import BaseNode
 from SBT.HowDeNode import HowDeNode
+from SBT.KmerHasher import KmerHasher
+from SBT.FlatTree import FlatTree
+from SBT.bits import packed_to_bitarray, packed_bits
+from SBT.index_file import write_index, open_index
+from SBT.external_build import build_index, DEFAULT_MEMORY_BUDGET
+from SBT.SparseFilter import DEFAULT_MAX_DENSITY
+from SBT.clustering import cluster_pairs, cluster_rounds
+from SBT.sequence_reader import iter_chunks, iter_kmers, CHUNK_SIZE
+from SBT.query_plan import plan_query, plan_batch
+from SBT.QueryCache import QueryCache, DEFAULT_CACHE_BYTES
+from SBT.QueryTrace import QueryTrace
+from SBT.traversal import iter_nodes, index_shapes, index_leaves, leaf_path, iter_matching_names, match_leaf_ids, \
+    batch_match_leaf_ids
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import pickle
 import numpy as np
 
+DEFAULT_BALANCE_FACTOR = 2  # Subtrees may be up to this many times deeper than a perfectly balanced tree
+
 
 class SBT(object):
     def __init__(self, k, bloom_filter_length, hash_functions, threshold, similarity_function, sbt_type="Base",
@@ -19,41 +36,269 @@ class SBT(object):
         self.hash_functions = hash_functions
         self.threshold = threshold
         self.similarity_function = similarity_function
-        if sbt_type is not "Base" and sbt_type is not "SSBT" and sbt_type is not "HowDe":
+        if sbt_type != "Base" and sbt_type != "SSBT" and sbt_type != "HowDe":
             raise ValueError("Node class should be Base or SSBT or HowDe")
-        self.NodeClass = SSBTNode if sbt_type is "SSBT" else HowDeNode if sbt_type is "HowDe" else BaseNode
+        self.NodeClass = SSBTNode if sbt_type == "SSBT" else HowDeNode if sbt_type == "HowDe" else BaseNode
         self.hash_fraction = hash_fraction
         self.root = None
+        self.flat = None  # FlatTree layout of the tree when compacted (root is None in that case)
+        self.leaves = None  # Leaf nodes in leaf id order (None until the next query numbers them)
+        self.compressed = False  # Whether sparse node filters are stored as SparseFilters (see compress_filters)
+        self.query_cache = None  # QueryCache of query results (None if disabled, see enable_query_cache)
+        self.balance_factor = None  # Rebalance the tree as it changes if set (see enable_rebalancing)
+        self.balance_bits_to_check = None  # bits_to_check of the clustering when rebalancing
+        self.trace = None  # QueryTrace that queries report to (None if disabled, see enable_tracing)
+
+    """ Must be called after every change to the tree so that the leaf ids are renumbered and cached query results are
+    dropped before the next query """
+    def tree_changed(self):
+        self.leaves = None
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    """ Cache the results of up to max_bytes of queries (see QueryCache). Repeated queries are then answered without
+    traversing the tree. The cache is cleared whenever the tree changes """
+    def enable_query_cache(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.query_cache = QueryCache(max_bytes)
+
+    """ Stop caching query results """
+    def disable_query_cache(self):
+        self.query_cache = None
+
+    """ Returns the bitset of leaf ids matching a query with the given filter indices, from the query cache if it holds
+    them and by calling match() otherwise """
+    def cached_leaf_ids(self, filter_indices, match):
+        if self.query_cache is None:
+            return match()
+        key = QueryCache.key(filter_indices, self.threshold)
+        leaf_ids = self.query_cache.get(key)
+        if leaf_ids is None:
+            leaf_ids = match()
+            self.query_cache.put(key, leaf_ids)
+        return leaf_ids
+
+    """ Trace the queries from now on (see QueryTrace): the nodes checked, kmer rows and bits read, subtrees pruned
+    and complete hits at every depth of the tree and the time spent in every phase of the queries. Returns the
+    QueryTrace, whose to_json() exports what it recorded. Queries answered from the query cache are not walked down the
+    tree, so they only add to the number of queries and the hashing time """
+    def enable_tracing(self):
+        self.trace = QueryTrace()
+        return self.trace
+
+    """ Stop tracing queries. Returns the QueryTrace that recorded them (None if tracing was disabled) """
+    def disable_tracing(self):
+        trace, self.trace = self.trace, None
+        return trace
+
+    """ Returns function(), timed as phase of the traced queries if tracing is enabled """
+    def traced(self, phase, function):
+        if self.trace is None:
+            return function()
+        return self.trace.timed(phase, function)
+
+    """ Add num_queries to the traced queries if tracing is enabled """
+    def trace_queries(self, num_queries=1):
+        if self.trace is not None:
+            self.trace.queries += num_queries
+
+    """ Keep the tree balanced as experiments are inserted, appended or removed: whenever a subtree on the path of a
+    change gets more than balance_factor times deeper than a perfectly balanced tree with as many leaves, the highest
+    such subtree is reclustered (see rebalance_path()). The leaves are clustered comparing their first
+    (# bits_to_check) bits """
+    def enable_rebalancing(self, balance_factor=DEFAULT_BALANCE_FACTOR, bits_to_check=None):
+        if balance_factor < 1:
+            raise ValueError("The balance factor should be at least 1")
+        self.balance_factor = balance_factor
+        self.balance_bits_to_check = bits_to_check
+
+    """ Stop rebalancing the tree as it changes """
+    def disable_rebalancing(self):
+        self.balance_factor = None
+
+    """ Height of the tree (number of edges on the longest path from the root down to a leaf, -1 if the tree is
+    empty) """
+    def height(self):
+        if self.flat is not None:
+            return int(self.flat.heights()[0])
+        return self.root.height if self.root is not None else -1
+
+    """ Returns the leaves of the SBT in leaf id order, numbering the leaves (and the leaf range of every node) with
+    traversal.index_leaves if the tree changed since the last query """
+    def leaf_nodes(self):
+        if self.leaves is None:
+            self.leaves = index_leaves(self.root)
+        return self.leaves
+
+    """ Convert a bitset of leaf ids (or an array of leaf ids) into a list of experiment names """
+    def experiment_names(self, leaf_ids):
+        if leaf_ids.dtype == bool:
+            leaf_ids = np.flatnonzero(leaf_ids)
+        if self.flat is not None:
+            return [self.flat.leaf_names[leaf_id] for leaf_id in leaf_ids]
+        leaves = self.leaf_nodes()
+        return [leaves[leaf_id].experiment_name for leaf_id in leaf_ids]
+
+    """ Convert the tree into the flat, array-backed FlatTree layout and drop the node objects. Queries keep working
+    (except for the Normal query method, which needs the node objects) and any insertion expands the tree again """
+    def compact(self):
+        if self.root is not None:
+            self.flat = FlatTree.from_root(self.root)
+            self.root = None
+            self.tree_changed()
+            self.compressed = False
+
+    """ Rebuild the node objects of a compacted tree and decompress their filters so that experiments can be
+    inserted """
+    def expand(self):
+        if self.flat is not None:
+            self.root = self.flat.to_root(self.hash_functions, self.similarity_function)
+            self.flat = None
+            self.tree_changed()
+        self.decompress_filters()
+
+    """ Store every node filter that has at most max_density of its bits set as a SparseFilter. Sparse filters (most
+    Split-SBT and HowDe-SBT filters below the root) then take a fraction of the memory and are queried without being
+    decompressed. Inserting an experiment decompresses them again """
+    def compress_filters(self, max_density=DEFAULT_MAX_DENSITY):
+        if self.root is not None:
+            for node in iter_nodes(self.root):
+                node.compress(max_density)
+            self.compressed = True
+
+    """ Turn all SparseFilters back into bitarrays """
+    def decompress_filters(self):
+        if self.compressed:
+            for node in iter_nodes(self.root):
+                node.decompress()
+            self.compressed = False
+
+    """ Returns True if every hash function is a KmerHasher, in which case all k-mers of a sequence can be hashed at
+    once as a NumPy array """
+    def vectorized_hashing(self):
+        return all(isinstance(hash_function, KmerHasher) for hash_function in self.hash_functions)
+
+    """ Computes the bloom filter indices of every kmer in a sequence. Returns a (# kmers x # hash functions) array
+    where column i holds the indices given by hash_functions[i]. The sequence is only 2-bit encoded once """
+    def filter_indices(self, sequence: str):
+        if self.vectorized_hashing():
+            codes = KmerHasher.encode(sequence)
+            columns = [hash_function.kmer_hashes(codes, self.k) % np.uint64(self.bloom_filter_length)
+                       for hash_function in self.hash_functions]
+        else:  # Fall back on hashing every kmer string one at a time
+            kmers = list(iter_kmers(sequence, self.k))
+            columns = [[hash_function(kmer) % self.bloom_filter_length for kmer in kmers]
+                       for hash_function in self.hash_functions]
+        return np.array(columns, dtype=np.int64).reshape(len(self.hash_functions), -1).T
 
     """ Creates a SBT Node from a sequence by breaking down the sequence into kmers and then inserting the kmers using
      the node's implemented insert_kmer() method. If hash_fraction < 1, then some kmers are randomly chosen to not be
-     inserted. The node also is labeled with the experiment_name """
+     inserted. The node also is labeled with the experiment_name. When the hash functions are KmerHashers, the filter
+     indices of all kmers are computed at once and set with the node's insert_filter_indices() method instead """
     def node_from_sequence(self, sequence: str, experiment_name):
         node = self.NodeClass(self.bloom_filter_length, self.hash_functions, self.similarity_function, experiment_name)
+        self.insert_sequence_kmers(node, sequence)
+        return node
 
+    """ Creates a SBT Node from a sequence file (FASTA, FASTQ or a plain sequence, optionally gzipped) without reading
+    the whole file into memory. The file is hashed in chunks of at most chunk_size bases that overlap by k - 1 bases
+    (see sequence_reader.iter_chunks()), so the node gets the kmers of every record of the file and peak memory does
+    not depend on the size of the file """
+    def node_from_file(self, file_name, experiment_name, chunk_size=CHUNK_SIZE):
+        node = self.NodeClass(self.bloom_filter_length, self.hash_functions, self.similarity_function, experiment_name)
+        for _, chunk in iter_chunks(file_name, self.k, chunk_size):
+            self.insert_sequence_kmers(node, chunk if self.vectorized_hashing() else chunk.decode("ascii"))
+        return node
+
+    """ Inserts the kmers of a sequence into a node (see node_from_sequence()) """
+    def insert_sequence_kmers(self, node, sequence):
+        if self.vectorized_hashing():
+            filter_indices = self.filter_indices(sequence)
+            if self.hash_fraction < 1:  # Hash only some of the kmers
+                filter_indices = filter_indices[np.random.random(len(filter_indices)) < self.hash_fraction]
+            node.insert_filter_indices(filter_indices)
+            return
         if self.hash_fraction == 1:  # Just insert all kmers
-            for kmer_index in range(0, len(sequence) - self.k + 1):  # Iterate through k-mers
-                kmer = sequence[kmer_index:kmer_index + self.k]
+            for kmer in iter_kmers(sequence, self.k):  # Iterate through k-mers (of one record each)
                 node.insert_kmer(kmer)
-            return node
+            return
         # Hash only some of the kmers
         kmers_to_insert = np.random.random(len(sequence) - self.k + 1) < self.hash_fraction
-        for kmer_index in range(0, len(sequence) - self.k + 1):  # Iterate through k-mers
-            if kmers_to_insert[kmer_index]:
-                kmer = sequence[kmer_index:kmer_index + self.k]
+        for kmer, insert in zip(iter_kmers(sequence, self.k), kmers_to_insert):  # Iterate through k-mers
+            if insert:
                 node.insert_kmer(kmer)
-        return node
 
-    """ Creates a node for a single sequence and inserts it into the SBT using the given experiment_name """
-    def insert_sequence(self, sequence: str, experiment_name: str):
-        self.insert_node(self.node_from_sequence(sequence, experiment_name))
+    """ Creates the leaf nodes of many sequences (see node_from_sequence()). With workers > 1, the leaf filters are
+    built in a pool of that many processes, which send them back as packed bytes instead of pickled nodes. Only
+    KmerHasher hash functions give the same hashes in every process, so other hash functions always build the leaves in
+    this process """
+    def nodes_from_sequences(self, sequences, experiment_names, workers=None):
+        return self.build_leaves(sequences, experiment_names, False, workers)
 
-    """ Insert a pre-generated node into the SBT """
-    def insert_node(self, node):
+    """ Creates the leaf nodes of many sequence files (see node_from_file() and nodes_from_sequences()). Worker
+    processes read their files themselves, so the sequences are never sent between processes """
+    def nodes_from_files(self, file_names, experiment_names, workers=None):
+        return self.build_leaves(file_names, experiment_names, True, workers)
+
+    """ Creates the leaf nodes of sequences, or of sequence files if from_file (see nodes_from_sequences()) """
+    def build_leaves(self, sources, experiment_names, from_file, workers=None):
+        sources = list(sources)
+        experiment_names = list(experiment_names)
+        if workers is None or workers <= 1 or len(sources) <= 1 or not self.vectorized_hashing():
+            build = self.node_from_file if from_file else self.node_from_sequence
+            return [build(source, name) for source, name in zip(sources, experiment_names)]
+        seeds = np.random.randint(2 ** 32, size=len(sources))  # Keeps hash_fraction < 1 random in every worker
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            packed_filters = executor.map(leaf_filter_bytes, sources, repeat(from_file), repeat(self.k),
+                                          repeat(self.bloom_filter_length), repeat(self.hash_functions),
+                                          repeat(self.hash_fraction), seeds)
+            return self.nodes_from_packed(packed_filters, experiment_names)
+
+    """ Yield the packed leaf filter of every sequence, or of every sequence file if from_file, one at a time (see
+    build_leaves()) """
+    def iter_leaf_filters(self, sources, from_file, workers=None):
+        sources = list(sources)
+        if workers is None or workers <= 1 or len(sources) <= 1 or not self.vectorized_hashing():
+            build = self.node_from_file if from_file else self.node_from_sequence
+            for source in sources:
+                node = build(source, None)
+                yield packed_bits(getattr(node, node.filter_names[0]))
+            return
+        seeds = np.random.randint(2 ** 32, size=len(sources))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(leaf_filter_bytes, sources, repeat(from_file), repeat(self.k),
+                                    repeat(self.bloom_filter_length), repeat(self.hash_functions),
+                                    repeat(self.hash_fraction), seeds)
+
+    """ Creates leaf nodes from leaf filters packed into bytes (bitarray.tobytes()) or rows of uint8, e.g. leaf filters
+    built by other processes or read from a cache """
+    def nodes_from_packed(self, packed_filters, experiment_names):
+        return [self.NodeClass(self.bloom_filter_length, self.hash_functions, self.similarity_function, name,
+                               packed_to_bitarray(np.frombuffer(packed_filter, dtype=np.uint8),
+                                                  self.bloom_filter_length))
+                for packed_filter, name in zip(packed_filters, experiment_names)]
+
+    """ Creates a node for a single sequence and inserts it into the SBT using the given experiment_name. If
+    bits_to_check is set, the node is routed down the tree by comparing only that many bits (see insert_node()) """
+    def insert_sequence(self, sequence: str, experiment_name: str, bits_to_check=None):
+        self.insert_node(self.node_from_sequence(sequence, experiment_name), bits_to_check)
+
+    """ Inserts a list of sequences one at a time by traversing down the most similar child (see insert_sequence()).
+    The leaves are built first, in a pool of worker processes if workers > 1 """
+    def insert_sequences(self, sequences: list, experiment_names: list, workers=None, bits_to_check=None):
+        for node in self.nodes_from_sequences(sequences, experiment_names, workers):
+            self.insert_node(node, bits_to_check)
+
+    """ Insert a pre-generated node into the SBT. The node goes down the most similar child at every level, comparing
+    the first (# bits_to_check) bits of the filters (all bits if None) """
+    def insert_node(self, node, bits_to_check=None):
+        self.expand()
         if self.root is None:
             self.root = node
         else:
-            self.root.insert_experiment(node)
+            path = self.root.insert_experiment(node, bits_to_check)
+            path.reverse()
+            self.rebalance_path(path)
+        self.tree_changed()
 
     """ Clustering Method 1"""
     """ Inserts a list of sequences using clustering heuristics described in the AllSome Paper. Essentially, we first
@@ -61,93 +306,290 @@ class SBT(object):
     compute pairwise similarities between all sequences. The SBT of sequences with the highest similarities are then 
     joined together as children of a new parent node. The parent node goes back into the group of SBTs we compute the
     pairwise similarities on and can themselves be joined and parented. We repeat until there is only one SBT remaining.
-     At that point, the last SBT remaining becomes the root node. """
-    def insert_cluster_sequences1(self, sequences: list, experiment_names: list, bits_to_check):
-        nodes = []
-        if self.root is not None:
-            nodes.append(self.root)
-        for sequence, name in zip(sequences, experiment_names):
-            nodes.append(self.node_from_sequence(sequence, name))
-        # Iterate through all nodes, select the two that are the most similar and then create a parent node from them
-        while len(nodes) > 1:
-            max_similarity = -np.inf
-            max_pair = ()
-            # Select most similar pair
-            for idx1 in range(len(nodes)):
-                for idx2 in range(idx1 + 1, len(nodes)):
-                    similarity = nodes[idx1].similarity(nodes[idx2], bits_to_check)
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        max_pair = (idx1, idx2)
-            # Parent the most similar pair
-            node = self.NodeClass.from_children(nodes[max_pair[0]], nodes[max_pair[1]])
-            nodes.remove(node.left_child)
-            nodes.remove(node.right_child)
-            nodes.append(node)
-        self.root = nodes[0]
+     At that point, the last SBT remaining becomes the root node. The pairwise similarities are only computed once and
+     updated for every new parent (see clustering.cluster_pairs). The leaves are built in a pool of worker processes if
+     workers > 1 """
+    def insert_cluster_sequences1(self, sequences: list, experiment_names: list, bits_to_check, workers=None):
+        self.insert_nodes(self.nodes_from_sequences(sequences, experiment_names, workers), "Cluster1", bits_to_check)
 
     """ Clustering Method 2"""
     """ Inserts a list of sequences using clustering heuristics that were created by us. This heuristic is similar to
     the AllSome heuristic, but the main difference is that we don't allow newly combined SBTs to be considered in
     similarity calculations until all the nodes have been paired once. Then we pair together the parents until all the
     parents have been paired once. We continue until we remain with one node. This ensures the height of the SBT is
-    reasonable and also runs faster than the first method """
-    def insert_cluster_sequences2(self, sequences: list, experiment_names: list, bits_to_check):
-        nodes = []
+    reasonable and also runs faster than the first method (see clustering.cluster_rounds). The leaves are built in a
+    pool of worker processes if workers > 1 """
+    def insert_cluster_sequences2(self, sequences: list, experiment_names: list, bits_to_check, workers=None):
+        self.insert_nodes(self.nodes_from_sequences(sequences, experiment_names, workers), "Cluster2", bits_to_check)
+
+    """ Bulk append. Inserts a list of sequences by clustering their leaves among themselves (see
+    insert_cluster_sequences2()) and grafting the resulting subtree into the existing tree (see append_nodes()), so the
+    existing tree is not reclustered. The leaves are built in a pool of worker processes if workers > 1 """
+    def append_sequences(self, sequences: list, experiment_names: list, bits_to_check=None, workers=None):
+        self.insert_nodes(self.nodes_from_sequences(sequences, experiment_names, workers), "Append", bits_to_check)
+
+    """ Insert pre-generated leaf nodes with one of the insertion methods ("Greedy", "Cluster1", "Cluster2" or
+    "Append", see insert_sequences(), insert_cluster_sequences1(), insert_cluster_sequences2() and append_sequences()).
+    The clustering methods cluster the current tree as one more subtree """
+    def insert_nodes(self, nodes, method="Greedy", bits_to_check=None):
+        if method == "Greedy":
+            for node in nodes:
+                self.insert_node(node, bits_to_check)
+            return
+        if method == "Append":
+            self.append_nodes(nodes, bits_to_check)
+            return
+        if method != "Cluster1" and method != "Cluster2":
+            raise ValueError("Insertion method should be Greedy or Cluster1 or Cluster2 or Append")
+        self.expand()
+        subtrees = []
         if self.root is not None:
-            nodes.append(self.root)
-        for sequence, name in zip(sequences, experiment_names):
-            nodes.append(self.node_from_sequence(sequence, name))
-        # Iterate through all nodes, select the two that are the most similar and then create a parent node from them
-        while len(nodes) > 1:
-            similarities = [[0] * len(nodes) for _ in range(len(nodes))]
-            # Compute similairities
-            for idx1 in range(len(nodes)):
-                for idx2 in range(idx1 + 1, len(nodes)):
-                    similarities[idx1][idx2] = nodes[idx1].similarity(nodes[idx2], bits_to_check)
-                    similarities[idx2][idx1] = similarities[idx1][idx2]
-            parent_nodes = []
-            unmatched = {i for i in range(len(nodes))}
-            # Matches up pairs until there is 0 or 1 remaining
-            while len(unmatched) > 1:
-                max_similarity = -np.inf
-                max_pair = ()
-                for idx1 in unmatched:
-                    for idx2 in unmatched:
-                        if idx1 == idx2:
-                            continue
-                        if similarities[idx1][idx2] > max_similarity:
-                            max_similarity = similarities[idx1][idx2]
-                            max_pair = (idx1, idx2)
-                # Create matched parent node
-                node = self.NodeClass.from_children(nodes[max_pair[0]], nodes[max_pair[1]])
-                unmatched.remove(max_pair[0])
-                unmatched.remove(max_pair[1])
-                parent_nodes.append(node)
-            # Assign parents to now be matched
-            nodes = [nodes[idx] for idx in unmatched]
-            nodes.extend(parent_nodes)
-        self.root = nodes[0]
+            subtrees.append(self.root)
+        subtrees.extend(nodes)
+        cluster = cluster_pairs if method == "Cluster1" else cluster_rounds
+        self.root = cluster(subtrees, self.NodeClass, bits_to_check)
+        if self.balance_factor is not None:
+            self.rebalance(self.balance_factor, self.balance_bits_to_check)
+        self.tree_changed()
+
+    """ Cluster pre-generated leaf nodes among themselves into one subtree (see clustering.cluster_rounds) and graft it
+    into the tree next to the node found by graft_path(). Only the filters of the nodes on the path to the root are
+    recomputed (see replace_subtree()), so appending a batch to a tree of n experiments costs
+    O(depth * bloom_filter_length) on top of clustering the batch instead of reclustering all n experiments """
+    def append_nodes(self, nodes, bits_to_check=None):
+        nodes = list(nodes)
+        if not nodes:
+            return
+        self.expand()
+        subtree = cluster_rounds(nodes, self.NodeClass, bits_to_check)
+        if self.root is None:
+            self.root = subtree
+        else:
+            path = self.graft_path(subtree, bits_to_check)
+            node = path.pop()
+            node.detach(path)
+            parent = self.NodeClass.from_children(node, subtree)
+            self.replace_subtree(path, node, parent)
+            self.rebalance_path(path + [parent])
+        self.tree_changed()
+
+    """ Returns the nodes from the root down to the node that a subtree should be grafted next to. The path goes down
+    the child more similar to the subtree (comparing the first (# bits_to_check) bits of the filters of every node as if
+    it were the root of a standalone tree, see the node classes' detach()) for as long as that child is more similar to
+    the subtree than its parent """
+    def graft_path(self, subtree, bits_to_check=None):
+        path = [self.root]
+        similarity = self.standalone_similarity(path, subtree, bits_to_check)
+        while path[-1].left_child is not None:
+            child, child_similarity = max(
+                ((child, self.standalone_similarity(path + [child], subtree, bits_to_check))
+                 for child in (path[-1].left_child, path[-1].right_child)), key=lambda pair: pair[1])
+            if child_similarity <= similarity:
+                break
+            path.append(child)
+            similarity = child_similarity
+        return path
+
+    """ Similarity between a subtree and the last node of path as if that node were the root of a standalone tree """
+    @staticmethod
+    def standalone_similarity(path, subtree, bits_to_check=None):
+        node = path[-1].copy()
+        node.detach(path[:-1])
+        return node.similarity(subtree, bits_to_check)
+
+    """ Put node in the place of the subtree old, whose ancestors from the root down are path, and recompute the filters
+    of the nodes on the path (see the node classes' update_path()). node's filters must be those of a standalone
+    tree """
+    def replace_subtree(self, path, old, node):
+        if not path:
+            self.root = node
+            return
+        if path[-1].left_child is old:
+            path[-1].left_child = node
+        else:
+            path[-1].right_child = node
+        self.NodeClass.update_path(path, node)
+
+    """ Whether a subtree is more than balance_factor times deeper than a perfectly balanced tree with as many
+    leaves """
+    @staticmethod
+    def too_deep(node, balance_factor):
+        return node.height > balance_factor * (node.num_leaves - 1).bit_length()
+
+    """ Replace the subtree at node (whose ancestors from the root down are path) with a balanced subtree of the same
+    leaves, built by clustering them again (see clustering.cluster_rounds), and recompute the filters on the path. The
+    old inner nodes are dropped, so this costs O(# leaves * bloom_filter_length) plus the clustering of the leaves """
+    def recluster(self, path, node, bits_to_check=None):
+        node.detach(path)
+        leaves = []
+        stack = [node]
+        while stack:
+            subtree = stack.pop()
+            if subtree.left_child is None:
+                leaves.append(subtree)
+            else:
+                for child in (subtree.right_child, subtree.left_child):
+                    child.detach([subtree])  # subtree is standalone already
+                    stack.append(child)
+        self.replace_subtree(path, node, cluster_rounds(leaves, self.NodeClass, bits_to_check))
+
+    """ If rebalancing is enabled (see enable_rebalancing()), recluster the highest too deep node of path (nodes from
+    the root down, e.g. the path of an insertion). Only the nodes on the path of a change get deeper, so checking them
+    costs O(depth) and keeps the whole tree within the bound. Reclustering the highest too deep node makes the costly
+    rebuilds of big subtrees rare, as in a scapegoat tree """
+    def rebalance_path(self, path):
+        if self.balance_factor is None:
+            return
+        for depth, node in enumerate(path):
+            if self.too_deep(node, self.balance_factor):
+                self.recluster(path[:depth], node, self.balance_bits_to_check)
+                return
+
+    """ Rebalance the whole tree once, e.g. a tree built greedily without rebalancing. Walks down from the root and
+    reclusters every too deep subtree (see too_deep() and recluster()) that is not below another one, comparing the
+    first (# bits_to_check) bits of the leaves. Returns the number of reclustered subtrees """
+    def rebalance(self, balance_factor=DEFAULT_BALANCE_FACTOR, bits_to_check=None):
+        if balance_factor < 1:
+            raise ValueError("The balance factor should be at least 1")
+        self.expand()
+        if self.root is None:
+            return 0
+        reclustered = 0
+        path = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del path[depth:]
+            if self.too_deep(node, balance_factor):
+                self.recluster(path, node, bits_to_check)
+                reclustered += 1
+            elif node.left_child is not None:
+                path.append(node)
+                stack.append((node.right_child, depth + 1))
+                stack.append((node.left_child, depth + 1))
+        self.tree_changed()
+        return reclustered
+
+    """ Returns the nodes from the root down to the leaf of an experiment. Raises a ValueError if there is none """
+    def experiment_path(self, experiment_name):
+        self.expand()
+        path = leaf_path(self.root, experiment_name) if self.root is not None else None
+        if path is None:
+            raise ValueError("The SBT has no experiment named " + str(experiment_name))
+        return path
+
+    """ Remove an experiment from the SBT. Its sibling takes the place of their parent and only the filters of the
+    nodes on the path to the root are recomputed, so this costs O(depth * bloom_filter_length) instead of a rebuild """
+    def remove_experiment(self, experiment_name):
+        path = self.experiment_path(experiment_name)
+        leaf = path.pop()
+        if not path:  # The experiment was the only one
+            self.root = None
+        else:
+            parent = path[-1]
+            sibling = parent.right_child if parent.left_child is leaf else parent.left_child
+            sibling.detach(path)
+            self.replace_subtree(path[:-1], parent, sibling)
+            self.rebalance_path(path[:-1])
+        self.tree_changed()
+
+    """ Replace the sequence of an experiment with a new one. The experiment keeps its place in the tree and only the
+    filters of the nodes on the path to the root are recomputed, so this costs O(depth * bloom_filter_length) instead
+    of a rebuild """
+    def replace_experiment(self, experiment_name, sequence: str):
+        path = self.experiment_path(experiment_name)
+        leaf = path.pop()
+        self.replace_subtree(path, leaf, self.node_from_sequence(sequence, experiment_name))
+        self.tree_changed()
 
     """ Generic SBT querying algorithm. This involves checking each kmer as we walk down the tree. """
     def query_sequence(self, sequence: str):
+        if self.flat is not None:
+            raise ValueError("The Normal query method needs the node objects, call expand() on compacted SBTs")
+        self.trace_queries()
         # Break sequence into individual kmers
-        kmers = [sequence[kmer_index:kmer_index + self.k] for kmer_index in range(0, len(sequence) - self.k + 1)]
+        kmers = self.traced("hashing", lambda: list(iter_kmers(sequence, self.k)))
         # Determine absolute threshold (theta * # kmers) and begin query
-        return self.root.query_experiment(kmers=kmers, absolute_threshold=self.threshold * len(kmers))
+        matches = self.cached_leaf_ids(
+            self.traced("hashing", lambda: self.filter_indices(sequence)) if self.query_cache is not None else None,
+            lambda: self.traced("traversal", lambda: match_leaf_ids(
+                self.root, self.NodeClass.kmer_check, (kmers, None, self.threshold * len(kmers)),
+                len(self.leaf_nodes()), trace=self.trace)))
+        return self.traced("names", lambda: self.experiment_names(matches))
 
-    """ Fast querying algorithm. We keep track of the indices that the kmers hash so that we don't
-     have to hash our kmers every time we search a node. This only works when we have 1 or fewer hash functions. """
-    def fast_query_sequence(self, sequence: str):
-        if len(self.hash_functions) > 1:
-            raise ValueError("Cannot use query method if more than 1 hash function is employed")
+    """ Fast querying algorithm. We keep track of the indices that the kmers hash to (one per hash function) so that
+     we don't have to hash our kmers every time we search a node. The same index matrix is reused at every node, with
+     repeated kmers collapsed into weighted rows by query_plan.plan_query. Returns a bitset over the leaf ids of the
+     matching experiments """
+    def fast_query_leaf_ids(self, sequence: str):
+        self.trace_queries()
         # Determine what indices kmers get mapped to
-        filter_indices = []
-        for kmer_index in range(0, len(sequence) - self.k + 1):
-            kmer = sequence[kmer_index:kmer_index + self.k]
-            filter_indices.append(self.hash_functions[0](kmer) % self.bloom_filter_length)
-        return self.root.fast_query_experiment(filter_indices=filter_indices,
-                                               absolute_threshold=self.threshold * (len(sequence) - self.k + 1))
+        filter_indices = self.traced("hashing", lambda: self.filter_indices(sequence))
+        absolute_threshold = self.threshold * len(filter_indices)
+        return self.cached_leaf_ids(filter_indices, lambda: self.match_planned(filter_indices, absolute_threshold))
+
+    """ Returns a bitset over the leaf ids of the experiments matching a query's filter indices, probing the rows of its
+    query plan """
+    def match_planned(self, filter_indices, absolute_threshold):
+        rows, weights = self.traced("planning", lambda: plan_query(filter_indices))
+        if self.flat is not None:
+            return self.traced("traversal", lambda: self.flat.match_leaf_ids(rows, absolute_threshold, weights,
+                                                                             self.trace))
+        return self.traced("traversal", lambda: match_leaf_ids(
+            self.root, self.NodeClass.fast_check, (rows, None, absolute_threshold, weights), len(self.leaf_nodes()),
+            trace=self.trace))
+
+    """ Fast querying algorithm that returns the names of the matching experiments """
+    def fast_query_sequence(self, sequence: str):
+        matches = self.fast_query_leaf_ids(sequence)
+        return self.traced("names", lambda: self.experiment_names(matches))
+
+    """ Generator version of fast_query_sequence() that yields the names of matching experiments as they are found """
+    def iter_fast_query_sequence(self, sequence: str):
+        self.trace_queries()
+        filter_indices = self.traced("hashing", lambda: self.filter_indices(sequence))
+        rows, weights = self.traced("planning", lambda: plan_query(filter_indices))
+        absolute_threshold = self.threshold * len(filter_indices)
+        if self.flat is not None:
+            return self.flat.iter_matching_names(rows, absolute_threshold, weights, self.trace)
+        return iter_matching_names(self.root, self.NodeClass.fast_check, (rows, None, absolute_threshold, weights),
+                                   self.trace)
+
+    """ Batched querying algorithm. All sequences walk down the tree together so that every node's filters are only
+    read once per batch, using the fast query method's filter indices for each sequence. A query is dropped from a
+    subtree on its own without stopping the rest of the batch. Sequences whose results are in the query cache are not
+    walked down the tree. Returns a list with the result of each sequence """
+    def query_batch(self, sequences):
+        if len(sequences) == 0:
+            return []
+        self.trace_queries(len(sequences))
+        filter_indices = self.traced("hashing", lambda: [self.filter_indices(sequence) for sequence in sequences])
+        if self.query_cache is None:
+            matches = self.batch_leaf_ids(filter_indices)
+            return self.traced("names", lambda: [self.experiment_names(query_matches) for query_matches in matches])
+        keys = [QueryCache.key(indices, self.threshold) for indices in filter_indices]
+        matches = [self.query_cache.get(key) for key in keys]
+        missing = [query_index for query_index, query_matches in enumerate(matches) if query_matches is None]
+        if missing:
+            for query_index, query_matches in zip(missing, self.batch_leaf_ids([filter_indices[i] for i in missing])):
+                matches[query_index] = query_matches
+                self.query_cache.put(keys[query_index], query_matches)
+        return self.traced("names", lambda: [self.experiment_names(query_matches) for query_matches in matches])
+
+    """ Bitsets of the leaf ids matching each query of a batch given their filter indices (see query_batch()) """
+    def batch_leaf_ids(self, filter_indices):
+        num_queries = len(filter_indices)
+        num_kmers = np.array([len(indices) for indices in filter_indices])
+        rows, query_ids, weights = self.traced("planning", lambda: plan_batch(filter_indices))
+        if self.flat is not None:
+            matches = self.traced("traversal", lambda: self.flat.batch_match_leaf_ids(
+                rows, query_ids, self.threshold * num_kmers, weights, self.trace))
+        else:
+            state = (rows, np.ones(rows.shape, dtype=bool), query_ids, np.ones(num_queries, dtype=bool),
+                     self.threshold * num_kmers, weights)
+            matches = self.traced("traversal", lambda: batch_match_leaf_ids(
+                self.root, self.NodeClass.batch_check, state, num_queries, len(self.leaf_nodes()), trace=self.trace))
+        return list(matches)
 
     """ Print the experiment names and bits of every node in the SBT """
     def print(self):
@@ -173,3 +615,52 @@ class SBT(object):
     @staticmethod
     def load(file_name):
         return pickle.load(open(file_name, "rb"))
+
+    """ Restore an unpickled SBT. SBTs pickled before the tree could be compacted, cached, rebalanced or traced get
+    those features disabled, and the height and number of leaves of their nodes are computed """
+    def __setstate__(self, state):
+        legacy = "flat" not in state
+        self.__dict__.update(flat=None, leaves=None, compressed=False, query_cache=None, balance_factor=None,
+                             balance_bits_to_check=None, trace=None)
+        self.__dict__.update(state)
+        if legacy and self.root is not None:
+            index_shapes(self.root)
+
+    """ Save SBT to a memory-mapped index file (see index_file). Requires KmerHasher hash functions """
+    def save_index(self, file_name):
+        write_index(self, file_name)
+
+    """ Out-of-core build for collections whose filters do not fit in memory (see external_build). The leaves of
+    sequences (or of sequence files if from_file, read in chunks) are clustered like insert_cluster_sequences2() while
+    about memory_budget bytes of filters and similarities are held in memory, and the tree is written straight to the
+    index file file_name and opened, so the SBT ends up compacted with its filters on disk. Scratch files go into
+    scratch_directory (the index file's directory if None). The SBT must be empty and hashed with KmerHashers """
+    def build_index(self, sources, experiment_names, file_name, bits_to_check=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+                    from_file=False, workers=None, scratch_directory=None):
+        if self.root is not None or self.flat is not None:
+            raise ValueError("build_index builds a new tree, the SBT should be empty")
+        if not self.vectorized_hashing():
+            raise ValueError("Only SBTs hashed with KmerHasher hash functions can be saved as an index")
+        build_index(self, self.iter_leaf_filters(sources, from_file, workers), experiment_names, file_name,
+                    bits_to_check, memory_budget, scratch_directory)
+        _, self.flat = open_index(file_name)
+        self.tree_changed()
+
+    """ Open an index file written by save_index. The SBT is compacted and its filters stay on disk until a query reads
+    them. The similarity function is not stored in the file, so it has to be given to insert more experiments """
+    @staticmethod
+    def open_index(file_name, similarity_function=None):
+        metadata, tree = open_index(file_name)
+        sbt = SBT(metadata["k"], metadata["bloom_filter_length"], [KmerHasher(seed) for seed in metadata["hash_seeds"]],
+                  metadata["threshold"], similarity_function, tree.sbt_type, metadata["hash_fraction"])
+        sbt.flat = tree
+        return sbt
+
+
+# Packed bits of the leaf filter of a sequence (or of a sequence file if from_file). Runs in the worker processes of
+# SBT.build_leaves(), so it only takes picklable arguments and returns bytes instead of a node
+def leaf_filter_bytes(source, from_file, k, bloom_filter_length, hash_functions, hash_fraction, seed):
+    np.random.seed(seed)
+    sbt = SBT(k, bloom_filter_length, hash_functions, 0, None, hash_fraction=hash_fraction)
+    node = sbt.node_from_file(source, None) if from_file else sbt.node_from_sequence(source, None)
+    return node.bloom_filter.tobytes()
@@ -1,13 +1,22 @@
 """ Sequence Bloom Tree Node implementation based off of HowDe-SBT in Kingsford & Solomon (2018) """
 from bitarray import bitarray
+from SBT.bits import indices_to_bitarray
+from SBT.SparseFilter import compress_filter, decompress_filter, DEFAULT_MAX_DENSITY
+from SBT.kernels import split_check, split_batch_check, MISS, HIT, PARTIAL
+from SBT.traversal import update_shape, restore_node, iter_matching_names, iter_leaves
 
 
 class SSBTNode(object):
+    __slots__ = ("bloom_filter_length", "hash_functions", "similarity_function", "experiment_name", "sim_filter",
+                 "rem_filter", "left_child", "right_child", "leaf_range", "height",
+                 "num_leaves", "id")
     count = 0  # How many Nodes have been created
+    sbt_type = "SSBT"
+    filter_names = ("sim_filter", "rem_filter")  # Filters kept in the matrices of a FlatTree
 
     def __init__(self, bloom_filter_length, hash_functions, similarity_function, experiment_name, sim_filter=None):
         self.bloom_filter_length = bloom_filter_length
-        self.hash_function = hash_functions[0]  # Only need 1 hash function
+        self.hash_functions = hash_functions
         self.similarity_function = similarity_function
         self.experiment_name = experiment_name
         # Initialize Bloom Filters to all 0s
@@ -15,8 +24,11 @@ class SSBTNode(object):
         self.rem_filter = None  # None if node is a leaf
         self.left_child = None
         self.right_child = None
+        self.leaf_range = None  # (first, last + 1) leaf id of the subtree, set by traversal.index_leaves()
+        self.height = 0  # Number of edges on the longest path down to a leaf (see traversal.update_shape())
+        self.num_leaves = 1  # Number of leaves in the subtree
         # Give node an id
-        self.id = str(SSBTNode.count)
+        self.id = SSBTNode.count
         SSBTNode.count += 1
 
     """ Creates a new parent Node whose children are left_child and right_child. The Node's filter(s) are set so that
@@ -33,24 +45,48 @@ class SSBTNode(object):
         node.rem_filter = left_child.sim_filter | right_child.sim_filter
         if left_child.rem_filter is not None:
             node.rem_filter |= left_child.rem_filter
-        if left_child.rem_filter is not None:
+        if right_child.rem_filter is not None:
             node.rem_filter |= right_child.rem_filter
         # Set new node's children
         node.left_child = left_child
         node.right_child = right_child
+        update_shape(node)
         return node
 
     """ Insert a kmer into the Node's similarity filter """
     def insert_kmer(self, kmer):
-        self.sim_filter[self.hash_function(kmer) % self.bloom_filter_length] = True
+        for hash_function in self.hash_functions:
+            self.sim_filter[hash_function(kmer) % self.bloom_filter_length] = True
+
+    """ Insert the precomputed filter indices of many kmers (one column per hash function) into the Node's similarity
+    filter """
+    def insert_filter_indices(self, filter_indices):
+        self.sim_filter |= indices_to_bitarray(filter_indices, self.bloom_filter_length)
+
+    """ Replace every filter of this Node that has at most max_density of its bits set with a SparseFilter, which is
+    queried without decompressing it """
+    def compress(self, max_density=DEFAULT_MAX_DENSITY):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, compress_filter(getattr(self, filter_name), max_density))
 
-    """ Query a kmer from the Node's similarity filter """
-    def query_kmer_sim(self, kmer):
-        return self.sim_filter[self.hash_function(kmer) % self.bloom_filter_length]
+    """ Turn the Node's SparseFilters back into bitarrays (needed before inserting into the Node) """
+    def decompress(self):
+        for filter_name in self.filter_names:
+            setattr(self, filter_name, decompress_filter(getattr(self, filter_name)))
 
-    """ Query a kmer from the Node's remainder filter """
-    def query_kmer_rem(self, kmer):
-        return self.rem_filter[self.hash_function(kmer) % self.bloom_filter_length]
+    """ Query the bit of a kmer given by hash function number hash_index from the Node's similarity filter. The read is
+    reported to trace if given """
+    def query_kmer_sim(self, kmer, hash_index=0, trace=None):
+        if trace is not None:
+            trace.probe(0, 1)
+        return self.sim_filter[self.hash_functions[hash_index](kmer) % self.bloom_filter_length]
+
+    """ Query the bit of a kmer given by hash function number hash_index from the Node's remainder filter. The read is
+    reported to trace if given """
+    def query_kmer_rem(self, kmer, hash_index=0, trace=None):
+        if trace is not None:
+            trace.probe(0, 1)
+        return self.rem_filter[self.hash_functions[hash_index](kmer) % self.bloom_filter_length]
 
     """ Return similarity between the first (# bits_to_check) bits of this Node's sim filter and the first 
     (# bits_to_check) of another node's sim filter """
@@ -59,19 +95,28 @@ class SSBTNode(object):
             return self.similarity_function(self.sim_filter, node.sim_filter)
         return self.similarity_function(self.sim_filter[:bits_to_check], node.sim_filter[:bits_to_check])
 
+    """ Restore an unpickled Node, including Nodes pickled before the node classes had slots (see
+    traversal.restore_node()) """
+    def __setstate__(self, state):
+        restore_node(self, state)
+
     """ Deep copy fields of node (except for left and right children) """
     def copy(self):
-        return SSBTNode(self.bloom_filter_length, [self.hash_function], self.similarity_function, self.experiment_name,
+        return SSBTNode(self.bloom_filter_length, self.hash_functions, self.similarity_function, self.experiment_name,
                         self.sim_filter.copy())
 
     """ Insert a single node to an existing SBT greedily by traversing down the most similar child starting from the 
-    root """
-    def insert_experiment(self, node):
+    root. If bits_to_check is set, children are compared with the node on only their first (# bits_to_check) bits, a
+    fixed-size sample of the filters (hashed kmers are spread uniformly over the filter), so routing costs O(depth)
+    regardless of bloom_filter_length and only the filter updates touch the full filters. Returns the Nodes on the way
+    from the new leaf's parent up to this Node """
+    def insert_experiment(self, node, bits_to_check=None):
         # 0 children - copy current node into left child and insert into right child
         if self.left_child is None:
             self.left_child = self.copy()
             self.experiment_name = "I" + str(self.id)  # Label inner nodes
             self.right_child = node
+            path = []
             new_sim_filter = self.sim_filter & node.sim_filter
             self.rem_filter = (self.sim_filter & ~new_sim_filter) | (node.sim_filter & ~new_sim_filter)
             self.sim_filter = new_sim_filter
@@ -90,62 +135,130 @@ class SSBTNode(object):
             self.rem_filter = new_rem_filter
             node.sim_filter = new_node_filter
             # Iterate onto more similar child
-            left_similarity = self.left_child.similarity(node)
-            right_similarity = self.right_child.similarity(node)
+            left_similarity = self.left_child.similarity(node, bits_to_check)
+            right_similarity = self.right_child.similarity(node, bits_to_check)
             if left_similarity > right_similarity:
-                self.left_child.insert_experiment(node)
+                path = self.left_child.insert_experiment(node, bits_to_check)
             else:
-                self.right_child.insert_experiment(node)
+                path = self.right_child.insert_experiment(node, bits_to_check)
+        update_shape(self)
+        path.append(self)
+        return path
 
-    """ Query a list of kmers from a SBT by checking whether the respective bit is turned on in the bloom filter. If at
-     least (# absolute_threshold) kmers are present, then the query returns all children nodes. If at least |kmers| - 
-      absolute_threshold kmers are not present, then the subtree at this node is pruned from search. Lastly, if neither
-      of those two conditions are met, then the query proceeds to the children. """
-    def query_experiment(self, kmers: list, absolute_threshold):
+    """ Make this Node's filters those of the root of a standalone tree, given its ancestors from the root down (path).
+    The similarity filters on a path are disjoint and together hold the bits set in every leaf below, so the bits of
+    the ancestors' similarity filters are added back to this Node's """
+    def detach(self, path):
+        for parent in path:
+            self.sim_filter |= parent.sim_filter
+
+    """ Recompute the filters of path (the ancestors of node from the root down, already linked to node) after the
+    subtree at node changed. node's filters must be those of a standalone tree (see detach()). The intersection (bits
+    set in every leaf below) and union of every node on the path are rebuilt bottom up from those of its children, then
+    every similarity filter on the path, of the path's siblings and of node is split off from its parent's intersection
+    again and every remainder filter is its union minus its intersection. Only the nodes on the path and their children
+    are touched, so this costs O(depth * bloom_filter_length) """
+    @staticmethod
+    def update_path(path, node):
+        # Intersection and union of the sibling of every child on the path, from the filters before the change
+        siblings = []
+        intersection = None
+        for parent, child in zip(path, path[1:] + [node]):
+            intersection = parent.sim_filter if intersection is None else intersection | parent.sim_filter
+            sibling = parent.right_child if parent.left_child is child else parent.left_child
+            sibling_intersection = sibling.sim_filter | intersection
+            sibling_union = sibling_intersection if sibling.rem_filter is None else \
+                sibling_intersection | sibling.rem_filter
+            siblings.append((sibling, sibling_intersection, sibling_union))
+        # Rebuild the intersection and union of the path bottom up
+        child_intersection = node.sim_filter
+        child_union = node.sim_filter if node.rem_filter is None else node.sim_filter | node.rem_filter
+        intersections = []
+        for parent, (sibling, sibling_intersection, sibling_union) in zip(reversed(path), reversed(siblings)):
+            child_intersection = child_intersection & sibling_intersection
+            child_union = child_union | sibling_union
+            parent.rem_filter = child_union & ~child_intersection
+            sibling.sim_filter = sibling_intersection & ~child_intersection
+            update_shape(parent)
+            intersections.append(child_intersection)
+        intersections.reverse()
+        # Split the similarity filters of the path and of node off their parents' intersections
+        for index, parent in enumerate(path):
+            parent.sim_filter = intersections[index] & ~intersections[index - 1] if index else intersections[0]
+        node.sim_filter &= ~intersections[-1]
+
+    """ Check a list of kmers against this Node by checking whether the respective bit is turned on in the bloom
+    filter. If at least (# absolute_threshold) kmers are present, then all descendants are returned (HIT). If more than
+    |kmers| - absolute_threshold kmers are not present, then the subtree at this node is pruned from search (MISS).
+    Lastly, if neither of those two conditions are met, then the partial hits are passed on to the children with the
+    remaining threshold (PARTIAL). With several hash functions, a kmer is a complete hit once all of its bits have been
+    found in a similarity filter on the way down, so pending holds the hash functions of each kmer whose bits have not
+    been found yet (None means all of them). The kmers and bits read are reported to trace if given """
+    def kmer_check(self, kmers: list, pending, absolute_threshold, trace=None):
+        if pending is None:
+            pending = [range(len(self.hash_functions))] * len(kmers)
         partial_hits = []
+        partial_pending = []
         complete_hits = 0
         complete_misses = 0
-        for kmer in kmers:  # Check if kmer is present
-            if self.query_kmer_sim(kmer):  # Complete hit - all descendants have
+        for kmer, hash_indices in zip(kmers, pending):  # Check if kmer is present
+            if trace is not None:
+                trace.probe(1, 0)
+            unresolved = [hash_index for hash_index in hash_indices
+                          if not self.query_kmer_sim(kmer, hash_index, trace)]
+            if not unresolved:  # Complete hit - all descendants have
                 complete_hits += 1
                 if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                    return self.iter_children()
-            elif self.rem_filter is not None and self.query_kmer_rem(kmer):  # Partial hit : some descendant have
+                    return HIT, None, None, absolute_threshold
+            elif self.rem_filter is not None and \
+                    all(self.query_kmer_rem(kmer, hash_index, trace) for hash_index in unresolved):  # Partial hit
                 partial_hits.append(kmer)
+                partial_pending.append(unresolved)
             else:  # Complete miss - no descendants have
                 complete_misses += 1
                 if complete_misses > len(kmers) - absolute_threshold:  # Stop since too many misses
-                    return []
+                    return MISS, None, None, absolute_threshold
+        if complete_hits >= absolute_threshold:
+            return HIT, None, None, absolute_threshold
+        if self.left_child is None:  # Leaves have no partial hits
+            return MISS, None, None, absolute_threshold
         # Search children since not enough hits but not enough misses only on kmer partial hits
-        return self.left_child.query_experiment(partial_hits, absolute_threshold - complete_hits) + \
-            self.right_child.query_experiment(partial_hits, absolute_threshold - complete_hits)
+        return PARTIAL, partial_hits, partial_pending, absolute_threshold - complete_hits
 
-    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a list of 
-    filter_indices that the kmers hash to """
-    def fast_query_experiment(self, filter_indices, absolute_threshold):
-        partial_hits = []
-        complete_hits = 0
-        complete_misses = 0
-        for index in filter_indices:  # Check if each index is a hit
-            if self.sim_filter[index]:  # Complete hit - all descendants have
-                complete_hits += 1
-                if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
-                    return self.iter_children()
-            elif self.rem_filter is not None and self.rem_filter[index]:  # Partial hit - some descendants have
-                partial_hits.append(index)
-            else:  # Complete miss - no descendants have
-                complete_misses += 1
-                if complete_misses > len(filter_indices) - absolute_threshold:  # Stop since too many misses
-                    return []
-        # Search children since not enough hits but not enough misses only on kmer partial hits
-        return self.left_child.fast_query_experiment(partial_hits, absolute_threshold - complete_hits) + \
-            self.right_child.fast_query_experiment(partial_hits, absolute_threshold - complete_hits)
+    """ Query a list of kmers from a SBT. The tree is walked with traversal.iter_matches using kmer_check() """
+    def query_experiment(self, kmers: list, absolute_threshold, pending=None, trace=None):
+        return list(iter_matching_names(self, SSBTNode.kmer_check, (kmers, pending, absolute_threshold), trace))
+
+    """ Vectorized version of kmer_check() for a matrix of filter_indices that the kmers hash to (one row per kmer, one
+    column per hash function). pending marks the indices whose bits have not been found in a similarity filter yet
+    (None means all of them). The bits are checked with kernels.split_check and only the partial hits are passed on to
+    the children """
+    def fast_check(self, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+        status, partial_hits, pending, absolute_threshold, weights = split_check(
+            self.sim_filter, self.rem_filter, filter_indices, pending, absolute_threshold, weights, trace)
+        if status == PARTIAL and self.left_child is None:  # Leaves have no partial hits
+            return MISS, None, None, absolute_threshold, None
+        return status, partial_hits, pending, absolute_threshold, weights
+
+    """ Faster way to query a list of kmers from a SBT by only hashing the kmers once and then checking a matrix of 
+    filter_indices that the kmers hash to (one row per kmer, one column per hash function) """
+    def fast_query_experiment(self, filter_indices, absolute_threshold, pending=None, trace=None):
+        return list(iter_matching_names(self, SSBTNode.fast_check, (filter_indices, pending, absolute_threshold),
+                                        trace))
+
+    """ Check a batch of queries at once. filter_indices holds the indices of the kmers of every query (one row per
+    kmer, one column per hash function), pending marks the indices whose bits have not been found in a similarity filter
+    yet, and query_ids the query each row belongs to. The bits of all rows are looked up in one pass over each filter
+    (kernels.split_batch_check), and each query is then completed, pruned or passed on to the children on its own.
+    active marks the queries still searching this subtree and absolute_thresholds holds their thresholds. Returns the
+    queries whose every descendant matches and the state to search the children with (None if no query has to) """
+    def batch_check(self, filter_indices, pending, query_ids, active, absolute_thresholds, weights=None, trace=None):
+        return split_batch_check(self.sim_filter, self.rem_filter, filter_indices, pending, query_ids, active,
+                                 absolute_thresholds, weights, trace)
 
     """ Returns a list of the names of all descendant nodes """
     def iter_children(self):
-        if self.left_child is not None:
-            return self.left_child.iter_children() + self.right_child.iter_children()
-        return [self.experiment_name]
+        return [leaf.experiment_name for leaf in iter_leaves(self)]
 
     """ Print experiment name and the bits of the bloom filter, then call print on children """
     def print(self):
@@ -159,12 +272,12 @@ class SSBTNode(object):
     """ Obtain experiment name (bits=False) or bits (bits=True) of the bloom filter, then add to a graphviz Graph, then 
     iterate on children """
     def graphviz(self, graph, bits):
-        graph.node(self.id,
+        graph.node(str(self.id),
                    'sim: ' + ''.join(map(str, map(int, self.sim_filter))) +
                    ('\nrem: ' + ''.join(map(str, map(int, self.rem_filter))) if self.rem_filter is not None else '')
                    if bits else self.experiment_name)
         if self.left_child is not None:
-            graph.edge(tail_name=self.id, head_name=self.left_child.id)
-            graph.edge(tail_name=self.id, head_name=self.right_child.id)
+            graph.edge(tail_name=str(self.id), head_name=str(self.left_child.id))
+            graph.edge(tail_name=str(self.id), head_name=str(self.right_child.id))
             self.left_child.graphviz(graph, bits)
             self.right_child.graphviz(graph, bits)
@@ -0,0 +1,241 @@
+""" Sharded SBT. The experiments are partitioned into num_shards sub-trees, each built and queried by its own worker
+process, so building and querying use one core per shard and each process only holds its shard. Queries are scattered
+to every shard at once and the matches of all shards are concatenated. Experiments are assigned to shards in turn
+("round_robin") or so that similar experiments share a shard ("cluster", which keeps each shard's tree tighter).
+
+save() writes every shard (an index file, see index_file, or a pickle for hash functions other than KmerHasher) and a
+manifest.json that lists the shard files and their experiments, so ShardedSBT.open() reopens the whole collection """
+from SBT.SBT import SBT
+from SBT.KmerHasher import KmerHasher
+from SBT.clustering import PairwiseSimilarity
+from multiprocessing import Pipe, Process
+import numpy as np
+import json
+import os
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+PARTITIONS = ["round_robin", "cluster"]
+
+
+# Assign experiments to shards in turn. Returns the experiment indices of every shard
+def round_robin_partition(num_experiments, num_shards):
+    return [list(range(shard, num_experiments, num_shards)) for shard in range(num_shards)]
+
+
+# Assign experiments to shards of at most ceil(# experiments / num_shards) experiments so that similar experiments
+# share a shard. The most dissimilar experiments (farthest-first traversal of the similarity matrix of the first
+# bits_to_check bits of the leaf filters) seed the shards, and the other experiments join the most similar seed whose
+# shard has room, most similar experiments first. Returns the experiment indices of every shard
+def cluster_partition(nodes, num_shards, bits_to_check):
+    capacity = -(-len(nodes) // num_shards)
+    similarities = PairwiseSimilarity(nodes, bits_to_check).matrix()
+    np.fill_diagonal(similarities, np.inf)
+    seeds = [0]
+    nearest = similarities[0].copy()  # Similarity of every experiment to its most similar seed
+    while len(seeds) < min(num_shards, len(nodes)):
+        candidates = nearest.copy()
+        candidates[seeds] = np.inf
+        seeds.append(int(candidates.argmin()))
+        nearest = np.maximum(nearest, similarities[seeds[-1]])
+    seed_similarities = similarities[:, seeds]
+    shards = [[] for _ in range(num_shards)]
+    for experiment in np.argsort(-seed_similarities.max(axis=1), kind="stable"):
+        for shard in np.argsort(-seed_similarities[experiment], kind="stable"):
+            if len(shards[shard]) < capacity:
+                shards[shard].append(int(experiment))
+                break
+    return [sorted(shard) for shard in shards]
+
+
+# Main loop of a shard process. Answers the coordinator's (command, arguments) messages with ("ok", result) or
+# ("error", exception) until it receives "close"
+def run_shard(connection):
+    sbt = None
+    command, args = connection.recv()
+    while command != "close":
+        try:
+            result = None
+            if command == "create":
+                sbt = SBT(**args)
+            elif command == "open":
+                file_name, file_format, similarity_function = args
+                sbt = SBT.open_index(file_name, similarity_function) if file_format == "index" else SBT.load(file_name)
+            elif command == "insert":  # Build the leaves of sequences or sequence files and insert them
+                sources, experiment_names, from_file, method, bits_to_check = args
+                sbt.insert_nodes(sbt.build_leaves(sources, experiment_names, from_file), method, bits_to_check)
+            elif command == "insert_packed":  # Insert leaves built by the coordinator, sent as packed filters
+                packed_filters, experiment_names, method, bits_to_check = args
+                sbt.insert_nodes(sbt.nodes_from_packed(packed_filters, experiment_names), method, bits_to_check)
+            elif command == "query":
+                if sbt.root is None and sbt.flat is None:  # Empty shard
+                    result = [[] for _ in args]
+                else:
+                    result = sbt.query_batch(args)
+            elif command == "save":
+                file_name, file_format = args
+                sbt.save_index(file_name) if file_format == "index" else sbt.save(file_name)
+            else:
+                raise ValueError("Unknown shard command " + str(command))
+            connection.send(("ok", result))
+        except Exception as error:  # Send the error to the coordinator, which raises it
+            connection.send(("error", error))
+        command, args = connection.recv()
+    connection.close()
+
+
+class ShardedSBT(object):
+    def __init__(self, num_shards, k, bloom_filter_length, hash_functions, threshold, similarity_function,
+                 sbt_type="Base", hash_fraction=1):
+        if num_shards < 1:
+            raise ValueError("A sharded SBT needs at least one shard")
+        self.num_shards = num_shards
+        self.sbt_args = dict(k=k, bloom_filter_length=bloom_filter_length, hash_functions=hash_functions,
+                             threshold=threshold, similarity_function=similarity_function, sbt_type=sbt_type,
+                             hash_fraction=hash_fraction)
+        self.shard_names = [[] for _ in range(num_shards)]  # Experiment names in every shard
+        self.connections = []
+        self.processes = []
+        self.start([("create", self.sbt_args)] * num_shards)
+
+    """ Start one process per shard and send each its first command (creating or opening its SBT) """
+    def start(self, first_commands):
+        for first_command in first_commands:
+            connection, shard_connection = Pipe()
+            process = Process(target=run_shard, args=(shard_connection,), daemon=True)
+            process.start()
+            shard_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.gather(first_commands)
+
+    """ Send one (command, arguments) message to every shard, then wait for all of them. Returns the result of every
+    shard and raises the first error of a shard """
+    def gather(self, messages):
+        for connection, message in zip(self.connections, messages):
+            connection.send(message)
+        replies = [connection.recv() for connection in self.connections]
+        for status, result in replies:
+            if status == "error":
+                raise result
+        return [result for _, result in replies]
+
+    """ All experiment names, shard by shard """
+    def experiment_names(self):
+        return [name for names in self.shard_names for name in names]
+
+    """ Insert experiments into the shards (see SBT.insert_nodes() for the methods). Sources are sequences, or
+    sequence files if from_file. With the "round_robin" partition every shard process builds its own leaves, with the
+    "cluster" partition the leaves are built first (in num_shards processes) to compare them """
+    def insert(self, sources, experiment_names, from_file=False, method="Cluster2", bits_to_check=None,
+               partition="round_robin"):
+        if partition not in PARTITIONS:
+            raise ValueError("Partition should be round_robin or cluster")
+        sources = list(sources)
+        experiment_names = list(experiment_names)
+        if partition == "cluster":
+            if self.sbt_args["hash_functions"] is None:
+                raise ValueError("The hash functions of pickled shards are unknown, use the round_robin partition")
+            nodes = SBT(**self.sbt_args).build_leaves(sources, experiment_names, from_file, self.num_shards)
+            shards = cluster_partition(nodes, self.num_shards, bits_to_check)
+            messages = [("insert_packed", ([getattr(nodes[i], nodes[i].filter_names[0]).tobytes() for i in shard],
+                                           [experiment_names[i] for i in shard], method, bits_to_check))
+                        for shard in shards]
+        else:
+            shards = round_robin_partition(len(sources), self.num_shards)
+            messages = [("insert", ([sources[i] for i in shard], [experiment_names[i] for i in shard], from_file,
+                                    method, bits_to_check)) for shard in shards]
+        # Shards that get no new experiments are only asked to answer an empty query
+        self.gather([message if shard else ("query", []) for message, shard in zip(messages, shards)])
+        for names, shard in zip(self.shard_names, shards):
+            names.extend(experiment_names[i] for i in shard)
+
+    """ Insert sequences (see insert()) """
+    def insert_sequences(self, sequences, experiment_names, method="Cluster2", bits_to_check=None,
+                         partition="round_robin"):
+        self.insert(sequences, experiment_names, False, method, bits_to_check, partition)
+
+    """ Insert sequence files (see insert() and SBT.node_from_file()) """
+    def insert_files(self, file_names, experiment_names, method="Cluster2", bits_to_check=None,
+                     partition="round_robin"):
+        self.insert(file_names, experiment_names, True, method, bits_to_check, partition)
+
+    """ Query a batch of sequences on all shards at once (SBT.query_batch() in every shard process). Returns a list with
+    the names of the matching experiments of each sequence, shard by shard """
+    def query_batch(self, sequences):
+        sequences = list(sequences)
+        shard_results = self.gather([("query", sequences)] * self.num_shards)
+        return [[name for results in shard_results for name in results[query_index]]
+                for query_index in range(len(sequences))]
+
+    """ Query one sequence on all shards """
+    def fast_query_sequence(self, sequence):
+        return self.query_batch([sequence])[0]
+
+    """ Save every shard into directory together with a manifest (see open()) """
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        hash_functions = self.sbt_args["hash_functions"]
+        indexable = hash_functions is not None and all(isinstance(hash_function, KmerHasher)
+                                                       for hash_function in hash_functions)
+        shards = []
+        for shard, names in enumerate(self.shard_names):
+            file_format = "index" if indexable and names else "pickle"  # Empty trees cannot be saved as an index
+            shards.append({"file": "shard" + str(shard) + (".sbtindex" if file_format == "index" else ".pickle"),
+                           "format": file_format, "names": names})
+        self.gather([("save", (os.path.join(directory, shard["file"]), shard["format"])) for shard in shards])
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "num_shards": self.num_shards,
+            "k": self.sbt_args["k"],
+            "bloom_filter_length": self.sbt_args["bloom_filter_length"],
+            "threshold": self.sbt_args["threshold"],
+            "sbt_type": self.sbt_args["sbt_type"],
+            "hash_fraction": self.sbt_args["hash_fraction"],
+            "hash_seeds": [hash_function.seed for hash_function in hash_functions] if indexable else None,
+            "shards": shards,
+        }
+        with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+    """ Open a sharded SBT saved with save(). Every shard is opened by its own process. The similarity function is not
+    stored in index files, so it has to be given to insert more experiments """
+    @staticmethod
+    def open(directory, similarity_function=None):
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest["version"] > MANIFEST_VERSION:
+            raise ValueError(directory + " has manifest version " + str(manifest["version"]) + ", which is newer than "
+                             "this version of the SBT can read (" + str(MANIFEST_VERSION) + ")")
+        sharded = ShardedSBT.__new__(ShardedSBT)
+        sharded.num_shards = manifest["num_shards"]
+        sharded.shard_names = [shard["names"] for shard in manifest["shards"]]
+        sharded.connections = []
+        sharded.processes = []
+        sharded.start([("open", (os.path.join(directory, shard["file"]), shard["format"], similarity_function))
+                       for shard in manifest["shards"]])
+        # Other hash functions than KmerHashers are only stored in the pickles of the shards
+        hash_functions = None
+        if manifest["hash_seeds"] is not None:
+            hash_functions = [KmerHasher(seed) for seed in manifest["hash_seeds"]]
+        sharded.sbt_args = dict(k=manifest["k"], bloom_filter_length=manifest["bloom_filter_length"],
+                                hash_functions=hash_functions, threshold=manifest["threshold"],
+                                similarity_function=similarity_function, sbt_type=manifest["sbt_type"],
+                                hash_fraction=manifest["hash_fraction"])
+        return sharded
+
+    """ Stop the shard processes """
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                connection.send(("close", None))
+            process.join()
+            connection.close()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,81 @@
+""" Compressed Bloom filter for sparse filters. Below the root, the sim/rem filters of a Split-SBT and the how/det
+filters of a HowDe-SBT have very few bits set, but a bitarray always costs bloom_filter_length bits. A SparseFilter
+stores only the sorted positions of its set bits (the array container of a roaring bitmap), so a filter with a density
+below 1 / (bits per position) takes less memory. Bits are looked up with binary search (np.searchsorted) and the filter
+is never decompressed to answer a query """
+from bitarray import bitarray
+import numpy as np
+
+DEFAULT_MAX_DENSITY = 1 / 64  # Filters at most this dense are compressed by default (half the size of a bitarray)
+
+
+class SparseFilter(object):
+    __slots__ = ("length", "positions")
+
+    def __init__(self, length, positions):
+        self.length = length
+        self.positions = positions  # Sorted positions of the set bits
+
+    """ Compress a bitarray (big endian) """
+    @staticmethod
+    def from_bitarray(bloom_filter):
+        bits = np.unpackbits(np.frombuffer(bloom_filter, dtype=np.uint8), count=len(bloom_filter))
+        dtype = np.uint32 if len(bloom_filter) <= 1 << 32 else np.uint64
+        return SparseFilter(len(bloom_filter), np.flatnonzero(bits).astype(dtype))
+
+    """ Decompress into a bitarray """
+    def to_bitarray(self):
+        bits = np.zeros(self.length, dtype=bool)
+        bits[self.positions] = True
+        bloom_filter = bitarray(endian="big")
+        bloom_filter.frombytes(np.packbits(bits).tobytes())
+        del bloom_filter[self.length:]
+        return bloom_filter
+
+    """ Decompress into a packed (big endian) uint8 array """
+    def to_packed(self):
+        bits = np.zeros(self.length, dtype=bool)
+        bits[self.positions] = True
+        return np.packbits(bits)
+
+    """ Number of set bits before every index in filter_indices """
+    def rank(self, filter_indices):
+        return np.searchsorted(self.positions, np.asarray(filter_indices).astype(self.positions.dtype))
+
+    """ Look up the bits at every index in filter_indices (see bits.get_bits). Returns a bool array with the same shape
+    as filter_indices """
+    def get_bits(self, filter_indices):
+        if len(self.positions) == 0:
+            return np.zeros(np.shape(filter_indices), dtype=bool)
+        ranks = np.minimum(self.rank(filter_indices), len(self.positions) - 1)
+        return self.positions[ranks] == filter_indices
+
+    """ Number of set bits """
+    def count(self):
+        return len(self.positions)
+
+    """ Number of bytes used by the positions """
+    def nbytes(self):
+        return self.positions.nbytes
+
+    def __getitem__(self, index):
+        rank = self.positions.searchsorted(index)
+        return bool(rank < len(self.positions) and self.positions[rank] == index)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.to_bitarray())
+
+
+# Replace a bitarray filter with a SparseFilter if at most max_density of its bits are set. None stays None
+def compress_filter(bloom_filter, max_density=DEFAULT_MAX_DENSITY):
+    if isinstance(bloom_filter, bitarray) and bloom_filter.count() <= max_density * len(bloom_filter):
+        return SparseFilter.from_bitarray(bloom_filter)
+    return bloom_filter
+
+
+# Turn a SparseFilter back into a bitarray. bitarrays and None are returned unchanged
+def decompress_filter(bloom_filter):
+    return bloom_filter.to_bitarray() if isinstance(bloom_filter, SparseFilter) else bloom_filter
@@ -0,0 +1,195 @@
+""" Reproducible benchmark suite (run with benchmark.py). Seeded synthetic genomes are written as FASTA files, and every
+combination of sbt_type and insert_method is benchmarked in a fresh process: the files are read, hashed into leaves,
+inserted, queried with every query_method, saved and loaded again. Every phase is timed with time.perf_counter() and
+its peak of traced memory (tracemalloc, memory allocated on top of what was already allocated when the phase started)
+is recorded along with the peak RSS of the case's process. The results are one JSON document, which can be compared
+against a stored baseline with compare_results() to catch regressions """
+from SBT.SBT import SBT
+from SBT.KmerHasher import KmerHasher, ENCODING
+from SBT.sequence_reader import read_sequence
+from SBT.genome_simulator import write_fasta, BASES
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import tracemalloc
+import platform
+import resource
+import json
+import time
+import sys
+import os
+
+RESULTS_VERSION = 1
+
+
+# Write num_sequences seeded synthetic genomes of sequence_len bases as FASTA files into directory. The genomes belong
+# to num_families random reference genomes and differ from their reference by SNPs at a rate of snp_rate, like strains
+# of a few species. Returns the file names
+def generate_sequences(directory, num_sequences, sequence_len, num_families, snp_rate, seed):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    references = rng.integers(0, 4, size=(num_families, sequence_len), dtype=np.uint8)
+    file_names = []
+    for number in range(num_sequences):
+        codes = references[number % num_families].copy()
+        snps = np.flatnonzero(rng.random(sequence_len) < snp_rate)
+        codes[snps] = (codes[snps] + rng.integers(1, 4, size=len(snps), dtype=np.uint8)) % 4  # Always a new base
+        file_name = os.path.join(directory, "sequence" + str(number) + ".fa")
+        write_fasta(file_name, "sequence" + str(number), BASES[codes].tobytes())
+        file_names.append(file_name)
+    return file_names
+
+
+# Draw num_queries seeded queries of query_size bases from random places of the sequences, each with query_snps SNPs
+def generate_queries(sequences, num_queries, query_size, query_snps, seed):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(num_queries):
+        sequence = sequences[rng.integers(len(sequences))]
+        start = int(rng.integers(0, len(sequence) - query_size + 1))
+        codes = ENCODING[np.frombuffer(sequence[start:start + query_size].encode(), dtype=np.uint8)]
+        snps = rng.integers(0, query_size, size=query_snps)
+        codes[snps] = (codes[snps] + rng.integers(1, 4, size=query_snps, dtype=np.uint8)) % 4
+        queries.append(BASES[codes].tobytes().decode())
+    return queries
+
+
+# JSON-friendly description of a parameter (hash functions by their seeds, functions by their names)
+def describe(value):
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    if isinstance(value, KmerHasher):
+        return "KmerHasher(" + str(value.seed) + ")"
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return getattr(value, "__name__", repr(value))
+
+
+# Time one phase of a case. Returns the phase's result and records its time and peak traced memory in phases
+def measure(phases, name, function, *args):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function(*args)
+    phases[name] = {"time": time.perf_counter() - start}
+    if tracing:
+        phases[name]["peak_memory"] = tracemalloc.get_traced_memory()[1] - start_memory
+    return result
+
+
+# Query every sequence with one query method. Returns the number of matches of every query
+def run_queries(sbt, queries, query_method):
+    if query_method == "Batch":
+        return [len(matches) for matches in sbt.query_batch(queries)]
+    query = sbt.query_sequence if query_method == "Normal" else sbt.fast_query_sequence
+    return [len(query(sequence)) for sequence in queries]
+
+
+# Benchmark one sbt_type and insert_method (see the module docstring). Runs in its own process (see run_suite()), so
+# the peak RSS and the memory traced belong to this case only
+def run_case(p, sbt_type, insert_method, file_names, queries, directory):
+    if p["trace_memory"]:
+        tracemalloc.start()
+    phases = {}
+    sbt = SBT(k=p["k"], bloom_filter_length=p["bloom_filter_length"], hash_functions=p["hash_functions"],
+              threshold=p["threshold"], similarity_function=p["similarity_function"], sbt_type=sbt_type,
+              hash_fraction=p["hash_fraction"])
+    sequences = measure(phases, "read", lambda: [read_sequence(file_name) for file_name in file_names])
+    names = [os.path.basename(file_name) for file_name in file_names]
+    nodes = measure(phases, "hash", sbt.nodes_from_sequences, sequences, names, p["workers"])
+    del sequences
+    measure(phases, "build", sbt.insert_nodes, nodes, insert_method, p["bits_to_check"])
+    del nodes
+    matches = {}
+    for query_method in p["query_methods"]:
+        matches[query_method] = measure(phases, "query_" + query_method, run_queries, sbt, queries, query_method)
+    # Index files need KmerHashers, other hash functions are pickled
+    indexable = all(isinstance(hash_function, KmerHasher) for hash_function in p["hash_functions"])
+    file_name = os.path.join(directory, sbt_type + "_" + insert_method + (".sbtindex" if indexable else ".pickle"))
+    measure(phases, "save", sbt.save_index if indexable else sbt.save, file_name)
+    measure(phases, "load", SBT.open_index if indexable else SBT.load, file_name)
+    if p["trace_memory"]:
+        tracemalloc.stop()
+    return {
+        "phases": phases,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "height": sbt.height(),
+        "file_size": os.path.getsize(file_name),
+        "matches": {query_method: int(np.sum(counts)) for query_method, counts in matches.items()},
+    }
+
+
+# Run the whole suite with the parameters p (see benchmark.py) in directory. Every case runs in a fresh process.
+# Returns the results (parameters, environment and the phases of every case, keyed "sbt_type/insert_method")
+def run_suite(p, directory):
+    start = time.perf_counter()
+    file_names = generate_sequences(os.path.join(directory, "data"), p["num_sequences"], p["sequence_len"],
+                                    p["num_families"], p["snp_rate"], p["seed"])
+    generate_time = time.perf_counter() - start
+    queries = generate_queries([read_sequence(file_name) for file_name in file_names], p["num_queries"],
+                               p["query_size"], p["query_snps"], p["seed"] + 1)
+    cases = {}
+    for sbt_type in p["sbt_types"]:
+        for insert_method in p["insert_methods"]:
+            # A fresh (spawned, not forked) process for every case
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                cases[sbt_type + "/" + insert_method] = executor.submit(
+                    run_case, p, sbt_type, insert_method, file_names, queries, directory).result()
+    return {
+        "version": RESULTS_VERSION,
+        "params": {key: describe(value) for key, value in p.items()},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                        "processor": platform.processor()},
+        "generate_time": generate_time,
+        "cases": cases,
+    }
+
+
+# Write results as JSON
+def save_results(results, file_name):
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(file_name, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+# Read results written by save_results()
+def load_results(file_name):
+    with open(file_name) as f:
+        results = json.load(f)
+    if results["version"] > RESULTS_VERSION:
+        raise ValueError(file_name + " has results version " + str(results["version"]) + ", which is newer than this "
+                         "version of the benchmark can read (" + str(RESULTS_VERSION) + ")")
+    return results
+
+
+# Compare results against a baseline run of the same cases. A phase regressed if it got more than tolerance (a
+# fraction) slower and more than min_time seconds slower, or if its peak memory grew by more than tolerance and more
+# than min_memory bytes. Changed match counts are reported too, since they mean the query results changed. Returns a
+# list of messages, empty if nothing regressed
+def compare_results(results, baseline, tolerance=0.25, min_time=0.01, min_memory=1 << 20):
+    regressions = []
+    for case, result in results["cases"].items():
+        if case not in baseline["cases"]:
+            continue
+        baseline_result = baseline["cases"][case]
+        for phase, measurement in result["phases"].items():
+            baseline_measurement = baseline_result["phases"].get(phase)
+            if baseline_measurement is None:
+                continue
+            for key, minimum in (("time", min_time), ("peak_memory", min_memory)):
+                if key not in measurement or key not in baseline_measurement:
+                    continue
+                new, old = measurement[key], baseline_measurement[key]
+                if new > old * (1 + tolerance) and new - old > minimum:
+                    regressions.append("{} {} {}: {:.6g} -> {:.6g} ({:+.0%})".format(
+                        case, phase, key, old, new, new / old - 1 if old else float("inf")))
+        for query_method, matches in result["matches"].items():
+            baseline_matches = baseline_result["matches"].get(query_method)
+            if baseline_matches is not None and matches != baseline_matches:
+                regressions.append("{} query_{} matches: {} -> {}".format(case, query_method, baseline_matches,
+                                                                         matches))
+    return regressions
@@ -0,0 +1,37 @@
+""" Helpers for moving between bitarray Bloom filters and NumPy arrays of filter indices """
+from bitarray import bitarray
+from SBT.SparseFilter import SparseFilter
+import numpy as np
+
+
+# Build a bitarray of the given length from a packed (big endian) uint8 array
+def packed_to_bitarray(packed, length):
+    bloom_filter = bitarray(endian="big")
+    bloom_filter.frombytes(packed.tobytes())
+    del bloom_filter[length:]
+    return bloom_filter
+
+
+# Build a bitarray of the given length with the bits at every index in filter_indices set
+def indices_to_bitarray(filter_indices, length):
+    bits = np.zeros(length, dtype=bool)
+    bits[np.asarray(filter_indices, dtype=np.int64).ravel()] = True
+    return packed_to_bitarray(np.packbits(bits), length)
+
+
+# Packed (big endian) uint8 array of the bits of a bitarray or SparseFilter. The pad bits past the end of the filter
+# are zero (the buffer of a bitarray leaves them uninitialized, so it is copied with tobytes())
+def packed_bits(bloom_filter):
+    if isinstance(bloom_filter, SparseFilter):
+        return bloom_filter.to_packed()
+    return np.frombuffer(bloom_filter.tobytes(), dtype=np.uint8)
+
+
+# Look up the bits of a bitarray (big endian), a packed uint8 array or a SparseFilter at every index in filter_indices
+# with one vectorized gather. Returns a bool array with the same shape as filter_indices
+def get_bits(bloom_filter, filter_indices):
+    if isinstance(bloom_filter, SparseFilter):
+        return bloom_filter.get_bits(filter_indices)
+    packed = bloom_filter if isinstance(bloom_filter, np.ndarray) else np.frombuffer(bloom_filter, dtype=np.uint8)
+    shifts = (7 - (filter_indices & 7)).astype(np.uint8)
+    return ((packed[filter_indices >> 3] >> shifts) & 1).astype(bool)
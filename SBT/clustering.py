@@ -0,0 +1,354 @@
+""" Agglomerative clustering engine behind the cluster insertion methods. The similarity of every pair of nodes is
+computed once: for the similarity functions in similarity, which only depend on the number of bits set in each filter
+and in their intersection, the whole matrix comes from one matrix product over the unpacked bits. The most similar pair
+is then found from every node's most similar partner, and after a merge only the row of the new parent is computed, so
+building a tree of n experiments takes O(n^2) similarity computations instead of O(n^3). The partners that a merge makes
+stale are found again in O(log n) with a tree of the rows' maxima over blocks of columns (BestColumns), so the merges
+take O(n log n) work each and clustering O(n^2 log n) in all. For collections whose similarity matrix does not fit in
+memory, bounded_round_pairs() pairs one round within a memory budget from a block of rows of the matrix at a time """
+from SBT.similarity import popcounts, tie_break_state, set_tie_break_state
+import numpy as np
+import heapq
+
+MATRIX_BYTES = 1 << 26  # Bytes of unpacked bits multiplied at once when computing a similarity matrix
+BLOCK_COLUMNS = 16  # Columns of the similarity matrix summarized by one leaf of a BestColumns tree
+SCAN_ELEMENTS = 1 << 16  # BestColumns scans the rows directly if they have at most this many elements in all
+BLOCK_ELEMENT_BYTES = 96  # Working bytes per element of a block of rows of the similarity matrix (bounded_round_pairs)
+CANDIDATE_BYTES = 128  # Working bytes per candidate partner of a filter while blocks are merged into the candidates
+PAIRING_SHARES = 3  # Parts of the budget of bounded_round_pairs(): unpacked bits, a block of rows and the candidates
+
+
+# (# filters x # filters) similarity matrix of a packed matrix of filters under a similarity.CountSimilarity function.
+# The intersection counts come from a matrix product of the unpacked bits, a block of columns at a time (float32
+# products are exact up to 2^24 bits per block), so packed can be a memory-mapped matrix larger than memory. The
+# diagonal is -inf
+def similarity_matrix(packed, similarity_function, matrix_bytes=MATRIX_BYTES):
+    num_filters = len(packed)
+    intersections = np.zeros((num_filters, num_filters), dtype=np.int64)
+    block = max(1, min(matrix_bytes // (32 * max(num_filters, 1)), (1 << 24) // 8))
+    for start in range(0, packed.shape[1], block):
+        bits = np.unpackbits(np.asarray(packed[:, start:start + block]), axis=1).astype(np.float32)
+        intersections += np.rint(bits @ bits.T).astype(np.int64)
+    sizes = np.diagonal(intersections).copy()  # A filter's intersection with itself is its set bit count
+    similarities = similarity_function.from_counts(sizes[:, None], sizes[None, :], intersections)
+    lower = np.tril_indices(num_filters, -1)
+    similarities[lower] = similarities.T[lower]  # Same tie-breaking perturbation for both orders of a pair
+    np.fill_diagonal(similarities, -np.inf)
+    return similarities
+
+
+# Similarities between the nodes being clustered. Nodes are compared on the first bits_to_check bits of their first
+# filter (see the node classes' similarity()). If the similarity function is computed from set bit counts (one of the
+# similarity.CountSimilarity functions), the filters are kept as a packed matrix and compared with popcounts, otherwise
+# node.similarity() is called for every pair
+class PairwiseSimilarity(object):
+    def __init__(self, nodes, bits_to_check):
+        self.bits_to_check = bits_to_check
+        self.nodes = list(nodes)
+        self.similarity_function = self.nodes[0].similarity_function if self.nodes else None
+        self.count_similarity = hasattr(self.similarity_function, "from_counts")
+        if self.count_similarity:
+            self.packed = np.array([self.packed_filter(node) for node in self.nodes]).reshape(len(self.nodes), -1)
+            self.sizes = popcounts(self.packed)
+
+    """ Packed bits of the part of a node's filter that is compared (the pad bits are zero) """
+    def packed_filter(self, node):
+        bloom_filter = getattr(node, node.filter_names[0])
+        num_bits = len(bloom_filter) if self.bits_to_check is None else min(self.bits_to_check, len(bloom_filter))
+        return np.packbits(np.unpackbits(np.frombuffer(bloom_filter, dtype=np.uint8), count=num_bits))
+
+    """ (# nodes x # nodes) similarity matrix. The diagonal is -inf """
+    def matrix(self):
+        num_nodes = len(self.nodes)
+        if not self.count_similarity:
+            similarities = np.full((num_nodes, num_nodes), -np.inf)
+            for index1 in range(num_nodes):
+                for index2 in range(index1 + 1, num_nodes):
+                    similarities[index1, index2] = self.nodes[index1].similarity(self.nodes[index2], self.bits_to_check)
+                    similarities[index2, index1] = similarities[index1, index2]
+            return similarities
+        return similarity_matrix(self.packed, self.similarity_function)
+
+    """ Replace the node at position index with a new node. Returns its similarity to every node whose position is set
+    in compared (-inf to the others and to itself) """
+    def replace(self, index, node, compared):
+        self.nodes[index] = node
+        if not self.count_similarity:
+            return np.array([node.similarity(other, self.bits_to_check) if compared[other_index] else -np.inf
+                             for other_index, other in enumerate(self.nodes)])
+        self.packed[index] = self.packed_filter(node)
+        self.sizes[index] = popcounts(self.packed[index])
+        row = self.similarity_function.one_vs_matrix(self.packed[index], self.packed, matrix_counts=self.sizes)
+        row[~compared] = -np.inf
+        return row
+
+
+# Most similar column of any row of a symmetric similarity matrix, kept up to date as the matrix changes. The columns
+# are cut into blocks of BLOCK_COLUMNS and a binary tree over the blocks holds every row's maximum under each tree node
+# (one row of maxima per tree node and one value per matrix row, so a change to a column updates one contiguous vector
+# per level, and the tree takes about 2 n^2 / BLOCK_COLUMNS values). Updating a column costs O(n (BLOCK_COLUMNS +
+# log n)) and finding a row's best column O(BLOCK_COLUMNS + log n). Ties go to the leftmost column, like numpy's
+# argmax()
+class BestColumns(object):
+    def __init__(self, similarities):
+        self.similarities = similarities
+        num_blocks = max(1, -(-len(similarities) // BLOCK_COLUMNS))
+        self.size = 1 << (num_blocks - 1).bit_length()  # Number of leaves of the tree (blocks padded with -inf)
+        self.maxima = np.full((2 * self.size, len(similarities)), -np.inf)
+        for block in range(num_blocks):
+            self.maxima[self.size + block] = self.block_maxima(block)
+        for node in range(self.size - 1, 0, -1):
+            np.maximum(self.maxima[2 * node], self.maxima[2 * node + 1], out=self.maxima[node])
+
+    """ Maximum of every row over the columns of a block. The matrix is symmetric, so the columns of a block are the
+    contiguous rows of the same block """
+    def block_maxima(self, block):
+        return self.similarities[block * BLOCK_COLUMNS:(block + 1) * BLOCK_COLUMNS].max(axis=0)
+
+    """ Update the tree after column index of the matrix (and row index, by symmetry) changed. The maxima of a removed
+    row are left as they are, since its best column is not asked for anymore """
+    def update(self, index, removed=False):
+        block = index // BLOCK_COLUMNS
+        node = self.size + block
+        self.maxima[node] = self.block_maxima(block)
+        while node > 1:
+            node //= 2
+            np.maximum(self.maxima[2 * node], self.maxima[2 * node + 1], out=self.maxima[node])
+        if removed:
+            return
+        # The row's maxima over every block and tree node, one level at a time
+        padded = np.full(self.size * BLOCK_COLUMNS, -np.inf)
+        padded[:len(self.similarities)] = self.similarities[index]
+        level = padded.reshape(self.size, BLOCK_COLUMNS).max(axis=1)
+        start = self.size
+        while start >= 1:
+            self.maxima[start:2 * start, index] = level
+            level = np.maximum(level[0::2], level[1::2])
+            start //= 2
+
+    """ Leftmost most similar column of every row in rows """
+    def best(self, rows):
+        num_rows = len(self.similarities)
+        if len(rows) * num_rows <= SCAN_ELEMENTS:
+            return self.similarities[rows].argmax(axis=1)
+        maxima = self.maxima.reshape(-1)
+        positions = num_rows + rows  # Position of every row's maximum under the root (node 1) in the flat maxima
+        for _ in range(self.size.bit_length() - 1):
+            positions = 2 * positions - rows  # Left child
+            positions += num_rows * (maxima[positions + num_rows] > maxima[positions])  # Right child if larger
+        blocks = positions // num_rows - self.size
+        # Columns past the end of the matrix are clipped to the last one, which comes first in its block
+        columns = np.minimum(blocks[:, None] * BLOCK_COLUMNS + np.arange(BLOCK_COLUMNS), num_rows - 1)
+        values = self.similarities.reshape(-1)[rows[:, None] * num_rows + columns]
+        return columns[np.arange(len(rows)), values.argmax(axis=1)]
+
+
+# Repeatedly join the two most similar of the remaining subtrees (including the parents created so far) under a new
+# parent node_class.from_children(left, right) until one tree remains (Clustering Method 1). Every subtree keeps its
+# most similar partner, so the most similar pair is found with one argmax over the subtrees instead of a scan over all
+# pairs. A parent takes the position of one of its children and only its row of the similarity matrix is computed. The
+# subtrees whose partner was merged find their new partner in BestColumns, so every merge takes O(n log n) work.
+# Returns the root
+def cluster_pairs(nodes, node_class, bits_to_check):
+    nodes = list(nodes)
+    if len(nodes) <= 1:
+        return nodes[0] if nodes else None
+    pairwise = PairwiseSimilarity(nodes, bits_to_check)
+    similarities = pairwise.matrix()
+    positions = np.arange(len(nodes))
+    alive = np.ones(len(nodes), dtype=bool)
+    created = list(range(len(nodes)))  # Creation order of the node at every position (older nodes become left children)
+    best_columns = BestColumns(similarities)
+    best = similarities.argmax(axis=1)  # Most similar partner of every node
+    best_similarities = similarities[positions, best]  # -inf for removed nodes
+    for merge in range(len(nodes) - 1):
+        index1 = int(best_similarities.argmax())
+        index2 = int(best[index1])
+        if created[index1] > created[index2]:
+            index1, index2 = index2, index1
+        parent = node_class.from_children(pairwise.nodes[index1], pairwise.nodes[index2])
+        # The parent replaces the left child, the right child is removed
+        alive[index2] = False
+        similarities[index2, :] = -np.inf
+        similarities[:, index2] = -np.inf
+        best_similarities[index2] = -np.inf
+        compared = alive.copy()
+        compared[index1] = False
+        row = pairwise.replace(index1, parent, compared)
+        similarities[index1, :] = row
+        similarities[:, index1] = row
+        created[index1] = len(nodes) + merge
+        best_columns.update(index2, removed=True)
+        best_columns.update(index1)
+        # Update the best partner of the parent, of the nodes whose best partner was merged and of the nodes that are
+        # more similar to the parent than to their best partner
+        stale = alive & ((best == index1) | (best == index2))
+        stale[index1] = True
+        best[stale] = best_columns.best(np.flatnonzero(stale))
+        best_similarities[stale] = similarities[stale, best[stale]]
+        closer = alive & ~stale & (row > best_similarities)
+        best[closer] = index1
+        best_similarities[closer] = row[closer]
+    return pairwise.nodes[int(np.flatnonzero(alive)[0])]
+
+
+# Pairs of one round of Clustering Method 2 given the similarity matrix of the remaining subtrees: the most similar
+# pairs first, until every subtree but possibly one is paired. Returns the (left, right) positions of the pairs in the
+# order they were made and the mask of the paired subtrees
+def round_pairs(similarities):
+    index1, index2 = np.triu_indices(len(similarities), 1)
+    order = np.argsort(-similarities[index1, index2], kind="stable")
+    matched = np.zeros(len(similarities), dtype=bool)
+    pairs = []
+    for pair in order:
+        if not matched[index1[pair]] and not matched[index2[pair]]:
+            pairs.append((int(index1[pair]), int(index2[pair])))
+            matched[index1[pair]] = matched[index2[pair]] = True
+            if len(pairs) == len(similarities) // 2:
+                break
+    return pairs, matched
+
+
+# Pair up all remaining subtrees, most similar pairs first, before any of the new parents are paired again (Clustering
+# Method 2). Every round computes one similarity matrix and sorts its pairs once. Returns the root
+def cluster_rounds(nodes, node_class, bits_to_check):
+    nodes = list(nodes)
+    while len(nodes) > 1:
+        pairs, matched = round_pairs(PairwiseSimilarity(nodes, bits_to_check).matrix())
+        parent_nodes = [node_class.from_children(nodes[index1], nodes[index2]) for index1, index2 in pairs]
+        nodes = [node for node, node_matched in zip(nodes, matched) if not node_matched] + parent_nodes
+    return nodes[0] if nodes else None
+
+
+# Smallest memory budget that bounded_round_pairs() can pair num_filters filters within
+def min_pairing_budget(num_filters):
+    return PAIRING_SHARES * max(BLOCK_ELEMENT_BYTES, CANDIDATE_BYTES) * num_filters
+
+
+# (# rows x # columns) numbers of bits set in both a row and a column (lists of row numbers of a packed matrix of
+# filters, which can be memory-mapped), from matrix products of their unpacked bits a block of bytes at a time like
+# similarity_matrix(). About matrix_bytes bytes of unpacked bits are held at once
+def intersection_counts(packed, rows, columns, matrix_bytes=MATRIX_BYTES):
+    counts = np.zeros((len(rows), len(columns)), dtype=np.int64)
+    block = max(1, min(matrix_bytes // (48 * (len(rows) + len(columns))), (1 << 24) // 8))
+    for start in range(0, packed.shape[1], block):
+        row_bits = np.unpackbits(np.asarray(packed[rows, start:start + block]), axis=1).astype(np.float32)
+        column_bits = np.unpackbits(np.asarray(packed[columns, start:start + block]), axis=1).astype(np.float32)
+        counts += np.rint(row_bits @ column_bits.T).astype(np.int64)
+    return counts
+
+
+# Keep the num_candidates best of the candidate partners of every row (the most similar first, ties to the lowest
+# partner, which is the order of round_pairs() among the pairs of one filter). Missing candidates are -inf and -1
+def best_candidates(similarities, partners, num_candidates):
+    order = np.lexsort((partners, -similarities))[:, :num_candidates]
+    return np.take_along_axis(similarities, order, 1), np.take_along_axis(partners, order, 1)
+
+
+# The num_candidates best partners among the remaining filters (a bool mask) of every remaining filter, as a pair of
+# (# filters x num_candidates) arrays of similarities and partners (see best_candidates()). The similarity matrix is
+# computed a block of block_rows rows at a time, in the order similarity_matrix() draws its tie-breaking perturbations
+# in, and every pair is scored by its row in the upper triangle like in similarity_matrix(). The bits of the remaining
+# filters are unpacked once if they fit in matrix_bytes and a block of bytes at a time for every block otherwise
+def candidate_partners(packed, similarity_function, sizes, remaining, num_candidates, block_rows, matrix_bytes):
+    num_filters = len(packed)
+    similarities = np.full((num_filters, num_candidates), -np.inf)
+    partners = np.full((num_filters, num_candidates), -1, dtype=np.int64)
+    columns = np.flatnonzero(remaining)
+    unpacked = None
+    if 48 * len(columns) * packed.shape[1] <= matrix_bytes and packed.shape[1] <= (1 << 24) // 8:
+        unpacked = np.unpackbits(np.asarray(packed[columns]), axis=1).astype(np.float32)
+    for start in range(0, num_filters, block_rows):
+        stop = min(num_filters, start + block_rows)
+        rows = columns[(columns >= start) & (columns < stop)]
+        intersections = np.zeros((stop - start, num_filters), dtype=np.int64)
+        if len(rows) and unpacked is not None:
+            positions = np.searchsorted(columns, rows)
+            intersections[np.ix_(rows - start, columns)] = np.rint(unpacked[positions] @ unpacked.T)
+        elif len(rows):
+            intersections[np.ix_(rows - start, columns)] = intersection_counts(packed, rows, columns, matrix_bytes)
+        # Every block is scored to draw the perturbations of its rows, even if none of its rows remain
+        block = similarity_function.from_counts(sizes[start:stop, None], sizes[None, :], intersections)
+        del intersections
+        if not len(rows):
+            continue
+        block = block[np.ix_(rows - start, columns)]
+        block[columns[None, :] <= rows[:, None]] = -np.inf  # Lower triangle and diagonal
+        # Pairs of the block's rows with later columns are candidates of both the row and the column
+        order = np.argsort(-block, axis=1, kind="stable")[:, :num_candidates]
+        similarities[rows], partners[rows] = best_candidates(
+            np.hstack((similarities[rows], np.take_along_axis(block, order, 1))),
+            np.hstack((partners[rows], columns[order])), num_candidates)
+        order = np.argsort(-block, axis=0, kind="stable")[:num_candidates]
+        similarities[columns], partners[columns] = best_candidates(
+            np.hstack((similarities[columns], np.take_along_axis(block, order, 0).T)),
+            np.hstack((partners[columns], rows[order].T)), num_candidates)
+    partners[similarities == -np.inf] = -1
+    return similarities, partners
+
+
+# Make the pairs of round_pairs() from the candidates of candidate_partners() for as long as they are certain to come
+# next, adding them to pairs and matched. Pairs are taken most similar first, ties to the first pair of the upper
+# triangle in row-major order. A pair that is missing from the candidates of a filter whose candidates were cut off at
+# num_candidates comes after its last candidate, so pairing stops before the first pair that comes after the last
+# candidate of a filter that is still unpaired
+def pair_candidates(similarities, partners, matched, pairs):
+    num_candidates = similarities.shape[1]
+    truncated = len(matched) - np.count_nonzero(matched) - 1 > num_candidates
+
+    # Order of the candidate at position of a filter's candidates (the filter's row comes last)
+    def key(row, position):
+        row, partner = int(row), int(partners[row, position])
+        return -float(similarities[row, position]), min(row, partner), max(row, partner), row, position
+
+    heads = [key(row, 0) for row in np.flatnonzero(~matched) if partners[row, 0] >= 0]
+    heapq.heapify(heads)
+    last_candidates = [key(row, num_candidates - 1)[:4] for row in np.flatnonzero(~matched)] \
+        if truncated else []
+    heapq.heapify(last_candidates)
+    while heads:
+        while last_candidates and matched[last_candidates[0][3]]:
+            heapq.heappop(last_candidates)
+        if last_candidates and heads[0][:3] > last_candidates[0][:3]:  # Missing pairs may come first
+            return
+        _, first, second, row, position = heapq.heappop(heads)
+        if matched[row]:
+            continue
+        if matched[first + second - row]:  # Try the row's next candidate
+            if position + 1 < num_candidates and partners[row, position + 1] >= 0:
+                heapq.heappush(heads, key(row, position + 1))
+            continue
+        pairs.append((first, second))
+        matched[first] = matched[second] = True
+
+
+# Same as round_pairs(similarity_matrix(packed, similarity_function)), but within about memory_budget bytes instead of
+# several (# filters x # filters) arrays, so packed can be a memory-mapped matrix of more filters than fit in memory.
+# The similarity matrix is computed a block of rows at a time and every filter keeps only its best candidate partners,
+# from which pairs are made for as long as no pair missing from them can come first (see pair_candidates()). The
+# filters still unpaired then get new candidates among each other from another pass over the matrix, which draws the
+# same tie-breaking perturbations again. Returns the pairs and the mask of the paired filters like round_pairs()
+def bounded_round_pairs(packed, similarity_function, memory_budget):
+    num_filters = len(packed)
+    if memory_budget < min_pairing_budget(num_filters):
+        raise ValueError("Pairing " + str(num_filters) + " filters needs a memory budget of at least " +
+                         str(min_pairing_budget(num_filters)) + " bytes")
+    share = memory_budget // PAIRING_SHARES
+    num_candidates = max(1, min(num_filters - 1, share // (CANDIDATE_BYTES * num_filters)))
+    block_rows = max(1, share // (BLOCK_ELEMENT_BYTES * num_filters))
+    chunk = max(1, share // (2 * max(1, packed.shape[1])))
+    sizes = np.concatenate([popcounts(np.asarray(packed[start:start + chunk]))
+                            for start in range(0, num_filters, chunk)])
+    start_state = tie_break_state()
+    end_state = None
+    matched = np.zeros(num_filters, dtype=bool)
+    pairs = []
+    while end_state is None or num_filters - 2 * len(pairs) > 1:
+        set_tie_break_state(start_state)
+        similarities, partners = candidate_partners(packed, similarity_function, sizes, ~matched, num_candidates,
+                                                    block_rows, share)
+        if end_state is None:
+            end_state = tie_break_state()
+        pair_candidates(similarities, partners, matched, pairs)
+    set_tie_break_state(end_state)
+    return pairs, matched
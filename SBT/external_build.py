@@ -0,0 +1,159 @@
+""" Out-of-core construction of an SBT index (SBT.build_index()) for collections whose filters do not fit in memory. The
+tree is clustered like insert_cluster_sequences2() (clustering.cluster_rounds), but no node objects are created: the
+leaf filters are spilled to memory-mapped scratch files as they are built, and every subtree is summarized by the
+intersection and the union of its leaf filters, which are also kept on disk. Every filter of every node type is a
+function of these summaries: a Base filter is the union, a HowDe how filter is the intersection (its det filter is the
+intersection plus the bits missing from the union and its union filter is the union), and a Split-SBT sim filter is the
+intersection minus the parent's intersection (its rem filter is the union minus the intersection). The clustering
+rounds copy the compared bits of the remaining subtrees (to a scratch file if they take more than a quarter of the
+budget) and pair them with clustering.bounded_round_pairs(), which computes the similarity matrix a block of rows at a
+time and only keeps the best candidate partners of every subtree, so no (# subtrees x # subtrees) array is ever held.
+Parents are combined a chunk of rows at a time. The filters, bits and similarities held at once stay within about
+memory_budget bytes, which has to hold a few hundred bytes per experiment (clustering.min_pairing_budget()). The final
+filters are computed row by row while they are written into the index file (see index_file), so the tree never exists
+in memory """
+from SBT.clustering import bounded_round_pairs, min_pairing_budget
+from SBT.index_file import write_index_file
+import numpy as np
+import tempfile
+import os
+
+DEFAULT_MEMORY_BUDGET = 1 << 28  # Bytes of filters, bits and similarities held in memory at once
+COMPARED_SHARE = 4  # The compared bits of a round are kept in memory if they take at most 1 / COMPARED_SHARE of it
+WORKING_ROWS = 6  # Filters held per pair while combining parents (intersection and union of both children and parent)
+
+
+# Matrix of num_rows packed filters of row_bytes bytes each, in memory if it fits in memory_budget and in a scratch file
+# in directory otherwise
+def scratch_matrix(directory, name, num_rows, row_bytes, memory_budget):
+    if num_rows * row_bytes <= memory_budget:
+        return np.zeros((num_rows, row_bytes), dtype=np.uint8)
+    return np.memmap(os.path.join(directory, name), dtype=np.uint8, mode="w+", shape=(num_rows, row_bytes))
+
+
+# Packed bits of the first num_bits bits of the given rows of a matrix of filters (the pad bits are zero, like
+# clustering.PairwiseSimilarity.packed_filter()), copied a chunk of rows at a time
+def compared_bits(filters, rows, num_bits, directory, memory_budget):
+    num_bytes = (num_bits + 7) // 8
+    compared = scratch_matrix(directory, "compared", len(rows), num_bytes, memory_budget)
+    chunk = max(1, memory_budget // (2 * num_bytes))
+    for start in range(0, len(rows), chunk):
+        compared[start:start + chunk] = filters[rows[start:start + chunk], :num_bytes]
+    if num_bits % 8:
+        compared[:, -1] &= np.uint8(0xff << (8 - num_bits % 8) & 0xff)
+    return compared
+
+
+# Nodes of the tree under root in pre-order
+def preorder(root, left, right):
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        if left[node] >= 0:
+            stack.append(right[node])
+            stack.append(left[node])
+    return np.array(nodes, dtype=np.int64)
+
+
+# Yield the packed rows of one filter kind for the given nodes, computed from the intersection and union of their leaf
+# filters (see the module docstring). pad_mask clears the bits past the end of the filter in inverted rows
+def iter_filter_rows(filter_name, nodes, parents, intersections, unions, pad_mask):
+    for node in nodes:
+        if filter_name == "bloom_filter" or filter_name == "union_filter":
+            yield unions[node]
+        elif filter_name == "how_filter":
+            yield intersections[node]
+        elif filter_name == "det_filter":
+            yield (intersections[node] | ~unions[node]) & pad_mask
+        elif filter_name == "sim_filter":
+            yield intersections[node] if parents[node] < 0 else intersections[node] & ~intersections[parents[node]]
+        elif filter_name == "rem_filter":
+            yield unions[node] & ~intersections[node]
+        else:
+            raise ValueError("Unknown filter " + filter_name)
+
+
+# Build the SBT of the leaf filters yielded by leaf_filters (packed rows, one per experiment name) and write it to the
+# index file file_name. Subtrees are compared on their first (# bits_to_check) bits (all bits if None) and scratch
+# files go into a temporary directory in scratch_directory (the index file's directory if None)
+def build_index(sbt, leaf_filters, experiment_names, file_name, bits_to_check=None,
+                memory_budget=DEFAULT_MEMORY_BUDGET, scratch_directory=None):
+    experiment_names = list(experiment_names)
+    num_leaves = len(experiment_names)
+    row_bytes = (sbt.bloom_filter_length + 7) // 8
+    if num_leaves == 0:
+        raise ValueError("Cannot build an index without experiments")
+    if not hasattr(sbt.similarity_function, "from_counts"):
+        raise ValueError("Building an index out of core needs a similarity function from SBT/similarity.py")
+    if memory_budget < WORKING_ROWS * row_bytes:
+        raise ValueError("The memory budget should hold at least " + str(WORKING_ROWS) + " filters")
+    pairing_budget = memory_budget - memory_budget // COMPARED_SHARE
+    if pairing_budget < min_pairing_budget(num_leaves):
+        raise ValueError("The memory budget should hold at least " + str(min_pairing_budget(num_leaves)) +
+                         " bytes to pair the subtrees besides their compared bits")
+    node_class = sbt.NodeClass
+    num_nodes = 2 * num_leaves - 1
+    if scratch_directory is None:
+        scratch_directory = os.path.dirname(os.path.abspath(file_name))
+    with tempfile.TemporaryDirectory(dir=scratch_directory) as directory:
+        # Summaries of every subtree, spilled to disk. Leaves are their own intersection and union
+        unions = np.memmap(os.path.join(directory, "unions"), dtype=np.uint8, mode="w+", shape=(num_nodes, row_bytes))
+        intersections = None
+        if node_class.sbt_type != "Base":
+            intersections = np.memmap(os.path.join(directory, "intersections"), dtype=np.uint8, mode="w+",
+                                      shape=(num_nodes, row_bytes))
+        pad_mask = np.full(row_bytes, 0xff, dtype=np.uint8)  # Clears the bits past the end of the filter
+        if sbt.bloom_filter_length % 8:
+            pad_mask[-1] = 0xff << (8 - sbt.bloom_filter_length % 8) & 0xff
+        for leaf, packed_filter in enumerate(leaf_filters):
+            unions[leaf] = np.frombuffer(packed_filter, dtype=np.uint8) & pad_mask
+            if intersections is not None:
+                intersections[leaf] = unions[leaf]
+        # Base nodes are compared on their union, the other node types on their intersection (their first filter)
+        compared_filters = unions if intersections is None else intersections
+        num_bits = sbt.bloom_filter_length if bits_to_check is None else min(bits_to_check, sbt.bloom_filter_length)
+        left = np.full(num_nodes, -1, dtype=np.int64)
+        right = np.full(num_nodes, -1, dtype=np.int64)
+        parents = np.full(num_nodes, -1, dtype=np.int64)
+        names = experiment_names + [None] * (num_leaves - 1)
+        subtrees = list(range(num_leaves))
+        next_node = num_leaves
+        chunk = max(1, memory_budget // (WORKING_ROWS * row_bytes))
+        while len(subtrees) > 1:  # Clustering rounds, like clustering.cluster_rounds()
+            compared = compared_bits(compared_filters, np.array(subtrees), num_bits, directory,
+                                     memory_budget // COMPARED_SHARE)
+            pairs, matched = bounded_round_pairs(compared, sbt.similarity_function, pairing_budget)
+            del compared
+            new_nodes = np.arange(next_node, next_node + len(pairs))
+            left[new_nodes] = [subtrees[index1] for index1, _ in pairs]
+            right[new_nodes] = [subtrees[index2] for _, index2 in pairs]
+            parents[left[new_nodes]] = new_nodes
+            parents[right[new_nodes]] = new_nodes
+            for new_node in new_nodes:
+                names[new_node] = "I" + str(node_class.count)  # Label inner nodes like from_children()
+                node_class.count += 1
+            for start in range(0, len(new_nodes), chunk):
+                nodes = new_nodes[start:start + chunk]
+                unions[nodes[0]:nodes[-1] + 1] = unions[left[nodes]] | unions[right[nodes]]
+                if intersections is not None:
+                    intersections[nodes[0]:nodes[-1] + 1] = intersections[left[nodes]] & intersections[right[nodes]]
+            subtrees = [subtree for subtree, subtree_matched in zip(subtrees, matched) if not subtree_matched]
+            subtrees += list(new_nodes)
+            next_node += len(pairs)
+        # Write the tree in pre-order. Leaves only have the first filter of their node type
+        nodes = preorder(subtrees[0], left, right)
+        numbers = np.empty(num_nodes, dtype=np.int64)
+        numbers[nodes] = np.arange(num_nodes)
+        is_leaf = left[nodes] < 0
+        left_numbers = np.where(is_leaf, -1, numbers[left[nodes]]).astype(np.int32)
+        right_numbers = np.where(is_leaf, -1, numbers[right[nodes]]).astype(np.int32)
+        filter_names = list(node_class.filter_names)
+        rows = [np.arange(num_nodes, dtype=np.int32)]
+        rows += [np.where(is_leaf, -1, np.cumsum(~is_leaf) - 1).astype(np.int32)] * (len(filter_names) - 1)
+        blocks = [iter_filter_rows(filter_name, nodes if number == 0 else nodes[~is_leaf], parents, intersections,
+                                   unions, pad_mask) for number, filter_name in enumerate(filter_names)]
+        write_index_file(sbt, file_name, left_numbers, right_numbers, [names[node] for node in nodes], filter_names,
+                         rows, blocks)
+        del unions, intersections
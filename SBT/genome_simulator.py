@@ -0,0 +1,125 @@
+""" Seeded synthetic genomes for benchmarks (run with simulate_genomes.py). A reference genome (random or read from a
+file) evolves along a random phylogeny into num_genomes variant genomes: every branch of the tree applies SNPs,
+insertions and deletions drawn in proportion to its length, so genomes share the mutations of their common ancestors and
+closely related genomes differ by few mutations. The tree is ultrametric (every genome is as far from the reference),
+and relatedness bounds the time at which lineages split: 0 gives independent variants of the reference (like run.sh),
+higher values let genomes share more of their mutations. Everything is done on 2-bit code arrays with NumPy, and the
+mutations of every branch are drawn from a generator seeded with the seed and the branch, so the genomes are built and
+written in parallel processes and still only depend on the seed """
+from SBT.sequence_reader import read_sequence
+from SBT.KmerHasher import ENCODING
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import os
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+LINE_LENGTH = 80  # Bases per FASTA line
+
+
+# Write a sequence (bytes) as a FASTA file with one record
+def write_fasta(file_name, name, sequence):
+    with open(file_name, "wb") as f:
+        f.write(b">" + name.encode() + b"\n")
+        f.write(b"\n".join(sequence[start:start + LINE_LENGTH] for start in range(0, len(sequence), LINE_LENGTH)))
+        f.write(b"\n")
+
+
+# Random ultrametric phylogeny of num_genomes genomes. Node 0 is the reference at time 0 and the genomes are leaves at
+# time 1. Every internal node splits its genomes into two groups at a time drawn uniformly between the time of its
+# parent and relatedness. Returns the parent of every node (-1 for the reference), the time of every node and the leaf
+# of every genome
+def random_phylogeny(num_genomes, relatedness, rng):
+    parents = [-1]
+    times = [0.0]
+    genome_nodes = np.zeros(num_genomes, dtype=np.int64)
+    stack = [(0, 0, num_genomes)]  # (parent, first genome, last genome + 1)
+    while stack:
+        parent, first, last = stack.pop()
+        node = len(parents)
+        parents.append(parent)
+        if last - first == 1:
+            times.append(1.0)
+            genome_nodes[first] = node
+            continue
+        times.append(times[parent] + (relatedness - times[parent]) * rng.random())
+        split = int(rng.integers(first + 1, last))
+        stack.append((node, split, last))
+        stack.append((node, first, split))
+    return np.array(parents), np.array(times), genome_nodes
+
+
+# Nodes from below the reference down to a node
+def lineage(parents, node):
+    nodes = []
+    while parents[node] != -1:
+        nodes.append(node)
+        node = parents[node]
+    return nodes[::-1]
+
+
+# Mutate an array of 2-bit codes along a branch of the given length: Poisson numbers of SNPs (a base changes into one
+# of the three other bases) and of insertions and deletions of 1 to max_indel_len bases (half each) at uniformly random
+# positions, with snp_rate and indel_rate mutations per base over a branch of length 1. Returns the new codes
+def mutate(codes, branch_length, snp_rate, indel_rate, max_indel_len, rng):
+    codes = codes.copy()
+    snps = rng.integers(0, len(codes), size=rng.poisson(snp_rate * branch_length * len(codes)))
+    codes[snps] = (codes[snps] + rng.integers(1, 4, size=len(snps), dtype=np.uint8)) % 4
+    if indel_rate == 0:
+        return codes
+    num_deletions, num_insertions = rng.poisson(indel_rate * branch_length * len(codes) / 2, size=2)
+    starts = rng.integers(0, len(codes), size=num_deletions)
+    lengths = rng.integers(1, max_indel_len + 1, size=num_deletions)
+    deleted = np.zeros(len(codes) + max_indel_len, dtype=bool)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)  # Base within its deletion
+    deleted[np.repeat(starts, lengths) + offsets] = True
+    codes = codes[~deleted[:len(codes)]]
+    positions = rng.integers(0, len(codes) + 1, size=num_insertions)
+    lengths = rng.integers(1, max_indel_len + 1, size=num_insertions)
+    return np.insert(codes, np.repeat(positions, lengths), rng.integers(0, 4, size=lengths.sum(), dtype=np.uint8))
+
+
+# Build one genome by mutating the reference along its lineage and write it as a FASTA file. Runs in the worker
+# processes of simulate_genomes(). Returns the genome's length
+def write_genome(file_name, name, reference, nodes, branch_lengths, snp_rate, indel_rate, max_indel_len, seed):
+    codes = reference
+    for node, branch_length in zip(nodes, branch_lengths):
+        codes = mutate(codes, branch_length, snp_rate, indel_rate, max_indel_len, np.random.default_rng([seed, node]))
+    write_fasta(file_name, name, BASES[codes].tobytes())
+    return len(codes)
+
+
+# 2-bit codes of the reference: the first genome_len bases of a sequence file, or genome_len random bases if
+# reference_file is None
+def reference_codes(reference_file, genome_len, rng):
+    if reference_file is None:
+        return rng.integers(0, 4, size=genome_len, dtype=np.uint8)
+    return ENCODING[np.frombuffer(read_sequence(reference_file, genome_len, separator="").encode(), dtype=np.uint8)]
+
+
+# Write num_genomes variants of a reference as FASTA files named prefix + number (e.g. fasta/sim0, fasta/sim1, ...),
+# with workers processes (None to write them one at a time in this process). Every genome differs from the reference
+# by about snp_rate * genome_len SNPs and indel_rate * genome_len indels, and two genomes share the mutations of their
+# common ancestor (see random_phylogeny()). Returns the file names
+def simulate_genomes(prefix, num_genomes, genome_len, snp_rate, indel_rate=0, max_indel_len=1, relatedness=0.5,
+                     seed=0, reference_file=None, workers=None):
+    if not 0 <= relatedness <= 1:
+        raise ValueError("relatedness should be between 0 and 1")
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    reference = reference_codes(reference_file, genome_len, rng)
+    parents, times, genome_nodes = random_phylogeny(num_genomes, relatedness, rng)
+    lineages = [lineage(parents, node) for node in genome_nodes]
+    branch_lengths = [times[nodes] - times[parents[nodes]] for nodes in lineages]
+    file_names = [prefix + str(number) for number in range(num_genomes)]
+    names = [os.path.basename(file_name) for file_name in file_names]
+    arguments = (file_names, names, repeat(reference), lineages, branch_lengths, repeat(snp_rate), repeat(indel_rate),
+                 repeat(max_indel_len), repeat(seed))
+    if workers is None:
+        list(map(write_genome, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_genome, *arguments, chunksize=max(1, num_genomes // (4 * workers))))
+    return file_names
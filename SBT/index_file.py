@@ -0,0 +1,139 @@
+""" Versioned, memory-mapped on-disk index format for SBTs. Unlike SBT.save (a pickle of the whole object graph), an
+index file is opened with mmap, so loading it only reads the header and topology, and a query only pages in the filters
+of the nodes it visits. The OS page cache is shared between processes that open the same index.
+
+Layout (little endian):
+    header      struct HEADER: magic, version, sbt type, k, filter length, # nodes, row bytes, row stride and the
+                offset/length of the metadata
+    metadata    JSON: threshold, hash_fraction, hash seeds (KmerHasher), similarity function name, node names and
+                filter names
+    topology    int32 arrays: left child, right child, then the row of every node in each filter block (-1 if the node
+                does not have that filter)
+    filters     one page-aligned block per filter kind with one row per node that has the filter. Rows of at least a
+                page are padded to a whole number of pages so that every node's filter starts on its own page
+"""
+from SBT.FlatTree import FlatTree, topology, filter_rows
+from SBT.traversal import iter_nodes
+from SBT.bits import packed_bits
+import numpy as np
+import struct
+import json
+import mmap
+
+MAGIC = b"SBTINDEX"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQQQQQ")
+SBT_TYPES = ["Base", "SSBT", "HowDe"]
+PAGE_SIZE = mmap.PAGESIZE
+
+
+# Round offset up to a multiple of alignment
+def align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+# Distance between two rows of a filter block
+def row_stride(row_bytes):
+    return align(row_bytes, PAGE_SIZE) if row_bytes >= PAGE_SIZE else row_bytes
+
+
+# Offsets of the topology section and of every filter block given the number of rows of each filter block
+def section_offsets(metadata_offset, metadata_length, num_nodes, block_rows, stride):
+    topology_offset = align(metadata_offset + metadata_length, 8)
+    offset = topology_offset + 4 * num_nodes * (2 + len(block_rows))
+    filter_offsets = []
+    for num_rows in block_rows:
+        offset = align(offset, PAGE_SIZE)
+        filter_offsets.append(offset)
+        offset += num_rows * stride
+    return topology_offset, filter_offsets, offset
+
+
+# Yield the packed bits of one filter kind of every node that has it
+def node_rows(nodes, filter_name):
+    for node in nodes:
+        if getattr(node, filter_name) is not None:
+            yield packed_bits(getattr(node, filter_name))
+
+
+# Write an SBT to an index file. The filters are written straight from the node objects (or the FlatTree) one row at a
+# time, so saving does not need a second copy of the tree in memory
+def write_index(sbt, file_name):
+    if not sbt.vectorized_hashing():
+        raise ValueError("Only SBTs hashed with KmerHasher hash functions can be saved as an index")
+    if sbt.root is None and sbt.flat is None:
+        raise ValueError("Cannot save an empty SBT as an index")
+    if sbt.flat is not None:
+        tree = sbt.flat
+        left, right, names = tree.left, tree.right, tree.names
+        filter_names = list(tree.filters)
+        rows = [tree.rows[filter_name] for filter_name in filter_names]
+        blocks = [tree.filters[filter_name] for filter_name in filter_names]
+    else:
+        nodes = list(iter_nodes(sbt.root))
+        left, right = topology(nodes)
+        names = [node.experiment_name for node in nodes]
+        filter_names = list(sbt.NodeClass.filter_names)
+        rows = [filter_rows(nodes, filter_name) for filter_name in filter_names]
+        blocks = [node_rows(nodes, filter_name) for filter_name in filter_names]
+    write_index_file(sbt, file_name, left, right, names, filter_names, rows, blocks)
+
+
+# Write an index file given the topology in pre-order, the node names, the row of every node in each filter block and
+# the packed rows of every block (iterables, so rows can be computed while they are written)
+def write_index_file(sbt, file_name, left, right, names, filter_names, rows, blocks):
+    metadata = json.dumps({
+        "threshold": sbt.threshold,
+        "hash_fraction": sbt.hash_fraction,
+        "hash_seeds": [hash_function.seed for hash_function in sbt.hash_functions],
+        "similarity_function": getattr(sbt.similarity_function, "__name__", None),
+        "filter_names": filter_names,
+        "names": list(names),
+    }).encode("utf-8")
+    row_bytes = (sbt.bloom_filter_length + 7) // 8
+    stride = row_stride(row_bytes)
+    topology_offset, filter_offsets, _ = section_offsets(HEADER.size, len(metadata), len(left),
+                                                         [np.count_nonzero(r >= 0) for r in rows], stride)
+    with open(file_name, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, SBT_TYPES.index(sbt.NodeClass.sbt_type), sbt.k, sbt.bloom_filter_length,
+                            len(left), row_bytes, stride, HEADER.size, len(metadata)))
+        f.write(metadata)
+        f.seek(topology_offset)
+        for array in [left, right] + rows:
+            f.write(np.asarray(array, dtype="<i4").tobytes())
+        padding = bytes(stride - row_bytes)
+        for offset, block in zip(filter_offsets, blocks):
+            f.seek(offset)
+            for row in block:
+                f.write(row.tobytes())
+                f.write(padding)
+        f.truncate()
+
+
+# Open an index file. Returns the metadata (including the header fields k, bloom_filter_length and sbt_type) and a
+# FlatTree whose filter matrices are read-only views of the memory-mapped file
+def open_index(file_name):
+    with open(file_name, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(buffer) < HEADER.size or buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(file_name + " is not an SBT index file")
+    magic, version, sbt_type, k, bloom_filter_length, num_nodes, row_bytes, stride, metadata_offset, \
+        metadata_length = HEADER.unpack_from(buffer, 0)
+    if version > VERSION:
+        raise ValueError(file_name + " has index format version " + str(version) + ", which is newer than this "
+                         "version of the SBT can read (" + str(VERSION) + ")")
+    metadata = json.loads(bytes(buffer[metadata_offset:metadata_offset + metadata_length]).decode("utf-8"))
+    filter_names = metadata["filter_names"]
+    topology_offset = align(metadata_offset + metadata_length, 8)
+    arrays = np.frombuffer(buffer, dtype="<i4", count=num_nodes * (2 + len(filter_names)),
+                           offset=topology_offset).reshape(2 + len(filter_names), num_nodes).astype(np.int32)
+    rows = dict(zip(filter_names, arrays[2:]))
+    _, filter_offsets, _ = section_offsets(metadata_offset, metadata_length, num_nodes,
+                                           [np.count_nonzero(rows[name] >= 0) for name in filter_names], stride)
+    filters = {}
+    for filter_name, offset in zip(filter_names, filter_offsets):
+        filters[filter_name] = np.ndarray((np.count_nonzero(rows[filter_name] >= 0), row_bytes), dtype=np.uint8,
+                                          buffer=buffer, offset=offset, strides=(stride, 1))
+    tree = FlatTree(SBT_TYPES[sbt_type], bloom_filter_length, arrays[0], arrays[1], metadata["names"], filters, rows)
+    metadata.update(k=k, bloom_filter_length=bloom_filter_length, sbt_type=SBT_TYPES[sbt_type])
+    return metadata, tree
@@ -0,0 +1,212 @@
+""" Vectorized node checks used by the fast query method. Each check looks up the bits of a query's filter indices in
+one node's filters with NumPy gathers (see bits.get_bits), counts hits and misses with array reductions and returns the
+compacted indices that should be passed on to the node's children. The rows are checked in chunks of growing size so
+that a node can still stop early once the threshold is decided, without paying for a Python loop over every kmer.
+
+Every check takes optional weights, the number of kmers each row stands for (see query_plan), and counts hits and
+misses as sums of weights. None means one kmer per row. Given a QueryTrace, a check reports the rows and filter bits it
+actually read to it, which stops short of the whole query when the check stops early """
+from SBT.bits import get_bits
+import numpy as np
+
+MISS = 0  # Too many kmers are missing - prune the subtree
+HIT = 1  # Enough kmers are in every descendant - return all descendants
+PARTIAL = 2  # Undecided - search the children with the returned indices
+
+FIRST_CHUNK = 256  # Number of rows checked before the first early exit test (doubles after every chunk)
+
+
+# Make sure filter indices are a (# kmers x # hash functions) int64 array
+def as_index_matrix(filter_indices):
+    filter_indices = np.asarray(filter_indices, dtype=np.int64)
+    if filter_indices.ndim == 2:  # Also keeps the shape of queries without kmers
+        return filter_indices
+    return filter_indices.reshape(len(filter_indices), -1)
+
+
+# Total weight of the rows selected by a bool mask (the number of selected rows if weights is None)
+def weight(mask, weights=None):
+    return np.count_nonzero(mask) if weights is None else int(weights[mask].sum())
+
+
+# Number of kmers the rows of filter_indices stand for
+def total_weight(filter_indices, weights=None):
+    return len(filter_indices) if weights is None else int(weights.sum())
+
+
+# Weights of a subset of rows (None stays None)
+def select(weights, rows):
+    return None if weights is None else weights[rows]
+
+
+# Total weight of the rows of every query (only the rows selected by mask if given)
+def query_weights(query_ids, num_queries, weights=None, mask=None):
+    if mask is not None:
+        query_ids, weights = query_ids[mask], select(weights, mask)
+    return np.bincount(query_ids, weights=weights, minlength=num_queries)
+
+
+# Report to trace (if given) that a check read the bits of every index in rows from num_filters filters
+def probe(trace, rows, num_filters=1):
+    if trace is not None:
+        trace.probe(len(rows), rows.size * num_filters)
+
+
+# Yield (start, stop) bounds of chunks of rows whose size doubles every chunk
+def chunks(num_rows):
+    start, size = 0, FIRST_CHUNK
+    while start < num_rows:
+        yield start, min(num_rows, start + size)
+        start += size
+        size *= 2
+
+
+# Base SBT node check. A kmer is a hit if all of its bits are set in bloom_filter. Returns (MISS, ...) once more than
+# (# kmers) - absolute_threshold kmers are missing, otherwise (PARTIAL, hit rows, None, absolute_threshold, weights of
+# the hit rows)
+def base_check(bloom_filter, filter_indices, absolute_threshold, weights=None, trace=None):
+    filter_indices = as_index_matrix(filter_indices)
+    allowed_misses = total_weight(filter_indices, weights) - absolute_threshold
+    hits = np.empty(len(filter_indices), dtype=bool)
+    num_misses = 0
+    for start, stop in chunks(len(filter_indices)):
+        hits[start:stop] = get_bits(bloom_filter, filter_indices[start:stop]).all(axis=1)
+        probe(trace, filter_indices[start:stop])
+        num_misses += weight(~hits[start:stop], select(weights, slice(start, stop)))
+        if num_misses > allowed_misses:  # Stop since too many misses
+            return MISS, None, None, absolute_threshold, None
+    return PARTIAL, filter_indices[hits], None, absolute_threshold, select(weights, hits)
+
+
+# Split-SBT node check. pending marks the indices whose bits have not been found in a similarity filter yet (None
+# means all of them). A kmer is a complete hit once none of its bits are pending, a partial hit if every pending bit is
+# in rem_filter (None for leaves) and a complete miss otherwise. Partial hits are returned with their remaining pending
+# bits, the threshold left for the children and their weights
+def split_check(sim_filter, rem_filter, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+    filter_indices = as_index_matrix(filter_indices)
+    if pending is None:
+        pending = np.ones(filter_indices.shape, dtype=bool)
+    allowed_misses = total_weight(filter_indices, weights) - absolute_threshold
+    unresolved = np.empty(filter_indices.shape, dtype=bool)
+    partial = np.zeros(len(filter_indices), dtype=bool)
+    complete_hits = 0
+    complete_misses = 0
+    for start, stop in chunks(len(filter_indices)):
+        rows = filter_indices[start:stop]
+        chunk_weights = select(weights, slice(start, stop))
+        unresolved[start:stop] = pending[start:stop] & ~get_bits(sim_filter, rows)
+        complete = ~unresolved[start:stop].any(axis=1)
+        if rem_filter is not None:
+            partial[start:stop] = ~complete & (~unresolved[start:stop] | get_bits(rem_filter, rows)).all(axis=1)
+        probe(trace, rows, 1 if rem_filter is None else 2)
+        complete_hits += weight(complete, chunk_weights)
+        complete_misses += weight(~complete & ~partial[start:stop], chunk_weights)
+        if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
+            return HIT, None, None, absolute_threshold, None
+        if complete_misses > allowed_misses:  # Stop since too many misses
+            return MISS, None, None, absolute_threshold, None
+    if complete_hits >= absolute_threshold:
+        return HIT, None, None, absolute_threshold, None
+    return PARTIAL, filter_indices[partial], unresolved[partial], absolute_threshold - complete_hits, \
+        select(weights, partial)
+
+
+# HowDe-SBT node check. pending marks the indices whose bits are not determined yet (None means all of them). A bit is
+# determined if it is set in det_filter (None for leaves, where every bit is determined), in which case how_filter says
+# whether all or none of the descendants have it. A kmer is a complete miss if some pending bit is determined to be
+# absent, a complete hit if all pending bits are determined to be present, and a partial hit otherwise
+def howde_check(how_filter, det_filter, filter_indices, pending, absolute_threshold, weights=None, trace=None):
+    filter_indices = as_index_matrix(filter_indices)
+    if pending is None:
+        pending = np.ones(filter_indices.shape, dtype=bool)
+    allowed_misses = total_weight(filter_indices, weights) - absolute_threshold
+    unresolved = np.zeros(filter_indices.shape, dtype=bool)
+    partial = np.zeros(len(filter_indices), dtype=bool)
+    complete_hits = 0
+    complete_misses = 0
+    for start, stop in chunks(len(filter_indices)):
+        rows = filter_indices[start:stop]
+        chunk_weights = select(weights, slice(start, stop))
+        determined = pending[start:stop]
+        if det_filter is not None:
+            determined = determined & get_bits(det_filter, rows)
+            unresolved[start:stop] = pending[start:stop] & ~determined
+        missed = (determined & ~get_bits(how_filter, rows)).any(axis=1)
+        probe(trace, rows, 1 if det_filter is None else 2)
+        complete = ~missed & ~unresolved[start:stop].any(axis=1)
+        partial[start:stop] = ~missed & ~complete
+        complete_hits += weight(complete, chunk_weights)
+        complete_misses += weight(missed, chunk_weights)
+        if complete_hits >= absolute_threshold:  # Enough hits to return all descendants
+            return HIT, None, None, absolute_threshold, None
+        if complete_misses > allowed_misses:  # Stop since too many misses
+            return MISS, None, None, absolute_threshold, None
+    if complete_hits >= absolute_threshold:
+        return HIT, None, None, absolute_threshold, None
+    return PARTIAL, filter_indices[partial], unresolved[partial], absolute_threshold - complete_hits, \
+        select(weights, partial)
+
+
+# Batched version of base_check(). filter_indices holds the rows of every query and query_ids the query each row
+# belongs to, active marks the queries still searching and absolute_thresholds holds the threshold of every query. The
+# bits of all rows are looked up with one gather. Returns the queries that passed their threshold and the state to
+# search the children with (None if no query passed)
+def base_batch_check(bloom_filter, filter_indices, query_ids, active, absolute_thresholds, weights=None, trace=None):
+    hits = get_bits(bloom_filter, filter_indices).all(axis=1)  # Kmer is a hit if all of its bits are on
+    probe(trace, filter_indices)
+    num_hits = query_weights(query_ids, len(active), weights, hits)
+    passed = active & (num_hits >= absolute_thresholds)  # Queries that did not have too many misses
+    if not passed.any():
+        return passed, None
+    rows = hits & passed[query_ids]
+    return passed, (filter_indices[rows], None, query_ids[rows], passed, absolute_thresholds, select(weights, rows))
+
+
+# Batched version of split_check(). Returns the queries with enough complete hits to return all descendants and the
+# state to search the children with (None if no query has to)
+def split_batch_check(sim_filter, rem_filter, filter_indices, pending, query_ids, active, absolute_thresholds,
+                      weights=None, trace=None):
+    unresolved = pending & ~get_bits(sim_filter, filter_indices)
+    complete = ~unresolved.any(axis=1)  # Complete hit - all descendants have
+    if rem_filter is not None:  # Partial hit - every unresolved bit is in some descendant
+        partial = ~complete & (~unresolved | get_bits(rem_filter, filter_indices)).all(axis=1)
+    else:
+        partial = np.zeros(len(complete), dtype=bool)
+    probe(trace, filter_indices, 1 if rem_filter is None else 2)
+    num_rows = query_weights(query_ids, len(active), weights)
+    complete_hits = query_weights(query_ids, len(active), weights, complete)
+    complete_misses = num_rows - complete_hits - query_weights(query_ids, len(active), weights, partial)
+    found = active & (complete_hits >= absolute_thresholds)  # Enough hits to return all descendants
+    # Search children with the queries that have neither enough hits nor too many misses
+    searching = active & ~found & (complete_misses <= num_rows - absolute_thresholds)
+    if rem_filter is None or not searching.any():
+        return found, None
+    rows = partial & searching[query_ids]
+    return found, (filter_indices[rows], unresolved[rows], query_ids[rows], searching,
+                   absolute_thresholds - complete_hits, select(weights, rows))
+
+
+# Batched version of howde_check(). Returns the queries with enough complete hits to return all descendants and the
+# state to search the children with (None if no query has to)
+def howde_batch_check(how_filter, det_filter, filter_indices, pending, query_ids, active, absolute_thresholds,
+                      weights=None, trace=None):
+    how_bits = get_bits(how_filter, filter_indices)
+    if det_filter is not None:
+        det_bits = get_bits(det_filter, filter_indices)
+    else:  # Leaves only have a how filter, so every bit of a leaf is determined
+        det_bits = np.ones(filter_indices.shape, dtype=bool)
+    probe(trace, filter_indices, 1 if det_filter is None else 2)
+    unresolved = pending & ~det_bits
+    missed = (pending & det_bits & ~how_bits).any(axis=1)  # Complete miss - no descendant has some bit
+    complete = ~missed & ~unresolved.any(axis=1)  # Complete hit - all descendants have
+    num_rows = query_weights(query_ids, len(active), weights)
+    complete_hits = query_weights(query_ids, len(active), weights, complete)
+    complete_misses = query_weights(query_ids, len(active), weights, missed)
+    found = active & (complete_hits >= absolute_thresholds)  # Enough hits to return all descendants
+    # Search children with the queries that have neither enough hits nor too many misses
+    searching = active & ~found & (complete_misses <= num_rows - absolute_thresholds)
+    if det_filter is None or not searching.any():
+        return found, None
+    rows = ~missed & ~complete & searching[query_ids]
+    return found, (filter_indices[rows], unresolved[rows], query_ids[rows], searching,
+                   absolute_thresholds - complete_hits, select(weights, rows))
@@ -0,0 +1,39 @@
+""" Query planning for the fast and batched query methods. A query's filter indices have one row per kmer position, so a
+repetitive query (low complexity regions, tandem repeats, reads that repeat a kmer) looks up the same bits many times
+at every node it visits. The planner collapses duplicate rows into one row with a weight, the number of kmers it stands
+for, and the node checks count hits and misses as sums of weights (see kernels), so every node only probes each
+distinct kmer once. Rows are ordered so that the checks decide the threshold early: heavy rows first, since a single
+probe of a row decides as many kmers as its weight, and rows of equal weight by their first index so that the gathers
+walk the filters in address order. Hits and misses do not depend on the order of the rows, so planned queries return
+exactly the same results """
+from SBT.kernels import as_index_matrix
+import numpy as np
+
+
+# Plan a query. Returns the distinct rows of filter_indices in probing order and their weights (None if no row is
+# repeated, in which case the rows are only reordered)
+def plan_query(filter_indices):
+    if len(filter_indices) <= 1:
+        return np.asarray(filter_indices, dtype=np.int64), None
+    filter_indices = as_index_matrix(filter_indices)
+    # Sort the rows lexicographically (first column first) so that equal rows are next to each other
+    sorted_rows = filter_indices[np.lexsort(filter_indices.T[::-1])]
+    starts = np.flatnonzero(np.concatenate(([True], (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1))))
+    if len(starts) == len(sorted_rows):  # Every row is distinct
+        return sorted_rows, None
+    weights = np.diff(np.append(starts, len(sorted_rows)))
+    order = np.argsort(-weights, kind="stable")  # Heaviest first, then in index order
+    return sorted_rows[starts[order]], weights[order]
+
+
+# Plan every query of a batch (see plan_query()). Returns the concatenated rows of all queries, the query each row
+# belongs to and their weights (None if no query repeats a row)
+def plan_batch(filter_indices):
+    plans = [plan_query(indices) for indices in filter_indices]
+    rows = [plan_rows for plan_rows, _ in plans]
+    query_ids = np.repeat(np.arange(len(plans)), [len(plan_rows) for plan_rows in rows])
+    weights = None
+    if any(plan_weights is not None for _, plan_weights in plans):
+        weights = np.concatenate([np.ones(len(plan_rows), dtype=np.int64) if plan_weights is None else plan_weights
+                                  for plan_rows, plan_weights in plans])
+    return np.concatenate(rows), query_ids, weights
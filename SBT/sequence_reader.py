@@ -0,0 +1,134 @@
+""" Streaming reader for sequencing data. Files are read in large blocks, so a genome is never held in memory as one
+Python string. Handles FASTA (multi-line and multi-record), FASTQ, plain sequence files without headers (like the
+simulated genomes) and gzip compression of any of them. Sequences are cut into bounded chunks that overlap by k - 1
+bases, so hashing the chunks one after another gives every kmer of a record exactly once (kmers never span two
+records). read_sequence() returns a whole file as one string with its records joined by RECORD_SEPARATOR, which the
+hashing never lets a kmer span either (see KmerHasher and iter_kmers()), so both ways of reading a file give the same
+kmers """
+import gzip
+
+BLOCK_SIZE = 1 << 22  # Bytes read from a file at once
+CHUNK_SIZE = 1 << 22  # Maximum number of bases in a chunk
+GZIP_MAGIC = b"\x1f\x8b"
+RECORD_SEPARATOR = "|"  # Joins the records of a file in read_sequence()
+
+# Parser states
+SEQUENCE = 0  # Sequence lines (or the start of a header line)
+HEADER = 1  # Inside a ">" or "@" line
+PLUS = 2  # Inside the "+" line of a FASTQ record
+QUALITY = 3  # Inside the quality lines of a FASTQ record
+
+
+# Open a sequence file for binary reading, decompressing it if it is gzipped
+def open_sequence_file(file_name):
+    f = open(file_name, "rb")
+    if f.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+
+# Yield (record number, record name, sequence bytes) for the pieces of sequence in a file, in order. Pieces of the same
+# record are consecutive and have no line breaks. Files without headers are one record named None
+def iter_records(file_name, block_size=BLOCK_SIZE):
+    record = -1
+    name = None
+    header = bytearray()
+    state = SEQUENCE
+    line_start = True
+    fastq = False
+    sequence_length = 0  # Bases in the current record (a FASTQ quality string has as many characters)
+    quality_left = 0
+    with open_sequence_file(file_name) as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            position = 0
+            while position < len(block):
+                if line_start and state == SEQUENCE and block[position] in b">@":  # New record
+                    fastq = block[position] == ord("@")
+                    record += 1
+                    header.clear()
+                    sequence_length = 0
+                    state = HEADER
+                    position += 1
+                elif line_start and state == SEQUENCE and fastq and block[position] == ord("+"):
+                    state = PLUS
+                    position += 1
+                end = block.find(b"\n", position)
+                line_end = end if end >= 0 else len(block)
+                line = block[position:line_end].rstrip(b"\r")
+                if state == HEADER:
+                    header += line
+                elif state == SEQUENCE and line:
+                    if record < 0:  # No header
+                        record = 0
+                    sequence_length += len(line)
+                    yield record, name, line
+                elif state == QUALITY:
+                    quality_left -= len(line)
+                line_start = end >= 0
+                if line_start:  # End of a line
+                    if state == HEADER:
+                        name = (header.decode("ascii", "replace").split() or [""])[0]
+                        state = SEQUENCE
+                    elif state == PLUS:
+                        quality_left = sequence_length
+                        state = QUALITY if quality_left > 0 else SEQUENCE
+                    elif state == QUALITY and quality_left <= 0:
+                        state = SEQUENCE
+                position = line_end + 1
+
+
+# Yield (record name, chunk) for the sequences of a file. Every chunk is a bytes object of at most chunk_size bases and
+# consecutive chunks of a record overlap by k - 1 bases. Records shorter than k have no kmers and yield nothing
+def iter_chunks(file_name, k, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE):
+    chunk_size = max(chunk_size, k)
+    chunk = bytearray()  # Never more than chunk_size bases
+    current = None
+    name = None
+    for record, record_name, piece in iter_records(file_name, block_size):
+        if record != current:  # Finish the previous record
+            if len(chunk) >= k:
+                yield name, bytes(chunk)
+            chunk.clear()
+            current = record
+            name = record_name
+        start = 0
+        while start < len(piece):
+            taken = min(len(piece) - start, chunk_size - len(chunk))
+            chunk += piece[start:start + taken]
+            start += taken
+            if len(chunk) == chunk_size:
+                yield name, bytes(chunk)
+                del chunk[:chunk_size - (k - 1)]  # Keep the last k - 1 bases
+    if len(chunk) >= k:
+        yield name, bytes(chunk)
+
+
+# Read the sequence of a file as one string, joining its records with separator, up to sequence_len bases (all if
+# None). Kmers that span RECORD_SEPARATOR are left out when the string is hashed, so the default separator gives the
+# same kmers as iter_chunks(). An empty separator concatenates the records
+def read_sequence(file_name, sequence_len=None, block_size=BLOCK_SIZE, separator=RECORD_SEPARATOR):
+    pieces = []
+    length = 0
+    current = None
+    for record, _, piece in iter_records(file_name, block_size):
+        if record != current and current is not None:
+            pieces.append(separator.encode("ascii"))
+        current = record
+        if sequence_len is not None and length + len(piece) >= sequence_len:
+            pieces.append(piece[:sequence_len - length])
+            break
+        pieces.append(piece)
+        length += len(piece)
+    return b"".join(pieces).decode("ascii", "replace")
+
+
+# Yield the kmers of a sequence string, leaving out those that span two records (see read_sequence())
+def iter_kmers(sequence, k):
+    separated = RECORD_SEPARATOR in sequence
+    for kmer_index in range(0, len(sequence) - k + 1):
+        kmer = sequence[kmer_index:kmer_index + k]
+        if not separated or RECORD_SEPARATOR not in kmer:
+            yield kmer
@@ -0,0 +1,118 @@
+""" Similarity functions for comparing Bloom filters during insertion. Every function only depends on the number of bits
+set in each filter (a, b) and in their intersection (c), so two bitarrays are compared with popcounts
+(bitarray.util.count_and) instead of summing temporary a & b / a ^ b filters bit by bit, and one filter can be compared
+against a whole matrix of packed filters at once. Ties are broken with small perturbations drawn from a seeded random
+generator (see seed()), so builds can be reproduced """
+from bitarray.util import count_and
+import numpy as np
+
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)  # Set bits of every byte
+TIE_BREAK = 1e-9  # Scale of the random perturbations that break ties
+rng = np.random.default_rng(0)
+
+
+# Reseed the random generator used to break ties
+def seed(value):
+    global rng
+    rng = np.random.default_rng(value)
+
+
+# State of the random generator used to break ties, so the same perturbations can be drawn again (see
+# set_tie_break_state())
+def tie_break_state():
+    return rng.bit_generator.state
+
+
+# Restore a state of the random generator used to break ties returned by tie_break_state()
+def set_tie_break_state(state):
+    rng.bit_generator.state = state
+
+
+# Number of set bits in every row of a packed (big endian) uint8 array. If length is given, the pad bits after the
+# first length bits of every row are ignored
+def popcounts(packed, length=None):
+    if length is not None and length % 8:
+        packed = packed[..., :(length + 7) // 8].copy()
+        packed[..., -1] &= np.uint8(0xff << (8 - length % 8) & 0xff)
+    if hasattr(np, "bitwise_count"):  # NumPy 2
+        return np.bitwise_count(packed).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT[packed].sum(axis=-1, dtype=np.int64)
+
+
+# Element-wise numerator / denominator that is 0 where the denominator is 0
+def safe_divide(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator != 0)
+
+
+# Similarity formulas. a and b are the numbers of bits set in each filter and c in their intersection (NumPy arrays or
+# numbers)
+def hamming_counts(a, b, c):
+    return -(a + b - 2 * c)
+
+
+def and_hamming_counts(a, b, c):
+    return c - (a + b - 2 * c) * 1e-9  # hamming breaks ties
+
+
+def cosine_counts(a, b, c):
+    return safe_divide(c, np.sqrt(a * b))
+
+
+def jaccard_counts(a, b, c):
+    return 1 - safe_divide(c, a + b - c)
+
+
+def manhattan_counts(a, b, c):
+    return a + b - 2 * c
+
+
+def euclidian_counts(a, b, c):
+    return np.sqrt(a + b - 2 * c)
+
+
+def dice_counts(a, b, c):
+    return safe_divide(2 * c, a + b)
+
+
+def tanimoto_counts(a, b, c):
+    return safe_divide(c, a + b + c)
+
+
+class CountSimilarity(object):
+    def __init__(self, name, formula, tie_break=True):
+        self.__name__ = name
+        self.formula = formula
+        self.tie_break = tie_break  # Add random perturbations to break ties
+
+    """ Similarity from the set bit counts of two filters and of their intersection (numbers or NumPy arrays) """
+    def from_counts(self, a, b, c):
+        similarity = np.asarray(self.formula(a, b, c), dtype=float)
+        if self.tie_break:
+            similarity = similarity + rng.random(similarity.shape) * TIE_BREAK
+        return similarity
+
+    """ Similarity between two bitarrays of the same length """
+    def __call__(self, a, b):
+        return float(self.from_counts(a.count(), b.count(), count_and(a, b)))
+
+    """ Similarity between one packed filter and every row of a packed matrix of filters (big endian uint8 arrays
+    holding length bits each). matrix_counts can hold the set bit counts of the rows if they are already known. Returns
+    one similarity per row """
+    def one_vs_matrix(self, packed, matrix, length=None, matrix_counts=None):
+        if matrix_counts is None:
+            matrix_counts = popcounts(matrix, length)
+        return self.from_counts(popcounts(packed, length), matrix_counts, popcounts(matrix & packed, length))
+
+    def __repr__(self):
+        return self.__name__
+
+
+hamming = CountSimilarity("hamming", hamming_counts)
+and_hamming = CountSimilarity("and_hamming", and_hamming_counts, tie_break=False)
+cosine = CountSimilarity("cosine", cosine_counts)
+jaccard = CountSimilarity("jaccard", jaccard_counts)
+manhattan = CountSimilarity("manhattan", manhattan_counts)
+euclidian = CountSimilarity("euclidian", euclidian_counts)
+dice = CountSimilarity("dice", dice_counts)
+tanimoto = CountSimilarity("tanimoto", tanimoto_counts)
@@ -0,0 +1,172 @@
+""" Explicit-stack traversal shared by all node types. Queries walk the tree with a stack instead of recursion, so deep
+greedily built trees cannot hit the recursion limit, and results are collected as leaf ids instead of concatenating
+lists of names at every level. Leaves are numbered left to right by index_leaves(), which also stores the range of
+leaf ids under every node, so a node whose descendants all match is recorded in O(1). The query functions take the
+tree's links, so they walk node objects (NodeLinks) and the integer node ids of a FlatTree the same way. Given a
+QueryTrace, they pass it on to the checks, which report the rows and bits they read to it, and report every node check
+to it along with the node's depth """
+from SBT.kernels import HIT, PARTIAL
+import numpy as np
+
+
+# Children and leaf range of a node object (FlatTree has the same methods for its integer node ids)
+class NodeLinks(object):
+    @staticmethod
+    def children(node):
+        return node.left_child, node.right_child
+
+    @staticmethod
+    def leaf_range(node):
+        return node.leaf_range
+
+
+# Whether a node is a leaf (leaf node objects have no children, leaves of a FlatTree have child -1)
+def is_leaf(node, links):
+    left_child = links.children(node)[0]
+    return left_child is None if links is NodeLinks else left_child < 0
+
+
+# Yield the nodes of a subtree in pre-order (node, then left subtree, then right subtree)
+def iter_nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.left_child is not None:
+            stack.append(node.right_child)
+            stack.append(node.left_child)
+
+
+# Yield the leaves of a subtree from left to right
+def iter_leaves(root):
+    return (node for node in iter_nodes(root) if node.left_child is None)
+
+
+# Returns the nodes on the way from the root down to the leaf named experiment_name (None if no leaf has that name)
+def leaf_path(root, experiment_name):
+    path = []
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        del path[depth:]
+        path.append(node)
+        if node.left_child is None:
+            if node.experiment_name == experiment_name:
+                return path
+        else:
+            stack.append((node.right_child, depth + 1))
+            stack.append((node.left_child, depth + 1))
+    return None
+
+
+# Set the height and number of leaves of an inner node from those of its children
+def update_shape(node):
+    node.height = 1 + max(node.left_child.height, node.right_child.height)
+    node.num_leaves = node.left_child.num_leaves + node.right_child.num_leaves
+
+
+NODE_DEFAULTS = {"leaf_range": None, "height": 0, "num_leaves": 1}  # Node attributes that older pickles may lack
+
+
+# Restore the attributes of an unpickled node (the node classes' __setstate__). state is (None, slots) for nodes pickled
+# with __slots__ and the node's __dict__ for nodes pickled before the node classes had slots, which may lack the newer
+# attributes (they get the values of a leaf, see index_shapes()) and have a single hash_function and string ids
+def restore_node(node, state):
+    if isinstance(state, tuple):
+        state = state[1]
+    else:
+        state = dict(state)
+        if "hash_function" in state:
+            state["hash_functions"] = [state.pop("hash_function")]
+        state["id"] = int(state["id"])
+    for slot in type(node).__slots__:
+        setattr(node, slot, state[slot] if slot in state else NODE_DEFAULTS[slot])
+
+
+# Set the height and number of leaves of every node of a tree (e.g. of a tree pickled before nodes tracked them)
+def index_shapes(root):
+    for node in reversed(list(iter_nodes(root))):  # Children before their parents
+        if node.left_child is None:
+            node.height = 0
+            node.num_leaves = 1
+        else:
+            update_shape(node)
+
+
+# Number the leaves of a tree from left to right and set every node's leaf_range to the (first, last + 1) leaf ids of
+# its subtree. Returns the leaves in id order
+def index_leaves(root):
+    leaves = []
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if node.left_child is None:  # Leaf
+            node.leaf_range = (len(leaves), len(leaves) + 1)
+            leaves.append(node)
+        elif children_done:  # Both subtrees are numbered
+            node.leaf_range = (node.left_child.leaf_range[0], node.right_child.leaf_range[1])
+        else:
+            stack.append((node, True))
+            stack.append((node.right_child, False))
+            stack.append((node.left_child, False))
+    return leaves
+
+
+# Yield every node whose whole subtree matches a query, from left to right. check(node, *state, trace=trace) is one of
+# the node classes' check methods and returns (status, *child_state) where status is one of kernels.MISS, HIT or
+# PARTIAL. Children of PARTIAL nodes are searched with child_state. Every check is reported to trace (a QueryTrace) if
+# given
+def iter_matches(root, check, state, links=NodeLinks, trace=None):
+    stack = [(root, state, 0)]
+    while stack:
+        node, state, depth = stack.pop()
+        status, *child_state = check(node, *state, trace=trace)
+        if trace is not None:
+            trace.check(depth, status, is_leaf(node, links))
+        if status == HIT:
+            yield node
+        elif status == PARTIAL:
+            left_child, right_child = links.children(node)
+            stack.append((right_child, child_state, depth + 1))
+            stack.append((left_child, child_state, depth + 1))
+
+
+# Yield the experiment names of all leaves that match a query as they are found
+def iter_matching_names(root, check, state, trace=None):
+    for node in iter_matches(root, check, state, trace=trace):
+        for leaf in iter_leaves(node):
+            yield leaf.experiment_name
+
+
+# Collect the ids of all leaves that match a query into a bitset (bool array over the leaf ids). The tree must have
+# been numbered by index_leaves()
+def match_leaf_ids(root, check, state, num_leaves, links=NodeLinks, trace=None):
+    matches = np.zeros(num_leaves, dtype=bool)
+    for node in iter_matches(root, check, state, links, trace):
+        first, last = links.leaf_range(node)
+        matches[first:last] = True
+    return matches
+
+
+# Batched version of match_leaf_ids(). check(node, *state, trace=trace) is one of the node classes' batch_check
+# methods and returns (found, child_state) where found marks the queries whose every descendant matches and child_state
+# is None if no query has to search the children. Returns a (# queries x # leaves) bitset. The state holds the mask of
+# the queries still searching a subtree as its fourth element, which is what the checks reported to trace count
+def batch_match_leaf_ids(root, check, state, num_queries, num_leaves, links=NodeLinks, trace=None):
+    matches = np.zeros((num_queries, num_leaves), dtype=bool)
+    stack = [(root, state, 0)]
+    while stack:
+        node, state, depth = stack.pop()
+        found, child_state = check(node, *state, trace=trace)
+        if trace is not None:
+            trace.batch_check(depth, int(np.count_nonzero(state[3])), int(np.count_nonzero(found)),
+                              int(np.count_nonzero(child_state[3])) if child_state is not None else 0,
+                              is_leaf(node, links))
+        if found.any():
+            first, last = links.leaf_range(node)
+            matches[np.flatnonzero(found), first:last] = True
+        if child_state is not None:
+            left_child, right_child = links.children(node)
+            stack.append((right_child, child_state, depth + 1))
+            stack.append((left_child, child_state, depth + 1))
+    return matches
@@ -0,0 +1,89 @@
+"""
+Reproducible benchmark suite. Generates seeded synthetic genomes, benchmarks every combination of SBT type and insertion
+method on them (read, hash, build, query with every query method, save and load are timed separately and their peak
+memory is traced, see SBT/benchmark.py) and writes the results as one JSON file. Pass a baseline results file to
+compare against it: the script then lists every phase that got slower or used more memory and exits with status 1 if
+any did. The parameters in dictionary p are the defaults, the most common ones can also be set on the command line:
+
+    python benchmark.py --output results.json
+    python benchmark.py --sbt-types SSBT HowDe --baseline results.json
+"""
+from SBT.benchmark import run_suite, save_results, load_results, compare_results
+from SBT.KmerHasher import KmerHasher
+from SBT.similarity import and_hamming
+import argparse
+import tempfile
+import sys
+
+# Parameters
+p = {
+    "num_sequences": 32,                    # n - Number of synthetic genomes
+    "sequence_len": 50000,                  # Size of each genome
+    "num_families": 4,                      # Number of random reference genomes the genomes are strains of
+    "snp_rate": 0.001,                      # Fraction of the bases of a reference that a genome changes
+    "seed": 0,                              # Seed of the genomes and queries
+
+    "query_size": 500,                      # Size of query sequence
+    "num_queries": 200,                     # Number of queries to perform with each query method
+    "query_snps": 1,                        # SNPs in every query
+
+    "bloom_filter_length": 100000,          # m - Size of bloom filters
+    "k": 25,                                # k - Size of kmer
+    "bits_to_check": 1000,                  # b' - Number of bits to compare filters on when inserting
+    "threshold": 0.9,                       # theta - Proportion of kmers that must hit in order to return a node
+    "similarity_function": and_hamming,     # Similarity metric to compare filters
+    "hash_functions": [KmerHasher(0)],      # h - Seeded functions to hash kmers
+    "hash_fraction": 1,                     # Simulate partial hash function
+    "workers": None,                        # Processes building leaf filters in parallel (None for serial)
+
+    "sbt_types": ["Base", "SSBT", "HowDe"],  # SBT types to benchmark
+    "insert_methods": ["Greedy", "Cluster2"],  # Insertion methods to benchmark
+    "query_methods": ["Normal", "Fast", "Batch"],  # Query methods to benchmark
+    "trace_memory": True,                   # Trace the peak memory of every phase (tracemalloc slows phases down)
+
+    "output": "experiment_results/benchmark.json",  # Where to write the results
+    "baseline": None,                       # Results file to compare against (None to skip the comparison)
+    "tolerance": 0.25,                      # Fraction a phase may get slower or use more memory than the baseline
+    "min_time": 0.01,                       # Seconds a phase may get slower regardless of the tolerance
+}
+
+
+# Override the parameters given on the command line
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Benchmark SBT types and insertion and query methods")
+    parser.add_argument("--num-sequences", type=int, default=p["num_sequences"])
+    parser.add_argument("--sequence-len", type=int, default=p["sequence_len"])
+    parser.add_argument("--num-queries", type=int, default=p["num_queries"])
+    parser.add_argument("--bloom-filter-length", type=int, default=p["bloom_filter_length"])
+    parser.add_argument("--seed", type=int, default=p["seed"])
+    parser.add_argument("--sbt-types", nargs="+", default=p["sbt_types"], choices=["Base", "SSBT", "HowDe"])
+    parser.add_argument("--insert-methods", nargs="+", default=p["insert_methods"],
+                        choices=["Greedy", "Cluster1", "Cluster2", "Append"])
+    parser.add_argument("--query-methods", nargs="+", default=p["query_methods"], choices=["Normal", "Fast", "Batch"])
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false", default=p["trace_memory"])
+    parser.add_argument("--output", default=p["output"])
+    parser.add_argument("--baseline", default=p["baseline"])
+    parser.add_argument("--tolerance", type=float, default=p["tolerance"])
+    parser.add_argument("--min-time", type=float, default=p["min_time"])
+    p.update(vars(parser.parse_args(arguments)))
+
+
+if __name__ == "__main__":
+    parse_arguments(sys.argv[1:])
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_suite(p, directory)
+    save_results(results, p["output"])
+    for case, result in results["cases"].items():
+        print(case)
+        for phase, measurement in result["phases"].items():
+            print("   ", phase.ljust(16), "{:10.4f} s".format(measurement["time"]),
+                  "{:12.1f} KiB".format(measurement["peak_memory"] / 1024) if "peak_memory" in measurement else "")
+        print("   ", "peak RSS".ljust(16), "{:10.1f} MiB".format(result["peak_rss"] / (1 << 20)))
+    print("Results written to  ", p["output"])
+    if p["baseline"] is not None:
+        regressions = compare_results(results, load_results(p["baseline"]), p["tolerance"], p["min_time"])
+        for regression in regressions:
+            print("Regression          ", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", p["baseline"])
@@ -0,0 +1,43 @@
+"""
+Builds the index file of a collection too large to cluster in memory (see SBT/external_build.py). The leaf filters of
+the sequence files sequence_prefix + number are spilled to scratch files as they are built, the tree is clustered like
+the "Cluster2" insertion method within memory_budget bytes of filters and similarities and the index is written
+directly to index_file, ready for server.py or SBT.open_index(). Nothing here should be changed other than the
+parameters listed in dictionary p.
+"""
+from SBT.SBT import SBT
+from SBT.KmerHasher import KmerHasher
+from SBT.similarity import hamming
+import resource
+import time
+
+# Parameters
+p = {
+    "bloom_filter_length": 1000000,         # m - Size of bloom filters
+    "k": 25,                                # k - Size of kmer
+    "bits_to_check": 1000,                  # b' - Number of bits to compare filters on when clustering
+    "num_sequences": 250,                   # n - Number of sequence files to index
+    "threshold": 0.9,                       # theta - Proportion of kmers that must hit in order to return a node
+
+    "sbt_type": "Base",                     # SBT Type ("Base", "SSBT", "HowDe")
+    "similarity_function": hamming,         # Similarity metric from SBT/similarity.py (hamming, and_hamming, etc)
+    "hash_functions": [KmerHasher(0)],      # h - Seeded functions to hash kmers
+    "memory_budget": 1 << 28,               # Bytes of filters and similarities held in memory while building
+    "workers": None,                        # Processes building leaf filters in parallel (None for serial)
+
+    "sequence_prefix": "fasta/sim",         # Prefix of genome files (e.g. fasta/sim0, fasta/sim1)
+    "index_file": "sbt_data/index_Base",    # Index file to write
+    "scratch_directory": None,              # Directory of the scratch files (None for the index file's directory)
+}
+
+if __name__ == "__main__":
+    start = time.time()
+    file_names = [p["sequence_prefix"] + str(number) for number in range(p["num_sequences"])]
+    sbt = SBT(p["k"], p["bloom_filter_length"], p["hash_functions"], p["threshold"], p["similarity_function"],
+              p["sbt_type"])
+    sbt.build_index(file_names, file_names, p["index_file"], bits_to_check=p["bits_to_check"],
+                    memory_budget=p["memory_budget"], from_file=True, workers=p["workers"],
+                    scratch_directory=p["scratch_directory"])
+    print("Build Time          ", time.time() - start)
+    print("Peak Memory (KiB)   ", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    print("Nodes               ", len(sbt.flat.left))
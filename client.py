@@ -0,0 +1,55 @@
+"""
+Client for server.py. Sends random substrings of the sequence files as queries from several client threads at once,
+so that the server can batch them, and reports the client side latencies and the server's statistics. Nothing here
+should be changed other than the parameters listed in dictionary p.
+"""
+from SBT.QueryClient import QueryClient
+from SBT.sequence_reader import read_sequence
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import random
+import time
+
+# Parameters
+p = {
+    "host": "127.0.0.1",                    # Address of the server
+    "port": 8765,                           # Port of the server
+    "socket_path": None,                    # Unix socket of the server (None for TCP)
+    "sequence_prefix": "fasta/sim",         # Prefix of genome files to draw queries from
+    "num_sequences": 10,                    # Number of genome files to draw queries from
+    "sequence_len": 1000000,                # Bases read from each file
+    "query_size": 500,                      # Size of query sequence
+    "num_queries": 1000,                    # Number of queries to send
+    "clients": 8,                           # Number of clients sending queries at the same time
+}
+
+
+# Send queries one at a time from one client and return their latencies
+def run_client(queries):
+    latencies = []
+    with QueryClient(p["host"], p["port"], p["socket_path"]) as client:
+        for query in queries:
+            start = time.perf_counter()
+            client.query(query)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+if __name__ == "__main__":
+    sequences = [read_sequence(p["sequence_prefix"] + str(i), p["sequence_len"]) for i in range(p["num_sequences"])]
+    queries = []
+    for _ in range(p["num_queries"]):
+        sequence = random.choice(sequences)
+        start = random.randint(0, len(sequence) - p["query_size"])
+        queries.append(sequence[start:start + p["query_size"]])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=p["clients"]) as executor:
+        latencies = np.concatenate([latencies for latencies in
+                                    executor.map(run_client, [queries[i::p["clients"]] for i in range(p["clients"])])])
+    elapsed = time.perf_counter() - start
+    print("Queries per Second  ", len(queries) / elapsed)
+    print("p50 Latency         ", np.percentile(latencies, 50))
+    print("p99 Latency         ", np.percentile(latencies, 99))
+    with QueryClient(p["host"], p["port"], p["socket_path"]) as client:
+        for key, value in client.stats().items():
+            print(("Server " + key).ljust(20), value)
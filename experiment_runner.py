@@ -0,0 +1,233 @@
+"""
+Cached, parallel experiment runner used by pipelined_main.py. Every parameter only affects some phases of an experiment
+(reading, hashing, building, querying), so configurations are run in two stages:
+
+1. The leaf filters of every distinct combination of the hashing parameters (HASH_PARAMETERS) are built once, one
+   sequence file per task in a process pool. Sequences are cached as plain bases keyed on the file and sequence_len,
+   the 64-bit kmer hashes of every file are cached keyed on the file, sequence_len, k and hash function (so changing
+   bloom_filter_length or hash_fraction does not hash the kmers again), and the packed leaf filters are cached keyed on
+   all hashing parameters. The sorted kmers of the exact kmer index (exact_kmers) only depend on the file,
+   sequence_len and k, so they are built once per file in the same pool and cached too. The caches are files in
+   cache_location, so they are reused by later runs too and are invalidated when a sequence file changes.
+2. Configurations that only differ in query time parameters (anything outside BUILD_PARAMETERS, e.g. threshold,
+   query_method or max_density) share one tree: every group of them runs in one process of a pool, which builds the
+   tree from the cached leaves once and then queries it with every configuration of the group. The exact kmer index is
+   assembled from memory-mapped cached kmers, so the groups share them through the page cache instead of each holding
+   its own copy.
+
+The metrics of all configurations (the same as those reported by utils.main) are collected into one csv table.
+"""
+from utils import query_sequences, save_sbt, save_trace, print_params
+from SBT.SBT import SBT
+from SBT.KmerHasher import KmerHasher
+from SBT.KmerIndex import KmerIndex
+from SBT.bits import indices_to_bitarray
+from SBT.sequence_reader import read_sequence
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pandas as pd
+import numpy as np
+import hashlib
+import time
+import os
+
+CACHE_VERSION = 2  # Part of every cache key, bumped when the cached sequences or hashes change meaning
+READ_PARAMETERS = ("sequence_prefix", "num_sequences", "sequence_len")
+EXACT_PARAMETERS = READ_PARAMETERS + ("k",)  # Parameters the exact kmer index depends on
+HASH_PARAMETERS = READ_PARAMETERS + ("k", "bloom_filter_length", "hash_functions", "hash_fraction")
+BUILD_PARAMETERS = HASH_PARAMETERS + ("sbt_type", "insert_method", "bits_to_check", "similarity_function",
+                                      "balance_factor")
+
+
+# Key of a configuration's values of some parameters (functions and hash functions are told apart by their repr)
+def parameter_key(p, parameters):
+    return tuple(repr(p[parameter]) for parameter in parameters)
+
+
+# File name in the cache for the given parts of a key. Sequence files are identified by their path, size and
+# modification time, so a changed file is not served from the cache
+def cache_file(cache_location, kind, file_name, *parts):
+    status = os.stat(file_name)
+    key = repr((CACHE_VERSION, os.path.abspath(file_name), status.st_size, status.st_mtime_ns) + parts)
+    return os.path.join(cache_location, kind + "_" + hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+
+
+# Returns the first sequence_len bases of a sequence file, from the cache if they are in it
+def cached_sequence(file_name, sequence_len, cache_location):
+    cached = cache_file(cache_location, "sequence", file_name, sequence_len) + ".txt"
+    if os.path.exists(cached):
+        with open(cached) as f:
+            return f.read()
+    sequence = read_sequence(file_name, sequence_len)
+    with open(cached + ".tmp", "w") as f:
+        f.write(sequence)
+    os.replace(cached + ".tmp", cached)  # Other processes never see a partly written file
+    return sequence
+
+
+# Returns the 64-bit hashes of all kmers of a file's sequence under a KmerHasher, from the cache if they are in it
+def cached_kmer_hashes(file_name, sequence_len, k, hash_function, cache_location, sequence):
+    cached = cache_file(cache_location, "kmers", file_name, sequence_len, k, repr(hash_function)) + ".npy"
+    if os.path.exists(cached):
+        return np.load(cached, mmap_mode="r")
+    hashes = hash_function.kmer_hashes(KmerHasher.encode(sequence), k)
+    np.save(cached + ".tmp.npy", hashes)
+    os.replace(cached + ".tmp.npy", cached)
+    return hashes
+
+
+# Returns the sorted distinct kmer keys of a file's sequence for the exact kmer index (KmerIndex.experiment_kmers()),
+# memory-mapped from the cache and built into it first if they are not in it
+def cached_exact_kmers(file_name, sequence_len, k, cache_location):
+    cached = cache_file(cache_location, "exact", file_name, sequence_len, k) + ".npy"
+    if not os.path.exists(cached):
+        kmers = KmerIndex(k).experiment_kmers(cached_sequence(file_name, sequence_len, cache_location))
+        np.save(cached + ".tmp.npy", kmers)
+        os.replace(cached + ".tmp.npy", cached)
+    return np.load(cached, mmap_mode="r")
+
+
+# Build the cached kmers of the exact kmer index of every sequence file of the configurations with exact_kmers, once
+# per distinct key of EXACT_PARAMETERS and one sequence file per task. Returns the seconds spent for every key
+def build_exact_kmers(configurations, executor, cache_location):
+    times = {}
+    for p in configurations:
+        key = parameter_key(p, EXACT_PARAMETERS)
+        if key in times or not p["exact_kmers"]:
+            continue
+        file_names = [p["sequence_prefix"] + str(i) for i in range(p["num_sequences"])]
+        start = time.perf_counter()
+        for _ in executor.map(cached_exact_kmers, file_names, repeat(p["sequence_len"]), repeat(p["k"]),
+                              repeat(cache_location)):
+            pass
+        times[key] = time.perf_counter() - start
+    return times
+
+
+# Exact kmer index of a configuration's sequence files from the cached kmers of every file (see cached_exact_kmers)
+def cached_exact_index(file_names, p, cache_location):
+    index = KmerIndex(p["k"])
+    for file_name in file_names:
+        index.add_kmers(cached_exact_kmers(file_name, p["sequence_len"], p["k"], cache_location), file_name)
+    return index
+
+
+# Packed leaf filter of one sequence file for a configuration's hashing parameters (see HASH_PARAMETERS). Runs in the
+# processes of the first stage. The kmers left out for hash_fraction < 1 are drawn with the given seed. Returns the
+# filter and the seconds spent reading and hashing
+def leaf_filter(file_name, p, cache_location, seed):
+    start = time.perf_counter()
+    sequence = cached_sequence(file_name, p["sequence_len"], cache_location)
+    read_time = time.perf_counter() - start
+    columns = [cached_kmer_hashes(file_name, p["sequence_len"], p["k"], hash_function, cache_location, sequence) %
+               np.uint64(p["bloom_filter_length"]) for hash_function in p["hash_functions"]]
+    filter_indices = np.array(columns, dtype=np.int64).reshape(len(columns), -1).T
+    if p["hash_fraction"] < 1:  # Hash only some of the kmers
+        filter_indices = filter_indices[np.random.default_rng(seed).random(len(filter_indices)) < p["hash_fraction"]]
+    packed_filter = indices_to_bitarray(filter_indices, p["bloom_filter_length"]).tobytes()
+    return packed_filter, read_time, time.perf_counter() - start - read_time
+
+
+# Build (or read from the cache) the leaf filters of every configuration whose hash functions are all KmerHashers, one
+# sequence file per task. Returns the leaf filter file (a .npy matrix with one row per sequence file) and the seconds
+# spent reading and hashing for every key of the hashing parameters
+def build_leaf_filters(configurations, executor, cache_location):
+    leaves = {}
+    for p in configurations:
+        key = parameter_key(p, HASH_PARAMETERS)
+        if key in leaves or not all(isinstance(hash_function, KmerHasher) for hash_function in p["hash_functions"]):
+            continue
+        file_names = [p["sequence_prefix"] + str(i) for i in range(p["num_sequences"])]
+        leaf_file = cache_file(cache_location, "leaves", file_names[0], file_names[1:], key,
+                               [os.stat(file_name).st_mtime_ns for file_name in file_names]) + ".npy"
+        read_time = hash_time = 0
+        if not os.path.exists(leaf_file):
+            results = list(executor.map(leaf_filter, file_names, repeat(p), repeat(cache_location),
+                                        range(len(file_names))))
+            packed_filters = np.array([np.frombuffer(packed_filter, dtype=np.uint8) for packed_filter, _, _ in results])
+            read_time = sum(result[1] for result in results)
+            hash_time = sum(result[2] for result in results)
+            np.save(leaf_file + ".tmp.npy", packed_filters)
+            os.replace(leaf_file + ".tmp.npy", leaf_file)
+        leaves[key] = (leaf_file, read_time, hash_time)
+    return leaves
+
+
+# Run a group of configurations that share a tree (see BUILD_PARAMETERS). Runs in the processes of the second stage.
+# leaves is the leaf filter file, read and hash times of the group (None to build the leaves from the sequences here)
+# and exact_time the seconds spent building the cached kmers of its exact kmer index (None if no configuration of the
+# group uses one). Returns the parameters and metrics of every configuration
+def run_group(configurations, leaves, cache_location, exact_time=None):
+    p = configurations[0]
+    file_names = [p["sequence_prefix"] + str(i) for i in range(p["num_sequences"])]
+    start = time.perf_counter()
+    sequences = {file_name: cached_sequence(file_name, p["sequence_len"], cache_location) for file_name in file_names}
+    metrics = {"read_time": time.perf_counter() - start}
+    sbt = SBT(k=p["k"], bloom_filter_length=p["bloom_filter_length"], hash_functions=p["hash_functions"],
+              threshold=p["threshold"], similarity_function=p["similarity_function"], sbt_type=p["sbt_type"],
+              hash_fraction=p["hash_fraction"])
+    if p["balance_factor"] is not None:
+        sbt.enable_rebalancing(p["balance_factor"], p["bits_to_check"])
+    start = time.perf_counter()
+    if leaves is not None:
+        leaf_file, metrics["leaf_read_time"], metrics["hash_time"] = leaves
+        nodes = sbt.nodes_from_packed(np.load(leaf_file, mmap_mode="r"), file_names)
+    else:
+        nodes = sbt.nodes_from_sequences(sequences.values(), file_names, p["workers"])
+        metrics["hash_time"] = time.perf_counter() - start
+        start = time.perf_counter()
+    sbt.insert_nodes(nodes, p["insert_method"], p["bits_to_check"])
+    metrics["insert_time"] = time.perf_counter() - start
+    metrics["height"] = sbt.height()
+    del nodes
+    exact_index = None
+    if any(configuration["exact_kmers"] for configuration in configurations):
+        start = time.perf_counter()
+        exact_index = cached_exact_index(file_names, p, cache_location)
+        metrics["exact_index_time"] = (exact_time or 0) + time.perf_counter() - start
+    results = []
+    for p in configurations:
+        p = dict(p, **metrics)
+        print_params(p)
+        sbt.threshold = p["threshold"]
+        sbt.decompress_filters()
+        if p["max_density"] is not None:
+            sbt.compress_filters(p["max_density"])
+        if p["query_cache"] is not None:
+            sbt.enable_query_cache(p["query_cache"])
+        else:
+            sbt.disable_query_cache()
+        if p["trace_location"] is not None:
+            sbt.enable_tracing()
+        query_sequences(sbt=sbt, all_sequences=sequences, method=p["query_method"], num_queries=p["num_queries"],
+                        dictionary=p, query_size=p["query_size"], boyer_moore=p["boyer_moore"],
+                        exact_index=exact_index if p["exact_kmers"] else None)
+        if p["trace_location"] is not None:
+            save_trace(sbt.disable_tracing(), p["trace_location"], p["benchmark_name"], p)
+        save_sbt(sbt=sbt, file_name=p["sbt_location"] + "sbt_" + str(p["benchmark_name"]), dictionary=p)
+        results.append(p)
+    return results
+
+
+# Run every configuration (parameter dictionaries as for utils.main, each with its own benchmark_name) with at most
+# processes processes (None for one per core), caching in cache_location. Writes the parameters and metrics of all
+# configurations as one csv table to results_file and returns the table
+def run_experiments(configurations, results_file, cache_location, processes=None):
+    os.makedirs(cache_location, exist_ok=True)
+    groups = {}
+    for p in configurations:
+        groups.setdefault(parameter_key(p, BUILD_PARAMETERS), []).append(p)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        leaves = build_leaf_filters(configurations, executor, cache_location)
+        exact_times = build_exact_kmers(configurations, executor, cache_location)
+        futures = [executor.submit(run_group, group, leaves.get(parameter_key(group[0], HASH_PARAMETERS)),
+                                   cache_location, exact_times.get(parameter_key(group[0], EXACT_PARAMETERS)))
+                   for group in groups.values()]
+        rows = [row for future in futures for row in future.result()]
+    table = pd.DataFrame([{key: value if isinstance(value, (int, float, str, bool, type(None))) else repr(value)
+                           for key, value in row.items()} for row in rows]).set_index("benchmark_name")
+    directory = os.path.dirname(results_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    table.to_csv(results_file)
+    return table
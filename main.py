@@ -10,7 +10,7 @@ from utils import *
 p = {
     "bloom_filter_length": 1000000,         # m - Size of bloom filters
     "k": 25,                                # k - Size of kmer
-    "bits_to_check": 1000,                  # b' - Number of bits to check when clustering for insertions
+    "bits_to_check": 1000,                  # b' - Number of bits to compare filters on when inserting
     "num_sequences": 250,                   # n - Number of sequences to insert
     "threshold": 0.9,                       # theta - Proportion of kmers that must hit in order to return a node
 
@@ -19,12 +19,17 @@ p = {
     "num_queries": 500,                     # Number of queries to perform
 
     "sbt_type": "Base",                     # SBT Type ("Base", "SSBT", "HowDe")
-    "insert_method": "Cluster2",            # SBT Insertion Method - ("Greedy", "Cluster1", "Cluster2")
-    "query_method": "Fast",                 # SBT Query Method - ("Normal", "Fast")
+    "insert_method": "Cluster2",            # SBT Insertion Method - ("Greedy", "Cluster1", "Cluster2", "Append")
+    "workers": None,                        # Processes building leaf filters in parallel (None for serial)
+    "query_method": "Fast",                 # SBT Query Method - ("Normal", "Fast", "Batch")
 
     "similarity_function": hamming,         # Similarity metric to compare filters - (hamming, cosine, jaccard, etc)
-    "hash_functions": [hash],               # h - Function to hash kmers
+    "hash_functions": [KmerHasher(0)],      # h - Seeded functions to hash kmers (hash is salted per process)
     "hash_fraction": 1,                     # Simulate partial hash function
+    "max_density": None,                    # Store filters at most this dense as SparseFilters (None to disable)
+    "query_cache": None,                    # Bytes of query results to cache (None to disable)
+    "balance_factor": None,                 # Height limit in balanced heights (None to disable)
+    "trace_location": None,                 # Where to write a JSON trace of the queries (None to disable)
 
     "print_sbt": False,                     # Print SBT graph
     "print_type": "Bits",                   # What to print in SBT nodes - ("Bits", "Names")
@@ -35,6 +40,7 @@ p = {
     "benchmark_name": "test_benchmark",     # Name of benchmark
 
     "boyer_moore": False,                   # Use Boyer-Moore to benchmark against SBT and to verify hits
+    "exact_kmers": True,                    # Verify hits with an exact kmer index at the threshold (see KmerIndex)
 }
 
 main(p)
@@ -1,7 +1,14 @@
-""" Pipelined version of main.py that runs main multiple times but with different parameters """
+""" Pipelined version of main.py that runs the benchmark of main.py with many different parameters. Experiments run in
+parallel and only redo the phases that their parameters affect (see experiment_runner.py), and the results of all
+experiments are written to one csv table """
 from utils import *
+from experiment_runner import run_experiments
 import copy
 
+processes = None                               # Experiments run in parallel (None for one per core)
+cache_location = "sbt_data/cache/"             # Where sequences, hashed kmers and leaf filters are cached
+results_file = "experiment_results.csv"        # Table with the parameters and results of every experiment
+
 # List of the different experiments to run. Each dictionary in the list contains a key, which is the parameter that
 # will be varied, and a value, which is a list of different values that the parameter will be set to during different
 # calls to main
@@ -32,7 +39,7 @@ double_experiments = [
 default_parameters = {
     "bloom_filter_length": 1000000,            # m - Size of bloom filters
     "k": 25,                                   # k - Size of kmer
-    "bits_to_check": 1000,                     # b' - Number of bits to check when clustering for insertions
+    "bits_to_check": 1000,                     # b' - Number of bits to compare filters on when inserting
     "num_sequences": 250,                      # n - Number of sequences to insert
     "threshold": 0.9,                          # theta - Proportion of kmers that must hit in order to return a node
 
@@ -41,12 +48,17 @@ default_parameters = {
     "num_queries": 500,                        # Number of queries to perform
 
     "sbt_type": "Base",                        # SBT Type ("Base", "SSBT", "HowDe")
-    "insert_method": "Cluster2",               # SBT Insertion Method - ("Greedy", "Cluster1", "Cluster2")
-    "query_method": "Fast",                    # SBT Query Method - ("Normal", "Fast")
+    "insert_method": "Cluster2",               # SBT Insertion Method - ("Greedy", "Cluster1", "Cluster2", "Append")
+    "workers": None,                           # Processes building leaf filters in parallel (None for serial)
+    "query_method": "Fast",                    # SBT Query Method - ("Normal", "Fast", "Batch")
 
     "similarity_function": hamming,            # Similarity metric to compare filters - (hamming, cosine, jaccard, etc)
-    "hash_functions": [hash],                  # h - Function to hash kmers
+    "hash_functions": [KmerHasher(0)],         # h - Seeded functions to hash kmers (hash is salted per process)
     "hash_fraction": 1,                        # Simulate partial hash function
+    "max_density": None,                       # Store filters at most this dense as SparseFilters (None to disable)
+    "query_cache": None,                       # Bytes of query results to cache (None to disable)
+    "balance_factor": None,                    # Height limit in balanced heights (None to disable)
+    "trace_location": None,                    # Where to write a JSON trace of the queries (None to disable)
 
     "print_sbt": False,                        # Print SBT graph
     "print_type": "Bits",                      # What to print in SBT nodes - ("Bits", "Names")
@@ -57,17 +69,19 @@ default_parameters = {
     "benchmark_name": "test_benchmark",        # Name of benchmark
 
     "boyer_moore": False,                      # Use Boyer-Moore to benchmark against SBT and to verify hits
+    "exact_kmers": False,                      # Verify hits with an exact kmer index at the threshold (see KmerIndex)
 }
 
-# Run all experiments
+# Collect the parameters of all experiments
+configurations = []
 for experiment in experiments:
     for value in experiment["values"]:
         p = copy.deepcopy(default_parameters)
         p["benchmark_name"] = experiment["key"] + str(value)
         p[experiment["key"]] = value
-        main(p)
+        configurations.append(p)
 
-# Run all double experiments
+# Collect the parameters of all double experiments
 for experiment in double_experiments:
     for value0 in experiment["values0"]:
         for value1 in experiment["values1"]:
@@ -75,4 +89,8 @@ for experiment in double_experiments:
             p["benchmark_name"] = experiment["keys"][0] + str(value0) + experiment["keys"][1] + str(value1)
             p[experiment["keys"][0]] = value0
             p[experiment["keys"][1]] = value1
-            main(p)
+            configurations.append(p)
+
+# Run all experiments, sharing sequences, hashed kmers and trees between them (see experiment_runner.py)
+if __name__ == "__main__":
+    run_experiments(configurations, results_file=results_file, cache_location=cache_location, processes=processes)
@@ -11,8 +11,4 @@ for file in os.listdir('fasta'):
             os.remove(new_name)
         except FileNotFoundError:
             pass
-        os.rename('fasta/' + file, new_name)
-        with open(new_name, 'r') as fin:
-            data = fin.read().splitlines(True)
-        with open(new_name, 'w') as fout:
-            fout.writelines(data[1:])
+        os.rename('fasta/' + file, new_name)  # FASTA headers and line breaks are handled by SBT/sequence_reader.py
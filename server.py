@@ -0,0 +1,43 @@
+"""
+Query server that keeps an SBT resident and answers queries from many clients. The SBT is loaded once, either from a
+pickle saved by main.py (sbt_location + "sbt_" + sbt_type) or from an index file written by SBT.save_index(), and
+queries arriving close together are answered in micro-batches (see SBT/QueryServer.py). Run client.py to send queries
+and report latencies. Nothing here should be changed other than the parameters listed in dictionary p.
+"""
+from SBT.SBT import SBT
+from SBT.QueryServer import QueryServer
+from SBT.index_file import MAGIC
+import asyncio
+import time
+
+# Parameters
+p = {
+    "sbt_file": "sbt_data/sbt_Base",        # SBT pickle (SBT.save) or index file (SBT.save_index) to serve
+    "host": "127.0.0.1",                    # Address to listen on
+    "port": 8765,                           # Port to listen on
+    "socket_path": None,                    # Listen on this Unix socket instead of host:port (None for TCP)
+    "batch_window": 0.002,                  # Seconds to collect queries into a batch
+    "max_batch": 256,                       # Maximum number of queries in a batch
+    "query_cache": None,                    # Bytes of query results to cache (None to disable)
+}
+
+
+# Load an SBT pickle or index file
+def load(file_name):
+    with open(file_name, "rb") as f:
+        is_index = f.read(len(MAGIC)) == MAGIC
+    return SBT.open_index(file_name) if is_index else SBT.load(file_name)
+
+
+if __name__ == "__main__":
+    start = time.time()
+    sbt = load(p["sbt_file"])
+    if p["query_cache"] is not None:
+        sbt.enable_query_cache(p["query_cache"])
+    print("Load Time           ", time.time() - start)
+    print("Serving on          ", p["socket_path"] or p["host"] + ":" + str(p["port"]))
+    server = QueryServer(sbt, batch_window=p["batch_window"], max_batch=p["max_batch"])
+    try:
+        asyncio.run(server.serve(host=p["host"], port=p["port"], path=p["socket_path"]))
+    except KeyboardInterrupt:
+        print(server.stats())
@@ -0,0 +1,29 @@
+"""
+Generates related genomes as test data for the SBT without external tools (replaces run.sh and rename.py). A reference
+genome evolves along a random phylogeny into num_genomes variants with SNPs, insertions and deletions, which are written
+in parallel as FASTA files named sequence_prefix + number, ready for main.py (see SBT/genome_simulator.py)
+"""
+from SBT.genome_simulator import simulate_genomes
+import time
+
+# Parameters
+p = {
+    "num_genomes": 500,                     # Number of genomes to generate
+    "genome_len": 1000000,                  # Size of the reference (the genomes differ by their indels)
+    "reference_file": "fasta/ref.genome.fa",  # Reference genome (None for a random reference)
+    "snp_rate": 0.01,                       # Fraction of bases changed by SNPs between the reference and every genome
+    "indel_rate": 0.001,                    # Indels per base between the reference and every genome
+    "max_indel_len": 10,                    # Maximum number of bases inserted or deleted by an indel
+    "relatedness": 0.5,                     # How much of their mutations genomes share (0 for independent variants)
+    "seed": 0,                              # Seed of the reference, phylogeny and mutations
+    "workers": 4,                           # Processes writing genomes in parallel (None for serial)
+    "sequence_prefix": "fasta/sim",         # Prefix of the genome files (e.g. fasta/sim0, fasta/sim1)
+}
+
+if __name__ == "__main__":
+    start = time.time()
+    file_names = simulate_genomes(prefix=p["sequence_prefix"], num_genomes=p["num_genomes"],
+                                  genome_len=p["genome_len"], snp_rate=p["snp_rate"], indel_rate=p["indel_rate"],
+                                  max_indel_len=p["max_indel_len"], relatedness=p["relatedness"], seed=p["seed"],
+                                  reference_file=p["reference_file"], workers=p["workers"])
+    print(len(file_names), "genomes written in", time.time() - start, "seconds")
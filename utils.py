@@ -1,13 +1,17 @@
 """
 Utility functions that main.py uses. Here we define the individual processes for sequence reading, SBT insertion, SBT
 querying, and SBT saving. In addition, the processes also report metrics such as time elapsed, false positive rate, and
-memory used. Different hash and similarity functions are also included here for use.
+memory used. Different hash functions are also included here for use, along with the similarity functions of
+SBT/similarity.py.
 """
-import math
 import time
 import os
 import pandas as pd
 from SBT.SBT import SBT
+from SBT.KmerHasher import KmerHasher
+from SBT.KmerIndex import KmerIndex
+from SBT.sequence_reader import read_sequence
+from SBT.similarity import hamming, and_hamming, cosine, jaccard, manhattan, euclidian, dice, tanimoto
 import random
 from collections import defaultdict
 
@@ -25,10 +29,8 @@ def read_sequences(file_names, sequence_len, dictionary):
     sequences = {}
     start = time.time()
     for file_name in file_names:
-        # Read test sequences and insert
-        f = open(file_name, 'r')
-        sequences[file_name] = f.readline()[:sequence_len]
-        f.close()
+        # Read test sequences (FASTA/FASTQ/plain, optionally gzipped) up to sequence_len bases
+        sequences[file_name] = read_sequence(file_name, sequence_len)
     end = time.time()
     dictionary["read_time"] = end - start
     print("Read Time           ", dictionary["read_time"])
@@ -37,41 +39,65 @@ def read_sequences(file_names, sequence_len, dictionary):
 
 # Insert sequences into SBT using potentially different clustering methods
 # @profile
-def insert_sequences(sbt, sequences, bits_to_check, dictionary, method="Greedy"):
+def insert_sequences(sbt, sequences, bits_to_check, dictionary, method="Greedy", workers=None):
     start = time.time()
     if method == "Cluster1":
         sbt.insert_cluster_sequences1(sequences=sequences.values(), experiment_names=sequences.keys(),
-                                      bits_to_check=bits_to_check)
+                                      bits_to_check=bits_to_check, workers=workers)
     elif method == "Cluster2":
         sbt.insert_cluster_sequences2(sequences=sequences.values(), experiment_names=sequences.keys(),
-                                      bits_to_check=bits_to_check)
+                                      bits_to_check=bits_to_check, workers=workers)
+    elif method == "Append":
+        sbt.append_sequences(sequences=sequences.values(), experiment_names=sequences.keys(),
+                             bits_to_check=bits_to_check, workers=workers)
     else:
-        for name, sequence in sequences.items():
-            sbt.insert_sequence(sequence=sequence, experiment_name=name)
+        sbt.insert_sequences(sequences=sequences.values(), experiment_names=sequences.keys(), workers=workers,
+                             bits_to_check=bits_to_check)
     end = time.time()
     dictionary["insert_time"] = end - start
     print("Insert Time         ", dictionary["insert_time"])
 
 
+# Build the exact kmer index of the sequences (see SBT/KmerIndex.py) and report the time it took
+def build_exact_index(all_sequences, k, dictionary):
+    start = time.time()
+    exact_index = KmerIndex.from_sequences(all_sequences.values(), all_sequences.keys(), k)
+    end = time.time()
+    dictionary["exact_index_time"] = end - start
+    print("Exact Index Time    ", dictionary["exact_index_time"])
+    return exact_index
+
+
 # Query from SBT and report results
-# mode in ("Normal", "Fast", "Faster")
+# method in ("Normal", "Fast", "Batch")
 # repeat: number of times to run queries
+# exact_index: KmerIndex of all_sequences whose matches at the SBT's threshold are the true hits (None to only count
+# the query's own sequence and, with boyer_moore, the sequences that contain the query as a hit)
 # @profile
-def query_sequences(sbt, all_sequences, dictionary, num_queries, query_size, method="Normal", boyer_moore="False"):
+def query_sequences(sbt, all_sequences, dictionary, num_queries, query_size, method="Normal", boyer_moore="False",
+                    exact_index=None):
     queries = []
     hits = defaultdict(list)
     for name, sequence in all_sequences.items():
         idx = random.randint(0, len(sequence) - query_size)
         query = sequence[idx:idx+query_size]
         queries += [query]
-        if not boyer_moore:
+        if not boyer_moore and exact_index is None:
             hits[query] += [name]
+    # Verify hits with the exact kmer containment of every query
+    if exact_index is not None:
+        start = time.time()
+        for query, names in zip(queries, exact_index.query_batch(queries, sbt.threshold)):
+            hits[query] = names
+        end = time.time()
+        dictionary["exact_query_time"] = end - start
+        print("Exact Query Time    ", dictionary["exact_query_time"])
     # Report Boyer-Moore time to get an idea of how fast SBT runs and to verify hits
     if boyer_moore:
         start = time.time()
         for query in queries:
             for name, sequence in all_sequences.items():
-                if query in sequence:
+                if query in sequence and exact_index is None:
                     hits[query] += [name]
         end = time.time()
         dictionary["boyer_moore_time"] = end - start
@@ -85,9 +111,12 @@ def query_sequences(sbt, all_sequences, dictionary, num_queries, query_size, met
     total_negatives = 0
     queries_done = 0
     while queries_done < num_queries:
-        for query in queries:
+        batch_results = sbt.query_batch(sequences=queries) if method == "Batch" else None
+        for query_index, query in enumerate(queries):
             queries_done += 1
-            if method == "Fast":
+            if method == "Batch":
+                results = batch_results[query_index]
+            elif method == "Fast":
                 results = sbt.fast_query_sequence(sequence=query)
             else:
                 results = sbt.query_sequence(sequence=query)
@@ -112,6 +141,11 @@ def query_sequences(sbt, all_sequences, dictionary, num_queries, query_size, met
     print("False Positives     ", dictionary["false_positives"])
     print("False Negatives     ", dictionary["false_negatives"])
     print("False Positive Rate ", dictionary["false_positive_rate"])
+    if sbt.query_cache is not None:
+        dictionary["cache_hits"] = sbt.query_cache.hits
+        dictionary["cache_misses"] = sbt.query_cache.misses
+        print("Cache Hits          ", dictionary["cache_hits"])
+        print("Cache Misses        ", dictionary["cache_misses"])
 
 
 # Load SBT and report size
@@ -136,6 +170,20 @@ def save_sbt(sbt, file_name, dictionary):
     print("SBT Size (Bytes)    ", dictionary["sbt_size"])
 
 
+# Write the trace of the queries (see SBT.enable_tracing) as JSON into trace_location and report its totals
+def save_trace(trace, trace_location, benchmark_name, dictionary):
+    os.makedirs(trace_location, exist_ok=True)
+    file_name = "trace_" + str(benchmark_name).replace('<', '').replace('>', '') + ".json"
+    trace.to_json(os.path.join(trace_location, file_name))
+    summary = trace.to_dict()
+    dictionary["nodes_checked"] = summary["totals"]["checks"]
+    dictionary["bits_probed"] = summary["totals"]["bits_probed"]
+    dictionary["mean_prune_depth"] = summary["mean_prune_depth"]
+    print("Nodes Checked       ", dictionary["nodes_checked"])
+    print("Bits Probed         ", dictionary["bits_probed"])
+    print("Mean Prune Depth    ", dictionary["mean_prune_depth"])
+
+
 # Print Graph Itself
 def print_graph(sbt, print_sbt, print_type):
     if print_sbt:
@@ -166,13 +214,36 @@ def main(p):
     sequences = read_sequences(file_names=[p['sequence_prefix'] + str(i) for i in range(p["num_sequences"])],
                                sequence_len=p["sequence_len"], dictionary=p)
 
+    # Keep the tree balanced while inserting
+    if p["balance_factor"] is not None:
+        sbt.enable_rebalancing(p["balance_factor"], p["bits_to_check"])
+
     # Insert sequences into SBT
     insert_sequences(sbt=sbt, sequences=sequences, bits_to_check=p["bits_to_check"], method=p["insert_method"],
-                     dictionary=p)
+                     dictionary=p, workers=p["workers"])
+    p["height"] = sbt.height()
+    print("Tree Height         ", p["height"])
+
+    # Compress sparse node filters
+    if p["max_density"] is not None:
+        sbt.compress_filters(p["max_density"])
+
+    # Cache query results
+    if p["query_cache"] is not None:
+        sbt.enable_query_cache(p["query_cache"])
+
+    # Trace the queries
+    if p["trace_location"] is not None:
+        sbt.enable_tracing()
+
+    # Build the exact kmer index to verify hits with
+    exact_index = build_exact_index(sequences, p["k"], p) if p["exact_kmers"] else None
 
     # Query from SBT and report results
     query_sequences(sbt=sbt, all_sequences=sequences, method=p["query_method"], num_queries=p["num_queries"],
-                    dictionary=p, query_size=p["query_size"], boyer_moore=p["boyer_moore"])
+                    dictionary=p, query_size=p["query_size"], boyer_moore=p["boyer_moore"], exact_index=exact_index)
+    if p["trace_location"] is not None:
+        save_trace(sbt.disable_tracing(), p["trace_location"], p["benchmark_name"], p)
 
     # Save SBT
     save_sbt(sbt=sbt, file_name=p["sbt_location"] + "sbt_" + p["sbt_type"],
@@ -197,48 +268,5 @@ hash_dict = {
 def hash_lcg(s: str):
     x = 0
     for c in s[:16]:
-        x << 2
-        x += hash_dict[c]
+        x = (x << 2) + hash_dict[c]
     return x
-
-
-# Bit Similarity Function (Small pertubations to break ties)
-def hamming(a, b):
-    return -sum(a ^ b) + random.random() * 1e-9
-
-
-# Bit Similarity Function (hamming to break ties)
-def and_hamming(a, b):
-    return sum(a & b) - sum(a ^ b) * 1e-9
-
-
-# Bit Similarity Function
-def cosine(a, b):
-    d = math.sqrt(sum(a) * sum(b))
-    return (sum(a & b) / d if d else 0) + random.random() * 1e-9
-
-
-# Bit Similarity Function
-def jaccard(a, b):
-    return 1 - sum(a & b) / sum(a | b) + random.random() * 1e-9
-
-
-# Bit Similarity Function
-def manhattan(a, b):
-    return sum(a) + sum(b) - 2 * sum(a & b) + random.random() * 1e-9
-
-
-# Bit Similarity Function
-def euclidian(a, b):
-    return math.sqrt(manhattan(a, b)) + random.random() * 1e-9
-
-
-# Bit Similarity Function
-def dice(a, b):
-    return 2 * sum(a & b) / (sum(a) + sum(b)) + random.random() * 1e-9
-
-
-# Bit Similarity Function
-def tanimoto(a, b):
-    c = sum(a & b)
-    return c / (sum(a) + sum(b) + c) + random.random() * 1e-9